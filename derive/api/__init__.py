@@ -1,4 +1,4 @@
 """Business logic"""
 # flake8: noqa
 
-from derive.api.main import single, quantiles
+from derive.api.main import single, quantiles, merge, index
@@ -18,19 +18,185 @@ __status__ = "Production"
 __version__ = "$Revision$"
 # $Source$
 
+import hashlib
+import itertools
 import numpy as np
 from netCDF4 import Dataset
-from derive.api import configs
+from derive.api import configs, multiimpact, temporal
 
 deltamethod_vcv = None
 
+read_strategies = ["whole", "slab", "region"]
+whole_read_fraction = 0.5  # read whole variables once this share of chunks is used
+default_chunk_cache = 64 * 1024 * 1024  # upper bound on each variable's cache
+readstats = {"decompressed": 0, "used": 0}  # bytes, across all reads
+
+layouts = {}  # { axis signature => BundleLayout }
+
+
+class BundleLayout(object):
+    """The year and region axes shared by the bundles of a projection run
+
+    The regions are decoded, and their index map built, once per layout
+    rather than once per file. Selections of regions and years are
+    memoized on the configuration that produced them.
+    """
+
+    def __init__(self, years, regions):
+        self.years = years
+        self.regions = regions
+        self.regionorder = list(regions)
+        self.regionindex = {region: ii for ii, region in enumerate(self.regionorder)}
+        self.selections = {}  # { (regions_key, years_key) => Selection }
+
+    def select(self, config):
+        key = (regions_key(config), years_key(config))
+        if key not in self.selections:
+            if key[0] is None:
+                regionindices = None
+            elif key[0][0] == "chunk":
+                regionindices = np.arange(
+                    key[0][1][0], min(key[0][1][1], len(self.regionorder))
+                )
+            else:
+                targets = configs.get_regions(config, self.regionorder)
+                regionindices = np.flatnonzero(np.isin(self.regions, targets))
+
+            if key[1] is None:
+                yearindices = None
+            elif key[1][0] == "yearsets":
+                yearmask = np.zeros(len(self.years), dtype=bool)
+                for yearset in key[1][1]:
+                    yearmask |= (self.years >= yearset[0]) & (self.years < yearset[1])
+                yearindices = np.flatnonzero(yearmask)
+            else:
+                yearindices = np.flatnonzero(np.isin(self.years, key[1][1]))
+
+            self.selections[key] = Selection(self, regionindices, yearindices)
+
+        return self.selections[key]
+
+
+class Selection(object):
+    """The regions and years of a layout extracted for a configuration"""
+
+    def __init__(self, layout, regionindices, yearindices):
+        self.layout = layout
+        self.regionindices = regionindices  # None for all regions
+        self.yearindices = yearindices  # None for all years
+        if regionindices is None:
+            self.regions = layout.regions
+            self.regionorder = layout.regionorder
+            self.regionindex = layout.regionindex
+        else:
+            self.regions = layout.regions[regionindices]
+            self.regionorder = list(self.regions)
+            self.regionindex = {
+                region: ii for ii, region in enumerate(self.regionorder)
+            }
+        if yearindices is None:
+            self.years = layout.years
+        else:
+            self.years = layout.years[yearindices]
+        self.targets = None
+
+    def target_regions(self, config):
+        """Return the requested regions and their positions in the selection.
+
+        The positions are None if the requested regions are exactly the
+        selected ones, in order, so no indexing is needed.
+        """
+        if self.targets is None:
+            names = list(configs.get_regions(config, self.regionorder))
+            positions = np.array([self.regionindex[name] for name in names], dtype=int)
+            if np.array_equal(positions, np.arange(len(self.regionorder))):
+                positions = None
+            self.targets = (names, positions)
+
+        return self.targets
+
+
+def regions_key(config):
+    """Hashable description of the regions a configuration asks for."""
+    if config is None:
+        return None
+    if configs.is_allregions(config):
+        if config.get("region-chunk", None) is not None:
+            # A [start, stop) slice of all regions, see main.quantiles_by_chunk
+            return ("chunk", tuple(config["region-chunk"]))
+        return None
+    if "region" in config:
+        return ("region", config["region"])
+
+    regions = config.get("regions", None)
+    return ("regions", tuple(regions) if regions is not None else None)
+
+
+def years_key(config):
+    """Hashable description of the years a configuration needs read."""
+    if config is None:
+        return None
+    if config.get("yearsets", False):
+        return ("yearsets", tuple(configs.get_yearsets(config)))
+
+    if "year" in config:
+        years = [config["year"]]
+    elif config.get("years", None) is not None:
+        years = config["years"]
+    else:
+        return None
+
+    # Running reductions need the years leading up to those reported
+    if config.get("rolling-window", None):
+        return (
+            "yearsets",
+            ((min(years) - config["rolling-window"] + 1, max(years) + 1),),
+        )
+    if config.get("cumulative", False):
+        return ("yearsets", ((-np.inf, max(years) + 1),))
+
+    return ("years", tuple(years))
+
+
+def get_layout(rootgrp, filepath):
+    """Return the cached layout for an open bundle.
+
+    Layouts are keyed on the years and a digest of every region name,
+    so bundles share a layout only if their axes are the same; the
+    region index map and selections are built once per layout.
+    """
+    years = rootgrp.variables["year"][:]
+    regions = rootgrp.variables["regions"][:]
+
+    # Costs files can have bad regions; take them from the sibling .nc4
+    if (
+        filepath[-10:] == "-costs.nc4"
+        and len(regions) > 0
+        and not isinstance(regions[0], str)
+        and np.isnan(regions[0])
+    ):
+        siblingpath = filepath.replace("-costs.nc4", ".nc4")
+        regionsgrp = Dataset(siblingpath, "r", format="NETCDF4")
+        layout = get_layout(regionsgrp, siblingpath)
+        regionsgrp.close()
+        return layout
+
+    digest = hashlib.sha1("\0".join(map(str, regions)).encode("utf-8")).hexdigest()
+    signature = (len(regions), years.tobytes(), digest)
+    if signature not in layouts:
+        layouts[signature] = BundleLayout(years, regions)
+
+    return layouts[signature]
+
 
 def read_region(config, *args, **kwargs):
     """Snip-out target regions from nc4 file
 
-    Quick and dirty hax to reduce the size of data read in from netCDF files.
-    Keeps a memory leak in the module from blowing up the script. Not
-    the best way to handle this.
+    Looks up the indices of the target regions in the file's `regions`
+    variable before touching the data, and then reads only those
+    columns, so a short `regions` list decompresses kilobytes rather
+    than the whole array. This also keeps a memory leak in the netCDF
+    module from blowing up the script.
 
     Parameters
     ----------
@@ -47,21 +213,51 @@ def read_region(config, *args, **kwargs):
     regions : array-like
     data : array-like
     """
-    years, regions, data = read(*args, **kwargs)
+    kwargs["config"] = config
+    return read(*args, **kwargs)
 
-    if configs.is_allregions(config):
-        regions_msk = np.ones(regions.shape, dtype="bool")
-    else:
-        target_regions = configs.get_regions(config, regions)
-        regions_msk = np.isin(regions, target_regions)
 
-    return years, regions[regions_msk], data[..., regions_msk]
+def read(filepath, column="rebased", deltamethod=False, config=None):
+    """If deltamethod is True, treat as a deltamethod file.
 
+    If config is given, only its target regions are read, in file order.
+    """
+    bundle = read_bundle(filepath, [column], deltamethod, config)
+    use_deltamethod_vcv(bundle.vcv)
 
-def read(filepath, column="rebased", deltamethod=False):
-    """If deltamethod is True, treat as a deltamethod file."""
-    global deltamethod_vcv
+    return bundle.years, bundle.regions, bundle.columns[column]
+
+
+class Bundle(object):
+    """Columns read from one impact bundle, for a selection of regions"""
+
+    def __init__(self, selection, columns, vcv=None):
+        self.selection = selection
+        self.years = selection.years
+        self.regions = selection.regions
+        self.columns = columns  # { column => data }
+        self.vcv = vcv  # only for deltamethod files
 
+    @property
+    def nbytes(self):
+        """Bytes held by the data read for this bundle."""
+        total = sum(np.asarray(data).nbytes for data in self.columns.values())
+        if self.vcv is not None:
+            total += np.asarray(self.vcv).nbytes
+        return total
+
+
+def read_bundle(filepath, columns, deltamethod=False, config=None):
+    """Read all of the given columns, opening the file only once.
+
+    If deltamethod is True, the `_bcde` coefficient columns and the
+    VCV are read; if it is None, this is inferred from the file. If
+    config is given, only its target regions are read.
+
+    Returns
+    -------
+    Bundle
+    """
     try:
         rootgrp = Dataset(filepath, "r", format="NETCDF4")
     except Exception as ex:
@@ -73,189 +269,418 @@ def read(filepath, column="rebased", deltamethod=False):
         print("Error: Cannot read %s" % filepath)
         exit()
 
-    years = rootgrp.variables["year"][:]
-    regions = rootgrp.variables["regions"][:]
+    selection = get_layout(rootgrp, filepath).select(config)
 
     if deltamethod is None:
         # Infer from the file
         deltamethod = "vcv" in rootgrp.variables
 
+    data = {}
     if deltamethod:
-        data = rootgrp.variables[column + "_bcde"][:, :, :]
-        if deltamethod_vcv is None:
-            deltamethod_vcv = rootgrp.variables["vcv"][:, :]
-        else:
-            assert np.all(deltamethod_vcv == rootgrp.variables["vcv"][:, :])
+        for column in columns:
+            data[column] = read_indices(
+                rootgrp.variables[column + "_bcde"],
+                (selection.yearindices, selection.regionindices),
+                config,
+            )
+        vcv = rootgrp.variables["vcv"][:, :]
     else:
-        data = rootgrp.variables[column][:, :]
+        for column in columns:
+            data[column] = read_indices(
+                rootgrp.variables[column],
+                (selection.yearindices, selection.regionindices),
+                config,
+            )
+        vcv = None
 
     rootgrp.close()
 
-    # Correct bad regions in costs
-    if (
-        filepath[-10:] == "-costs.nc4"
-        and not isinstance(regions[0], str)
-        and not isinstance(regions[0], str)
-        and np.isnan(regions[0])
-    ):
-        rootgrp = Dataset(filepath.replace("-costs.nc4", ".nc4"), "r", format="NETCDF4")
-        regions = rootgrp.variables["regions"][:]
-        rootgrp.close()
+    return Bundle(selection, data, vcv)
+
+
+def read_bundle_columns(filepath, columns, config={}):
+    """Read a bundle once for all of the `columns` requested from it.
+
+    The columns are given as in iterate_regions; the returned bundle
+    can be passed on to iterate_regions for each of them.
+    """
+    needed = []
+    for column in columns:
+        if bundle_column(filepath, column) not in needed:
+            needed.append(bundle_column(filepath, column))
+
+    return read_bundle(filepath, needed, iterate_deltamethod(config), config)
+
+
+def bundle_column(filepath, column):
+    """The variable to read for a requested column (None for the default)."""
+    if column is not None:
+        return column
+    if "costs" in filepath:
+        return "costs_ub"
+    return "rebased"
 
-    return years, regions, data
 
+def iterate_deltamethod(config):
+    """The deltamethod argument for read_bundle under a configuration."""
+    if configs.is_parallel_deltamethod(config):
+        return False
+    return config.get("deltamethod", None)
 
-def iterate_regions(filepath, column, config={}):
+
+def use_deltamethod_vcv(vcv):
+    """Record the VCV of a deltamethod file, checking it is consistent."""
     global deltamethod_vcv
 
-    do_deltamethod = (
-        False
-        if configs.is_parallel_deltamethod(config)
-        else config.get("deltamethod", None)
-    )
-    if column is not None or "costs" not in filepath:
-        years, regions, data = read_region(
-            config,
-            filepath,
-            column if column is not None else "rebased",
-            do_deltamethod,
-        )
+    if vcv is None:
+        return
+    if deltamethod_vcv is None:
+        deltamethod_vcv = vcv
     else:
-        years, regions, data1 = read_region(
-            config, filepath, "costs_lb", do_deltamethod
-        )
-        years, regions, data2 = read_region(
-            config, filepath, "costs_ub", do_deltamethod
+        assert np.all(deltamethod_vcv == vcv)
+
+
+def coalesce_indices(indices):
+    """Group sorted indices into the fewest contiguous slices."""
+    if len(indices) == 0:
+        return []
+
+    breaks = np.flatnonzero(np.diff(indices) != 1) + 1
+    starts = np.concatenate(([0], breaks))
+    ends = np.concatenate((breaks, [len(indices)]))
+
+    return [
+        slice(int(indices[start]), int(indices[end - 1]) + 1)
+        for start, end in zip(starts, ends)
+    ]
+
+
+def read_indices(variable, indices, config=None):
+    """Read a netCDF variable, keeping only `indices` along its last axes.
+
+    Parameters
+    ----------
+    variable : netCDF4.Variable
+    indices : sequence of array-like or None
+        Sorted indices to keep along each of the trailing axes of the
+        variable; None keeps the whole axis.
+    config : dict, optional
+        Passed on to ReadPlan.
+    """
+    return ReadPlan(variable, indices, config).read(variable)
+
+
+class ReadPlan(object):
+    """Plan for reading a selection from a chunked, compressed variable
+
+    Chooses between reading the whole variable and subsetting in
+    memory (`whole`), reading chunk-aligned slabs around the selection
+    (`slab`), and reading each contiguous run of the selection on its
+    own (`region`), based on the variable's chunking and the share of
+    its chunks the selection touches. The chunk cache is sized to
+    match, so that chunks shared between runs are only decompressed
+    once.
+
+    Config options: read-strategy (auto, whole, slab, or region),
+    chunk-cache (upper bound on the cache size, in bytes)
+    """
+
+    def __init__(self, variable, indices, config=None):
+        if config is None:
+            config = {}
+
+        shape = tuple(variable.shape)
+        self.indices = [None] * (len(shape) - len(indices)) + list(indices)
+        self.shape = tuple(
+            shape[axis] if self.indices[axis] is None else len(self.indices[axis])
+            for axis in range(len(shape))
         )
-        data = data2 / 1e5
 
-    if deltamethod_vcv is not None and not config.get("deltamethod", False):
-        # Inferred that these were deltamethod files
-        config["deltamethod"] = True
+        chunking = variable.chunking()
+        self.contiguous = chunking == "contiguous"
+        chunks = shape if self.contiguous else tuple(chunking)
+        filters = variable.filters() or {}
+        self.compressed = any(
+            filters.get(name, False)
+            for name in ["zlib", "szip", "zstd", "bzip2", "blosc"]
+        )
 
-    if config.get("multiimpact_vcv", None) is not None and deltamethod_vcv is not None:
-        assert isinstance(config["multiimpact_vcv"], np.ndarray)
-        # Extend data to conform to multiimpact_vcv
-        foundindex = None
-        for ii in range(
-            config["multiimpact_vcv"].shape[0] - deltamethod_vcv.shape[0] + 1
-        ):
-            if np.allclose(
-                deltamethod_vcv,
-                config["multiimpact_vcv"][
-                    ii : (ii + deltamethod_vcv.shape[0]),
-                    ii : (ii + deltamethod_vcv.shape[1]),
-                ],
-            ):
-                foundindex = ii
-                break
-        if foundindex is None:
-            print(
-                np.sum(
-                    np.abs(
-                        deltamethod_vcv
-                        - config["multiimpact_vcv"][
-                            : deltamethod_vcv.shape[0], : deltamethod_vcv.shape[1]
-                        ]
+        itemsize = variable.dtype.itemsize
+        self.chunkbytes = int(np.prod(chunks)) * itemsize
+        self.used = int(np.prod(self.shape)) * itemsize
+
+        # Count the chunks, and the elements within them, that the
+        # selection touches along each axis
+        self.chunkranges = []
+        numchunks = 1
+        numtouched = 1
+        touchedbytes = itemsize
+        allbytes = itemsize
+        for axis in range(len(shape)):
+            chunkstarts = np.arange(0, shape[axis], chunks[axis])
+            if self.indices[axis] is None:
+                touched = np.arange(len(chunkstarts))
+            else:
+                touched = np.unique(np.asarray(self.indices[axis]) // chunks[axis])
+            self.chunkranges.append(
+                [
+                    slice(
+                        int(chunkrange.start * chunks[axis]),
+                        int(min(chunkrange.stop * chunks[axis], shape[axis])),
                     )
-                )
+                    for chunkrange in coalesce_indices(touched)
+                ]
             )
-            print(
-                np.sum(
-                    np.abs(
-                        deltamethod_vcv
-                        - config["multiimpact_vcv"][
-                            deltamethod_vcv.shape[0] :, deltamethod_vcv.shape[1] :
-                        ]
-                    )
-                )
+            numchunks *= len(chunkstarts)
+            numtouched *= len(touched)
+            touchedbytes *= int(
+                np.sum(np.minimum(chunks[axis], shape[axis] - touched * chunks[axis]))
             )
-        assert foundindex is not None, (
-            "Cannot find the VCV for " + filepath + " within the master VCV."
+            allbytes *= shape[axis]
+
+        self.strategy = config.get("read-strategy", "auto")
+        if self.strategy == "auto":
+            self.strategy = self.choose_strategy(numtouched, numchunks)
+        assert self.strategy in read_strategies, (
+            "Unknown read-strategy " + self.strategy
         )
-        newdata = np.zeros(
-            tuple([config["multiimpact_vcv"].shape[0]] + list(data.shape[1:]))
+
+        if self.contiguous:
+            self.decompressed = allbytes if self.strategy == "whole" else self.used
+            self.cachesize = None
+        elif self.strategy == "whole":
+            self.decompressed = allbytes
+            self.cachesize = self.chunkbytes
+        else:
+            self.decompressed = touchedbytes
+            if self.strategy == "slab":
+                # Every chunk is read whole, exactly once
+                self.cachesize = self.chunkbytes
+            else:
+                # Runs can share chunks, so keep all touched chunks around
+                self.cachesize = numtouched * self.chunkbytes
+
+        if self.cachesize is not None:
+            self.cachesize = min(
+                self.cachesize, config.get("chunk-cache", default_chunk_cache)
+            )
+
+    def choose_strategy(self, numtouched, numchunks):
+        if all(indices is None for indices in self.indices):
+            return "whole"
+        if self.contiguous:
+            return "region"
+        if numtouched >= whole_read_fraction * numchunks:
+            return "whole"
+
+        numruns = np.prod(
+            [
+                1 if indices is None else len(coalesce_indices(indices))
+                for indices in self.indices
+            ]
         )
-        if len(data.shape) == 2:
-            newdata[foundindex : (foundindex + deltamethod_vcv.shape[0]), :] = data
+        numslabs = np.prod([len(chunkranges) for chunkranges in self.chunkranges])
+        if numruns > numslabs:
+            return "slab"
+        return "region"
+
+    def pieces(self, axis):
+        """List the (read slice, local indices, output slice) for an axis."""
+        indices = self.indices[axis]
+        if indices is None:
+            return [(slice(None), None, slice(None))]
+        if self.strategy == "whole":
+            return [(slice(None), indices, slice(None))]
+
+        if self.strategy == "region":
+            readslices = coalesce_indices(indices)
         else:
-            newdata[foundindex : (foundindex + deltamethod_vcv.shape[0]), :, :] = data
-        data = newdata
+            readslices = self.chunkranges[axis]
+
+        pieces = []
+        for readslice in readslices:
+            first, last = np.searchsorted(indices, [readslice.start, readslice.stop])
+            local = np.asarray(indices[first:last]) - readslice.start
+            if len(local) == readslice.stop - readslice.start:
+                local = None  # whole slice is used
+            pieces.append((readslice, local, slice(int(first), int(last))))
+
+        return pieces
+
+    def read(self, variable):
+        if self.cachesize is not None:
+            variable.set_var_chunk_cache(
+                size=self.cachesize,
+                nelems=max(1009, 4 * (self.cachesize // self.chunkbytes) + 1),
+                preemption=0.0 if self.strategy == "region" else 1.0,
+            )
+
+        readstats["decompressed"] += self.decompressed
+        readstats["used"] += self.used
+
+        allpieces = [self.pieces(axis) for axis in range(len(self.shape))]
+        if all(len(pieces) == 1 for pieces in allpieces):
+            data = variable[tuple(pieces[0][0] for pieces in allpieces)]
+            for axis in range(len(self.shape)):
+                if allpieces[axis][0][1] is not None:
+                    data = data.take(allpieces[axis][0][1], axis=axis)
+            return data
+
+        data = np.ma.masked_array(
+            np.empty(self.shape, dtype=variable.dtype),
+            mask=np.zeros(self.shape, dtype=bool),
+        )
+        for combination in itertools.product(*allpieces):
+            block = variable[tuple(piece[0] for piece in combination)]
+            for axis in range(len(self.shape)):
+                if combination[axis][1] is not None:
+                    block = block.take(combination[axis][1], axis=axis)
+            data[tuple(piece[2] for piece in combination)] = block
+
+        return data
+
+
+def report_readstats():
+    """Print how much data was decompressed for each byte actually used."""
+    if readstats["used"] == 0:
+        return
+
+    print(
+        "Read %.1f MB of data, decompressing %.2f bytes per byte used."
+        % (
+            readstats["used"] / 1e6,
+            readstats["decompressed"] / float(readstats["used"]),
+        )
+    )
+
 
+def iterate_regions(filepath, column, config={}, bundle=None):
+    """Yield (region, years, values) for the target regions of a column.
+
+    If bundle is given (see read_bundle_columns), its already-read data
+    is used instead of opening the file again.
+    """
+    global deltamethod_vcv
+
+    if bundle is None:
+        bundle = read_bundle_columns(filepath, [column], config)
+    use_deltamethod_vcv(bundle.vcv)
+
+    data = bundle.columns[bundle_column(filepath, column)]
+    if column is None and "costs" in filepath:
+        data = data / 1e5
+    selection = bundle.selection
+    years = selection.years
+
+    if deltamethod_vcv is not None and not config.get("deltamethod", False):
+        # Inferred that these were deltamethod files
+        config["deltamethod"] = True
+
+    if config.get("multiimpact_vcv", None) is not None and deltamethod_vcv is not None:
+        # Keep this file's coefficients as its block of the master VCV
+        offset = config["multiimpact_vcv"].find_block(deltamethod_vcv, filepath)
         deltamethod_vcv = None  # reset for next file
+    else:
+        offset = None
 
-    config["regionorder"] = list(regions)
+    config["regionorder"] = selection.regionorder
 
     if configs.is_allregions(config):
-        yield "all", years, data
+        yield "all", years, as_block(data, offset)
         return
 
-    regions = list(regions)
-    for region in configs.get_regions(config, regions):
-        ii = regions.index(region)
-        if config.get("deltamethod", False) and not configs.is_parallel_deltamethod(
-            config
-        ):
-            yield regions[ii], years, data[:, :, ii]
-        else:
-            yield regions[ii], years, data[:, ii]
+    # Take all requested regions at once; then yield views of them
+    names, positions = selection.target_regions(config)
+    if positions is not None:
+        data = data[..., positions]
+    for ii in range(len(names)):
+        yield names[ii], years, as_block(data[..., ii], offset)
+
+
+def as_block(values, offset):
+    """Wrap coefficients as a block of the multi-impact VCV, if any."""
+    if offset is None:
+        return values
+    return multiimpact.BlockCoefficients({offset: values})
 
 
 def iterate_values(years, values, config={}):
     """
-    Config options: yearsets, years
+    Config options: yearsets, years, rolling-window, cumulative,
+    discount-rate, discount-year
     """
 
+    if isinstance(values, multiimpact.BlockCoefficients):
+        # All reductions are linear, so apply them to each block
+        offsets = list(values.blocks.keys())
+        for results in zip(
+            *[
+                iterate_values(years, values.blocks[offset], config)
+                for offset in offsets
+            ]
+        ):
+            yield results[0][0], multiimpact.BlockCoefficients(
+                {offsets[ii]: results[ii][1] for ii in range(len(offsets))}
+            )
+        return
+
+    if config.get("deltamethod", False) and not configs.is_parallel_deltamethod(config):
+        yearaxis = 1
+    else:
+        yearaxis = 0
+
     if "yearsets" in config and config["yearsets"]:
-        yearsets = config["yearsets"]
-        if yearsets:
-            yearsets = [(2000, 2019), (2020, 2039), (2040, 2059), (2080, 2099)]
-
-        for yearset in yearsets:
-            if isinstance(yearset, list):
-                yearset = tuple(yearset)
-            if config.get("deltamethod", False):
-                if values.ndim == 1:
-                    yield "%d-%d" % yearset, np.mean(
-                        values[
-                            :, np.logical_and(years >= yearset[0], years < yearset[1])
-                        ],
-                        axis=1,
-                    )
-                else:  # multiple regions included
-                    yield "%d-%d" % yearset, np.mean(
-                        values[
-                            :,
-                            np.logical_and(years >= yearset[0], years < yearset[1]),
-                            :,
-                        ],
-                        axis=1,
-                    )
-            else:
-                if values.ndim == 1:
-                    yield "%d-%d" % yearset, np.mean(
-                        values[np.logical_and(years >= yearset[0], years < yearset[1])]
-                    )
-                else:  # multiple regions included
-                    yield "%d-%d" % yearset, np.mean(
-                        values[
-                            np.logical_and(years >= yearset[0], years < yearset[1]), :
-                        ],
-                        axis=0,
-                    )
+        yearsets = configs.get_yearsets(config)
+        means = temporal.yearset_means(years, values, yearsets, yearaxis)
+        for ii in range(len(yearsets)):
+            yield "%d-%d" % yearsets[ii], np.take(means, ii, axis=yearaxis)
         return
 
-    years = list(years)
-    for year in configs.get_years(config, years):
-        if config.get("deltamethod", False) and not configs.is_parallel_deltamethod(
-            config
-        ):
-            if values.ndim == 2:
-                yield year, values[:, years.index(year)]
-            else:
-                yield year, values[:, years.index(year), :]
-        else:
-            if values.ndim == 1:
-                yield year, values[years.index(year)]
-            else:
-                yield year, values[years.index(year), :]
+    if config.get("rolling-window", None):
+        years, values = temporal.rolling_means(
+            years, values, config["rolling-window"], yearaxis
+        )
+    elif config.get("cumulative", False):
+        values = temporal.cumulative_sums(
+            years,
+            values,
+            yearaxis,
+            config.get("discount-rate", 0),
+            config.get("discount-year", None),
+        )
+
+    yearlist, yearindex = get_yearindex(years)
+    targetyears = configs.get_years(config, yearlist)
+    if config.get("rolling-window", None):
+        # Years without a complete window are dropped
+        targetyears = [year for year in targetyears if year in yearindex]
+    positions = [yearindex[year] for year in targetyears]
+
+    # Take all requested years at once; then yield views of them
+    if config.get("deltamethod", False) and not configs.is_parallel_deltamethod(config):
+        if positions != list(range(len(yearlist))):
+            values = values[:, positions]
+        for ii in range(len(targetyears)):
+            yield targetyears[ii], values[:, ii]
+    else:
+        if positions != list(range(len(yearlist))):
+            values = values[positions]
+        for ii in range(len(targetyears)):
+            yield targetyears[ii], values[ii]
+
+
+yearindexes = {}  # { years signature => (year list, { year => index }) }
+
+
+def get_yearindex(years):
+    """Return the years as a list, and a map from each year to its index."""
+    years = np.asarray(years)
+    signature = (years.dtype.str, years.tobytes())
+    if signature not in yearindexes:
+        yearlist = list(years)
+        yearindexes[signature] = (
+            yearlist,
+            {year: ii for ii, year in enumerate(yearlist)},
+        )
+
+    return yearindexes[signature]
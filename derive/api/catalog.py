@@ -0,0 +1,171 @@
+"""A persistent catalog of the directories and files in a results tree
+
+The catalog is a SQLite database holding the listing of every directory
+down to the target directories, along with the sizes and modification
+times of the files in them. It is built and refreshed by `derive index`;
+a refresh only re-lists directories whose modification time has
+changed. With the `catalog` option, results.scan_subdirs and
+results.list_directory answer from the catalog rather than the
+filesystem.
+
+A file rewritten in place does not change its directory's modification
+time, so such changes are only seen when the directory is re-listed.
+"""
+
+import os
+import sqlite3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS directories (
+    path TEXT PRIMARY KEY,
+    mtime REAL
+);
+CREATE TABLE IF NOT EXISTS entries (
+    parent TEXT,
+    position INTEGER,
+    name TEXT,
+    isdir INTEGER,
+    size INTEGER,
+    mtime REAL,
+    PRIMARY KEY (parent, position)
+);
+"""
+
+# Directories below the results root: batch, rcp, gcm, iam, ssp
+default_levels = 5
+
+
+class Catalog(object):
+    """A catalog of directory listings, stored at path
+
+    Parameters
+    ----------
+    path : str
+        The SQLite database file; it is created if it does not exist.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.pid = None
+        self.connection = None
+
+    def connect(self):
+        # SQLite connections cannot be shared with forked worker processes
+        if self.pid != os.getpid():
+            self.connection = sqlite3.connect(self.path)
+            self.connection.executescript(SCHEMA)
+            self.pid = os.getpid()
+
+        return self.connection
+
+    def listing(self, path):
+        """[(name, isdir)] for a cataloged directory, or None if not cataloged.
+
+        Entries are in the order the directory was listed in.
+        """
+        connection = self.connect()
+        path = os.path.normpath(path)
+        if (
+            connection.execute(
+                "SELECT 1 FROM directories WHERE path = ?", (path,)
+            ).fetchone()
+            is None
+        ):
+            return None
+
+        return [
+            (name, bool(isdir))
+            for name, isdir in connection.execute(
+                "SELECT name, isdir FROM entries WHERE parent = ? ORDER BY position",
+                (path,),
+            )
+        ]
+
+    def files(self, path):
+        """{name => (size, mtime)} for the files in a cataloged directory.
+
+        Returns None if the directory is not cataloged.
+        """
+        if self.listing(path) is None:
+            return None
+
+        return {
+            name: (size, mtime)
+            for name, size, mtime in self.connect().execute(
+                "SELECT name, size, mtime FROM entries WHERE parent = ? AND isdir = 0",
+                (os.path.normpath(path),),
+            )
+        }
+
+    def refresh(self, root, levels=default_levels):
+        """Bring the catalog of root up to date.
+
+        Every directory down to `levels` below root (by default, the
+        target directories) is checked, but only those modified since
+        they were last cataloged are listed again.
+
+        Returns
+        -------
+        counts : dict
+            The number of directories `listed` and `unchanged`.
+        """
+        connection = self.connect()
+        counts = {"listed": 0, "unchanged": 0}
+        with connection:
+            self.refresh_directory(connection, os.path.normpath(root), levels, counts)
+
+        return counts
+
+    def refresh_directory(self, connection, path, levels, counts):
+        mtime = os.stat(path).st_mtime
+        row = connection.execute(
+            "SELECT mtime FROM directories WHERE path = ?", (path,)
+        ).fetchone()
+
+        if row is not None and row[0] == mtime:
+            counts["unchanged"] += 1
+            subdirs = [name for name, isdir in self.listing(path) if isdir]
+        else:
+            counts["listed"] += 1
+            entries = []  # [(name, isdir, size, mtime)]
+            with os.scandir(path) as scanned:
+                for entry in scanned:
+                    if entry.is_dir():
+                        entries.append((entry.name, 1, None, None))
+                    else:
+                        stat = entry.stat()
+                        entries.append((entry.name, 0, stat.st_size, stat.st_mtime))
+
+            # Forget any subtrees that have gone
+            subdirs = [name for name, isdir, size, entrymtime in entries if isdir]
+            if row is not None:
+                for name, isdir in self.listing(path):
+                    if isdir and name not in subdirs:
+                        self.forget(connection, os.path.join(path, name))
+
+            connection.execute("DELETE FROM entries WHERE parent = ?", (path,))
+            connection.executemany(
+                "INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+                [(path, ii) + entries[ii] for ii in range(len(entries))],
+            )
+            connection.execute(
+                "INSERT OR REPLACE INTO directories VALUES (?, ?)", (path, mtime)
+            )
+
+        if levels > 0:
+            for subdir in subdirs:
+                self.refresh_directory(
+                    connection, os.path.join(path, subdir), levels - 1, counts
+                )
+
+    def forget(self, connection, path):
+        """Remove a directory and everything below it from the catalog."""
+        prefix = path + os.sep
+        connection.execute(
+            "DELETE FROM directories WHERE path = ? OR substr(path, 1, ?) = ?",
+            (path, len(prefix), prefix),
+        )
+        connection.execute(
+            "DELETE FROM entries WHERE parent = ? OR substr(parent, 1, ?) = ?",
+            (path, len(prefix), prefix),
+        )
@@ -8,7 +8,7 @@ import yaml
 import csv
 import warnings
 import numpy as np
-from derive.api import results
+from derive.api import multiimpact, results, outputs
 
 
 def consume_config():
@@ -53,12 +53,10 @@ def read_config(filename):
 
 def handle_multiimpact_vcv(config):
     if "multiimpact_vcv" in config and config["multiimpact_vcv"] is not None:
-        multiimpact_vcv = []
-        with open(config["multiimpact_vcv"], "r") as fp:
-            reader = csv.reader(fp)
-            for row in reader:
-                multiimpact_vcv.append(list(map(float, row)))
-        config["multiimpact_vcv"] = np.array(multiimpact_vcv)
+        if not isinstance(config["multiimpact_vcv"], multiimpact.MultiImpactVCV):
+            config["multiimpact_vcv"] = multiimpact.MultiImpactVCV.load(
+                config["multiimpact_vcv"]
+            )
     else:
         config["multiimpact_vcv"] = None
 
@@ -78,22 +76,31 @@ def iterate_valid_targets(root, config, impacts=None, verbose=True):
     allmodels = (
         config["only-models"] if config.get("only-models", "all") != "all" else None
     )
+    results.use_catalog(config)
+
+    # Prune the crawl to the requested rcp, gcm, iam and ssp
+    filters = [
+        [do_rcp_only] if do_rcp_only else None,
+        allmodels,
+        [do_iam_only] if do_iam_only else None,
+        [do_ssp_only] if do_ssp_only else None,
+    ]
 
     if dirtree == "climate-only":
 
         def get_iterator():
-            for alldirs in results.recurse_directories(root, 2):
+            for alldirs in results.recurse_directories(root, 2, filters[:2]):
                 yield ["pest", alldirs[0], alldirs[1], "NA", "NA", alldirs[2]]
 
         iterator = get_iterator()
     elif do_targetsubdirs:
         iterator = results.iterate_targetdirs(root, do_targetsubdirs)
     elif do_montecarlo == "both":
-        iterator = results.iterate_both(root)
+        iterator = results.iterate_both(root, filters)
     elif do_montecarlo:
-        iterator = results.iterate_montecarlo(root)
+        iterator = results.iterate_montecarlo(root, filters=filters)
     else:
-        iterator = results.iterate_batch(root, do_batchdir)
+        iterator = results.iterate_batch(root, do_batchdir, filters)
         # Logic for a given directory
         # if root[-1] == '/':
         #    root = root[0:-1]
@@ -150,7 +157,9 @@ def iterate_valid_targets(root, config, impacts=None, verbose=True):
         else:
             # Check that at least one of the impacts is here
             for impact in impacts:
-                if impact + ".nc4" in os.listdir(multipath(targetdir, impact)):
+                if impact + ".nc4" in results.list_directory(
+                    multipath(targetdir, impact)
+                ):
                     if is_parallel_deltamethod(config):
                         if isinstance(targetdir, dict):
                             dmpath = os.path.join(
@@ -205,11 +214,11 @@ def interpret_filenames(argv, config):
         if basename[0] == "-":
             basename = basename[1:]
             assert basename, "Error: Cannot interpret a single dash."
-            transforms.append(lambda x: -x)
-            vectransforms.append(lambda x: -x)
+            transforms.append(negate)
+            vectransforms.append(negate)
         else:
-            transforms.append(lambda x: x)
-            vectransforms.append(lambda x: x)
+            transforms.append(identity)
+            vectransforms.append(identity)
         if ":" in basename:
             columns.append(basename.split(":")[1])
             basename = basename.split(":")[0]
@@ -224,6 +233,15 @@ def interpret_filenames(argv, config):
     return columns, basenames, transforms, vectransforms
 
 
+# Module-level, so they can be passed to worker processes
+def identity(x):
+    return x
+
+
+def negate(x):
+    return -x
+
+
 # Plural handling
 
 
@@ -277,6 +295,18 @@ def get_years(config, years):
     return config.get("years", years)
 
 
+default_yearsets = [(2000, 2019), (2020, 2039), (2040, 2059), (2080, 2099)]
+
+
+def get_yearsets(config):
+    """Return the (start, end) yearsets to average over; end is exclusive."""
+    yearsets = config.get("yearsets", False)
+    if yearsets is True:
+        return default_yearsets
+
+    return [tuple(yearset) for yearset in yearsets]
+
+
 # CSV Creation
 
 
@@ -302,13 +332,16 @@ def csv_makepath(filestuff, config):
 
     outdir = config["output-dir"]
 
-    if not os.path.exists(outdir):
-        os.makedirs(outdir)
+    # Output workers may get here together
+    os.makedirs(outdir, exist_ok=True)
 
     suffix = config.get("suffix", "")
     suffix = suffix.format(**config)
 
-    return os.path.join(outdir, "-".join(list(filestuff)) + suffix + ".csv")
+    return os.path.join(
+        outdir,
+        "-".join(list(filestuff)) + suffix + outputs.extension(config),
+    )
 
 
 def csv_rownames(config):
@@ -0,0 +1,225 @@
+"""Dense storage of values across the members of an ensemble
+
+The values collected from a results tree are organized by output file
+(filestuff), row within the file (rowstuff) and ensemble member
+(batch, gcm, iam). Rather than nesting dictionaries down to every
+value, each output file's values are kept in one array with axes
+(member, row, ...), where any further axes are those of the values
+themselves (e.g., regions, or deltamethod coefficients). Members and
+rows are indexed in the order they are first seen.
+"""
+
+import numpy as np
+from derive.api import multiimpact
+
+
+class EnsembleStore(object):
+    """The values for every output file: { filestuff => FileGroup }"""
+
+    def __init__(self):
+        self.groups = {}
+
+    def set(self, filestuff, rowstuff, member, value):
+        if filestuff not in self.groups:
+            self.groups[filestuff] = FileGroup()
+        self.groups[filestuff].set(rowstuff, member, value)
+
+    def __contains__(self, filestuff):
+        return filestuff in self.groups
+
+    def __getitem__(self, filestuff):
+        return self.groups[filestuff]
+
+    def __iter__(self):
+        return iter(self.groups)
+
+    def __len__(self):
+        return len(self.groups)
+
+    def keys(self):
+        return self.groups.keys()
+
+
+class FileGroup(object):
+    """The values for one output file, as a (member, row, ...) array
+
+    Cells that have not been set are absent. Each cell records when it
+    was first set, so that the members of a row are returned in the
+    order they were added to it.
+
+    Values that cannot be stacked (BlockCoefficients, or values of
+    differing shapes) are kept in an object array instead.
+    """
+
+    def __init__(self):
+        self.members = []
+        self.memberindex = {}
+        self.rows = []
+        self.rowindex = {}
+        self.values = None  # (member capacity, row capacity, ...) array
+        self.sequence = np.full((0, 0), -1, dtype=np.int64)  # -1 if absent
+        self.count = 0  # cells set so far
+
+    def keys(self):
+        return list(self.rows)
+
+    def __contains__(self, rowstuff):
+        return rowstuff in self.rowindex
+
+    def __iter__(self):
+        return iter(list(self.rows))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def is_dense(self):
+        return self.values is None or self.values.dtype != object
+
+    def set(self, rowstuff, member, value):
+        """Set the value of a member for a row."""
+        mm = self.index(self.members, self.memberindex, member)
+        rr = self.index(self.rows, self.rowindex, rowstuff)
+        if np.ma.isMaskedArray(value):
+            value = value.filled(np.nan)
+
+        if self.values is None:
+            if isinstance(value, multiimpact.BlockCoefficients):
+                self.values = np.empty((0, 0), dtype=object)
+            else:
+                self.values = np.full(
+                    (0, 0) + np.shape(value), np.nan, dtype=value_dtype(value)
+                )
+        elif self.is_dense() and (
+            isinstance(value, multiimpact.BlockCoefficients)
+            or np.shape(value) != self.values.shape[2:]
+        ):
+            self.to_objects()
+        elif self.is_dense():
+            # Widen (e.g., to float64) rather than round later values
+            dtype = np.result_type(self.values.dtype, value_dtype(value))
+            if dtype != self.values.dtype:
+                self.values = self.values.astype(dtype)
+        self.reserve(len(self.members), len(self.rows))
+
+        self.values[mm, rr] = value
+        if self.sequence[mm, rr] < 0:
+            self.sequence[mm, rr] = self.count
+            self.count += 1
+
+    def row(self, rowstuff):
+        """The members present in a row, and their values.
+
+        Returns
+        -------
+        members : list of (batch, gcm, iam)
+        values : array-like
+            Stacked as (member, ...) if dense; otherwise a list.
+        """
+        rr = self.rowindex[rowstuff]
+        order = self.row_order(rr)
+        members = [self.members[mm] for mm in order]
+        if self.is_dense():
+            return members, self.values[order, rr]
+        return members, list(self.values[order, rr])
+
+    def member_order(self, rowstuff):
+        """Indexes into members of those present in a row, in order added."""
+        return self.row_order(self.rowindex[rowstuff])
+
+    def get(self, rowstuff, members):
+        """The values for the given members of a row, stacked."""
+        rr = self.rowindex[rowstuff]
+        order = [self.memberindex[member] for member in members]
+        assert np.all(self.sequence[order, rr] >= 0), "Member missing from row."
+        if self.is_dense():
+            return self.values[order, rr]
+        return list(self.values[order, rr])
+
+    def __getitem__(self, rowstuff):
+        """{ member => value } for a row."""
+        members, values = self.row(rowstuff)
+        return {members[ii]: values[ii] for ii in range(len(members))}
+
+    def row_order(self, rr):
+        present = np.flatnonzero(self.sequence[: len(self.members), rr] >= 0)
+        return present[np.argsort(self.sequence[present, rr], kind="stable")]
+
+    def present(self):
+        """(member, row) mask of the values that have been set."""
+        return self.sequence[: len(self.members), : len(self.rows)] >= 0
+
+    def with_values(self, values):
+        """A FileGroup with the same members and rows, and new values.
+
+        values has axes (member, row, ...) over this group's members and
+        rows.
+        """
+        group = FileGroup()
+        group.members = self.members
+        group.memberindex = self.memberindex
+        group.rows = self.rows
+        group.rowindex = self.rowindex
+        group.values = values
+        group.sequence = self.sequence[: len(self.members), : len(self.rows)]
+        group.count = self.count
+        return group
+
+    def subset(self, rowstuffs):
+        """A FileGroup with the same members, and only the given rows."""
+        rrs = [self.rowindex[rowstuff] for rowstuff in rowstuffs]
+        group = FileGroup()
+        group.members = self.members
+        group.memberindex = self.memberindex
+        group.rows = list(rowstuffs)
+        group.rowindex = {rowstuff: rr for rr, rowstuff in enumerate(group.rows)}
+        group.values = self.values[: len(self.members), rrs]
+        group.sequence = self.sequence[: len(self.members), rrs]
+        group.count = self.count
+        return group
+
+    @staticmethod
+    def index(keys, keyindex, key):
+        if key not in keyindex:
+            keyindex[key] = len(keys)
+            keys.append(key)
+        return keyindex[key]
+
+    def reserve(self, nummembers, numrows):
+        """Grow the arrays, doubling, to hold at least these many cells."""
+        capacity = self.sequence.shape
+        if nummembers <= capacity[0] and numrows <= capacity[1]:
+            return
+
+        newcapacity = (
+            (
+                capacity[0]
+                if nummembers <= capacity[0]
+                else max(nummembers, 2 * capacity[0])
+            ),
+            capacity[1] if numrows <= capacity[1] else max(numrows, 2 * capacity[1]),
+        )
+        sequence = np.full(newcapacity, -1, dtype=np.int64)
+        sequence[: capacity[0], : capacity[1]] = self.sequence
+        self.sequence = sequence
+
+        if self.is_dense():
+            values = np.full(
+                newcapacity + self.values.shape[2:], np.nan, dtype=self.values.dtype
+            )
+        else:
+            values = np.empty(newcapacity, dtype=object)
+        values[: capacity[0], : capacity[1]] = self.values
+        self.values = values
+
+    def to_objects(self):
+        """Switch to holding each value as a separate object."""
+        values = np.empty(self.sequence.shape, dtype=object)
+        for mm, rr in zip(*np.nonzero(self.sequence >= 0)):
+            values[mm, rr] = np.array(self.values[mm, rr])
+        self.values = values
+
+
+def value_dtype(value):
+    """The float type to keep a value in: its own (e.g., float32 values
+    from float32 bundles), or float64 for other numbers."""
+    return np.result_type(np.asarray(value).dtype, np.float32)
@@ -0,0 +1,209 @@
+"""Incremental runs, reusing the values of unchanged target directories
+
+With the `incremental` option, the values summed from each target
+directory are saved in a state directory, along with a fingerprint of
+the files they were read from (path, size and modification time). On
+the next run with the same configuration, target directories whose
+fingerprint is unchanged are not read again.
+
+Each output file is also recorded with a digest of the configuration
+and of the fingerprints of every target directory contributing to it;
+output files whose digest is unchanged are not computed or written
+again.
+"""
+
+import os
+import json
+import pickle
+import hashlib
+from derive.api import bundles, multiimpact
+
+# Options that do not change the values read from a target directory
+reading_options = [
+    "incremental",
+    "catalog",
+    "verbose",
+    "read-strategy",
+    "chunk-cache",
+    "workers",
+    "worker-tasks",
+    "worker-memory",
+    "prefetch",
+    "prefetch-memory",
+    "regionorder",
+    "max-memory",
+    "scratch-dir",
+    "output-workers",
+    "output-block-rows",
+    "shard",
+    "shard-dir",
+]
+
+# Options that only change how the values are combined or written
+output_options = [
+    "output-dir",
+    "output-file",
+    "suffix",
+    "evalqvals",
+    "do-gcmweights",
+    "ignore-missing",
+    "distribution",
+    "sketch-error",
+]
+
+sources = {}  # { filestuff => [target fingerprint] }, for the current run
+vcvdigests = {}  # { id(MultiImpactVCV) => digest }
+
+
+def config_digest(config, exclude):
+    """A digest of the configuration, leaving out the options in exclude."""
+    items = []
+    for key in sorted(config.keys()):
+        if key in exclude:
+            continue
+        value = config[key]
+        if key == "deltamethod" and value is True:
+            continue  # Set once inferred from the files, so same as missing
+        if isinstance(value, multiimpact.MultiImpactVCV):
+            if id(value) not in vcvdigests:
+                vcvdigests[id(value)] = hashlib.sha1(value.vcv.tobytes()).hexdigest()
+            value = vcvdigests[id(value)]
+        items.append((key, value))
+
+    return hashlib.sha1(repr(items).encode("utf-8")).hexdigest()
+
+
+def files_fingerprint(fullpaths):
+    """A digest of the path, size and modification time of each file."""
+    stats = []
+    for fullpath in sorted(set(fullpaths)):
+        stat = os.stat(fullpath)
+        stats.append((fullpath, stat.st_size, stat.st_mtime_ns))
+
+    return hashlib.sha1(repr(stats).encode("utf-8")).hexdigest()
+
+
+class TargetState(object):
+    """The cached values for one target directory
+
+    Parameters
+    ----------
+    path : str
+        Where the values are cached.
+    fingerprint : str
+        The fingerprint of the target's files now.
+    entry : dict or None
+        The cached values, if they were saved from the same files.
+    """
+
+    def __init__(self, path, fingerprint, entry):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.entry = entry
+
+    @staticmethod
+    def lookup(target, fullpaths, basenames, columns, config, transforms):
+        """The TargetState of a target, or None if not running incrementally."""
+        if not config.get("incremental", None):
+            return None
+
+        key = repr(
+            (
+                target[-1],
+                basenames,
+                columns,
+                [transform.__name__ for transform in transforms],
+                config_digest(config, reading_options + output_options),
+            )
+        )
+        path = os.path.join(
+            config["incremental"],
+            "targets",
+            hashlib.sha1(key.encode("utf-8")).hexdigest() + ".pkl",
+        )
+        fingerprint = files_fingerprint(fullpaths)
+
+        entry = None
+        if os.path.exists(path):
+            with open(path, "rb") as fp:
+                entry = pickle.load(fp)
+            if entry["fingerprint"] != fingerprint:
+                entry = None
+
+        return TargetState(path, fingerprint, entry)
+
+    def restore(self, config):
+        """Return the cached values, restoring the state set in reading them."""
+        if self.entry["regionorder"] is not None:
+            config["regionorder"] = self.entry["regionorder"]
+        if self.entry["deltamethod"] is True:
+            config["deltamethod"] = True
+        if config.get("multiimpact_vcv", None) is None:
+            bundles.use_deltamethod_vcv(self.entry["deltamethod_vcv"])
+
+        return (
+            self.entry["contributions"],
+            self.entry["observations"],
+            self.entry["years"],
+            self.fingerprint,
+        )
+
+    def save(self, config, contributions, observations, years):
+        entry = {
+            "fingerprint": self.fingerprint,
+            "contributions": contributions,
+            "observations": observations,
+            "years": years,
+            "regionorder": config.get("regionorder", None),
+            "deltamethod": config.get("deltamethod", None),
+            "deltamethod_vcv": bundles.deltamethod_vcv,
+        }
+
+        # Write and rename, so concurrent workers never see a partial file
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + ".%d" % os.getpid(), "wb") as fp:
+            pickle.dump(entry, fp, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(self.path + ".%d" % os.getpid(), self.path)
+
+
+def add_source(filestuff, fingerprint):
+    """Record that a target directory contributed to an output file."""
+    if filestuff not in sources:
+        sources[filestuff] = []
+    sources[filestuff].append(fingerprint)
+
+
+def group_digest(filestuff, config):
+    """A digest of everything that goes into an output file."""
+    return hashlib.sha1(
+        repr(
+            (
+                filestuff,
+                config_digest(config, reading_options),
+                sorted(sources.get(filestuff, [])),
+            )
+        ).encode("utf-8")
+    ).hexdigest()
+
+
+def load_groups(config):
+    """{ output path => digest } for the files written incrementally."""
+    path = os.path.join(config["incremental"], "groups.json")
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as fp:
+        return json.load(fp)
+
+
+def is_current(groups, outpath, digest):
+    """Is the output file already written from the same inputs?"""
+    return groups.get(outpath, None) == digest and os.path.exists(outpath)
+
+
+def record_group(config, groups, outpath, digest):
+    groups[outpath] = digest
+    path = os.path.join(config["incremental"], "groups.json")
+    os.makedirs(config["incremental"], exist_ok=True)
+    with open(path + ".tmp", "w") as fp:
+        json.dump(groups, fp, indent=1, sort_keys=True)
+    os.replace(path + ".tmp", path)
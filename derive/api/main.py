@@ -5,9 +5,29 @@ Main API entry points
 import sys
 import csv
 import copy
+import tempfile
+import concurrent.futures
 import numpy as np
 
-from derive.api import bundles, results, weights, weights_vcv, configs
+from derive.api import (
+    bundles,
+    ensemble,
+    results,
+    weights,
+    weights_vcv,
+    configs,
+    outputs,
+    catalog,
+    incremental,
+    sketches,
+    shards,
+)
+
+# Bytes of working memory per byte of values read, when computing quantiles
+chunk_memory_factor = 4
+
+# Rows of an output file computed together, with output-workers
+default_block_rows = 1000
 
 
 def single(argv, config):
@@ -18,9 +38,20 @@ def single(argv, config):
 
     data = {}  # {region => { year => value }}
 
+    filebundles = {}  # { filepath => Bundle }, each file read once
     for ii in range(len(basenames)):
+        if basenames[ii] not in filebundles:
+            filebundles[basenames[ii]] = bundles.read_bundle_columns(
+                basenames[ii],
+                [
+                    columns[jj]
+                    for jj in range(len(basenames))
+                    if basenames[jj] == basenames[ii]
+                ],
+                config,
+            )
         for region, years, values in bundles.iterate_regions(
-            basenames[ii], columns[ii], config
+            basenames[ii], columns[ii], config, filebundles[basenames[ii]]
         ):
             if region not in data:
                 data[region] = {}
@@ -33,37 +64,32 @@ def single(argv, config):
                 if year not in data[region]:
                     data[region][year] = value
                 else:
-                    data[region][year] += value
+                    # Not in place: the first may view a shared bundle
+                    data[region][year] = data[region][year] + value
 
     writer = csv.writer(sys.stdout)
     writer.writerow(["region", "year", "value"])
 
     for region in data:
+        years = list(data[region].keys())
+        values = [data[region][year] for year in years]
+        if config.get("deltamethod", False):
+            values = results.deltamethod_variances(values, config)
+
         if region == "all":
             for rr in range(len(config["regionorder"])):
-                for year in data[region]:
-                    if bundles.deltamethod_vcv is not None:
-                        value = bundles.deltamethod_vcv.dot(
-                            data[region][year][:, rr]
-                        ).dot(data[region][year][:, rr])
-                    else:
-                        value = data[region][year][rr]
-                    writer.writerow([config["regionorder"][rr], year, value])
-        else:
-            for year in data[region]:
-                if bundles.deltamethod_vcv is not None:
-                    value = bundles.deltamethod_vcv.dot(data[region][year]).dot(
-                        data[region][year]
+                for ii in range(len(years)):
+                    writer.writerow(
+                        [config["regionorder"][rr], years[ii], values[ii][rr]]
                     )
-                else:
-                    value = data[region][year][rr]
-                writer.writerow([region, year, value])
+        else:
+            for ii in range(len(years)):
+                writer.writerow([region, years[ii], values[ii]])
 
 
 def quantiles(argv, config):
     configs.handle_multiimpact_vcv(config)
 
-    do_gcmweights = config.get("do-gcmweights", True)
     evalqvals = config.get("evalqvals", ["mean", 0.17, 0.5, 0.83])
     output_format = config.get("output-format", "edfcsv")
 
@@ -71,187 +97,633 @@ def quantiles(argv, config):
         argv, config
     )
 
+    if sketches.is_sketch(config):
+        assert outputs.table_kind(output_format) == "edf" and not config.get(
+            "deltamethod", False
+        ), "Error: distribution: sketch only produces edf output, without deltamethod."
+
+    if (
+        config.get("max-memory", None)
+        and not sketches.is_sketch(config)
+        and not shards.is_sharded(config)
+        and configs.is_allregions(config)
+        and outputs.table_kind(output_format) == "edf"
+    ):
+        quantiles_by_chunk(
+            config, evalqvals, columns, basenames, transforms, vectransforms
+        )
+        return
+
     # Collect all available results
+    incremental.sources.clear()
+    data, years, parallel_deltamethod_data = collect_data(
+        config, columns, basenames, transforms, vectransforms
+    )
+
+    if shards.is_sharded(config):
+        shards.write_partial(argv, config, data, years, parallel_deltamethod_data)
+        return
+
+    write_outputs(data, years, parallel_deltamethod_data, evalqvals, config)
+
+
+def merge(argv, config):
+    """Combine the partial results of every shard, and write the output files.
+
+    The values of each target directory are added in the same order as
+    they would be by a single run, so the output files are the same.
+    """
+    configs.handle_multiimpact_vcv(config)
+    evalqvals = config.get("evalqvals", ["mean", 0.17, 0.5, 0.83])
+
+    partials = shards.read_partials(argv, config)
+    for partial in partials:
+        results.merge_worker_state(config, partial["state"])
+
+    if isinstance(partials[0]["data"], sketches.SketchStore):
+        assert sketches.is_sketch(
+            config
+        ), "Error: The shards were run with distribution: sketch."
+        data = partials[0]["data"]
+        for partial in partials[1:]:
+            data.merge(partial["data"])
+        years = partials[-1]["years"]
+        parallel_deltamethod_data = None
+    else:
+        assert not sketches.is_sketch(
+            config
+        ), "Error: The shards were not run with distribution: sketch."
+        data = ensemble.EnsembleStore()
+        years = []
+        for position, member, contributions, targetyears in shards.merged_targets(
+            [partial["data"] for partial in partials]
+        ):
+            results.add_contributions(data, member, contributions)
+            if targetyears is not None:
+                years = targetyears
+
+        parallel_deltamethod_data = None
+        if configs.is_parallel_deltamethod(config):
+            parallel_deltamethod_data = ensemble.EnsembleStore()
+            for position, member, contributions, targetyears in shards.merged_targets(
+                [partial["parallel_deltamethod_data"] for partial in partials]
+            ):
+                results.add_contributions(
+                    parallel_deltamethod_data, member, contributions
+                )
+
+    # Every file is written, as the sources of each are not known here
+    write_outputs(
+        data,
+        years,
+        parallel_deltamethod_data,
+        evalqvals,
+        dict(config, incremental=None),
+    )
+
+
+def write_outputs(data, years, parallel_deltamethod_data, evalqvals, config):
+    """Compute the quantiles (or values) of each output file, and write it.
+
+    With `output-workers`, the files are computed and written in a pool
+    of processes.
+    """
+    if config.get("incremental", None):
+        groups = incremental.load_groups(config)
+
+    outputworkers = config.get("output-workers", 1)
+    if outputworkers > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(outputworkers)
+        blockrows = config.get("output-block-rows", default_block_rows)
+    pending = []  # [(filestuff, digest, future, block futures)], if in workers
+
+    for filestuff in data:
+        digest = None
+        if config.get("incremental", None):
+            digest = incremental.group_digest(filestuff, config)
+            if incremental.is_current(
+                groups, configs.csv_makepath(filestuff, config), digest
+            ):
+                print("Unchanged file: " + str(filestuff))
+                continue
+
+        print("Creating file: " + str(filestuff))
+
+        if sketches.is_sketch(config):
+            filedata, filevariances = data[filestuff], None
+        else:
+            filegroups = file_groups(filestuff, data, parallel_deltamethod_data, config)
+            if filegroups is None:
+                continue
+            filedata, filevariances = filegroups
+        rowstuffs = configs.csv_sorted(list(filedata.keys()), config)
+
+        if outputworkers <= 1:
+            write_group(
+                filestuff, filedata, filevariances, rowstuffs, years, evalqvals, config
+            )
+            if config.get("incremental", None):
+                incremental.record_group(
+                    config, groups, configs.csv_makepath(filestuff, config), digest
+                )
+        elif len(rowstuffs) <= blockrows:
+            # The whole file, written by a worker
+            future = executor.submit(
+                write_group,
+                filestuff,
+                filedata,
+                filevariances,
+                rowstuffs,
+                years,
+                evalqvals,
+                config,
+            )
+            pending.append((filestuff, digest, future, None))
+        else:
+            # Blocks of rows, computed by the workers and written here
+            futures = [
+                executor.submit(
+                    block_columns,
+                    filestuff,
+                    subset_rows(filedata, rowstuffs[start : start + blockrows]),
+                    subset_rows(filevariances, rowstuffs[start : start + blockrows]),
+                    rowstuffs[start : start + blockrows],
+                    years,
+                    evalqvals,
+                    config,
+                )
+                for start in range(0, len(rowstuffs), blockrows)
+            ]
+            pending.append((filestuff, digest, None, futures))
+
+    # Finish each file in turn, as the workers complete them
+    for filestuff, digest, future, futures in pending:
+        if future is not None:
+            future.result()
+        else:
+            with outputs.open_writer(
+                configs.csv_makepath(filestuff, config), config
+            ) as writer:
+                writer.writeheader(output_header(evalqvals, config))
+                for blockfuture in futures:
+                    for columns in blockfuture.result():
+                        writer.writecolumns(columns)
+
+        if config.get("incremental", None):
+            incremental.record_group(
+                config, groups, configs.csv_makepath(filestuff, config), digest
+            )
+
+    if outputworkers > 1:
+        executor.shutdown()
+
+
+def write_group(
+    filestuff, filedata, filevariances, rowstuffs, years, evalqvals, config
+):
+    """Compute the rows of an output file, and write it."""
+    with outputs.open_writer(configs.csv_makepath(filestuff, config), config) as writer:
+        writer.writeheader(output_header(evalqvals, config))
+        for columns in group_columns(
+            filestuff, filedata, filevariances, rowstuffs, years, evalqvals, config
+        ):
+            writer.writecolumns(columns)
+
+
+def block_columns(
+    filestuff, filedata, filevariances, rowstuffs, years, evalqvals, config
+):
+    """group_columns for a block of rows, as a list."""
+    return list(
+        group_columns(
+            filestuff, filedata, filevariances, rowstuffs, years, evalqvals, config
+        )
+    )
+
+
+def subset_rows(filedata, rowstuffs):
+    """The part of a file's values (FileGroup or sketches) for some rows."""
+    if filedata is None:
+        return None
+    if isinstance(filedata, dict):
+        return {rowstuff: filedata[rowstuff] for rowstuff in rowstuffs}
+    return filedata.subset(rowstuffs)
+
+
+def output_header(evalqvals, config):
+    rownames = configs.csv_rownames(config)
+    if outputs.table_kind(config.get("output-format", "edfcsv")) == "edf":
+        return edf_header(rownames, evalqvals)
+    return rownames + ["batch", "gcm", "iam", "value", "weight"]
+
+
+def group_columns(
+    filestuff, filedata, filevariances, rowstuffs, years, evalqvals, config
+):
+    """Yield the columns of the output rows for rowstuffs, in blocks.
+
+    Each block is a list of columns, to be written in turn by
+    writecolumns. Rows without values are left out.
+    """
+    if sketches.is_sketch(config):
+        for columns in sketch_columns(filedata, rowstuffs, evalqvals, config):
+            yield columns
+        return
+
+    output_format = config.get("output-format", "edfcsv")
+    rownames = configs.csv_rownames(config)
+    encoded_evalqvals = encode_evalqvals(evalqvals, config)
+
+    # Rows whose quantiles are computed together, once all are known
+    pendingrows = []
+    pendingvalues = []
+    pendingweights = []
+    pendingvariances = []  # only used for parallel deltamethod
+
+    filegcmweights = {}  # { rcp => weight of each of filedata.members }
+
+    for rowstuff in rowstuffs:
+        print("Outputing row: " + str(rowstuff))
+        rcp = configs.csv_organized_rcp(filestuff, rowstuff, config)
+        if rcp not in filegcmweights:
+            filegcmweights[rcp] = weights.member_weights(filedata.members, rcp, config)
+
+        # Whole slices of the ensemble, in the order members were added
+        members, allvalues = filedata.row(rowstuff)
+        if filevariances is not None:
+            allvariances = filevariances.get(rowstuff, members)
+        else:
+            allvariances = None
+        allweights = filegcmweights[rcp][filedata.member_order(rowstuff)]
+
+        # print filestuff, rowstuff, allvalues
+        if len(allvalues) == 0:
+            continue
+
+        if outputs.table_kind(output_format) == "edf":
+            if configs.is_allregions(config):
+                assert "all" in rowstuff
+                # All regions at once
+                quantiles = allregions_quantiles(
+                    allvalues,
+                    allvariances,
+                    allweights,
+                    encoded_evalqvals,
+                    config,
+                )
+                columns = [[field] * len(quantiles) for field in rowstuff]
+                columns[rownames.index("region")] = config["regionorder"][
+                    : len(quantiles)
+                ]
+                yield columns + list(quantiles.T)
+            else:
+                pendingrows.append(rowstuff)
+                pendingvalues.append(allvalues)
+                pendingweights.append(allweights)
+                if allvariances is not None:
+                    pendingvariances.append(allvariances)
+        elif outputs.table_kind(output_format) == "values":
+            yield values_columns(
+                rowstuff,
+                rownames,
+                members,
+                allvalues,
+                allweights,
+                years,
+                config,
+            )
+
+    if pendingrows and configs.is_parallel_deltamethod(config):
+        allquantiles = weights_vcv.mixture_quantiles_rows(
+            pendingvalues,
+            pendingvariances,
+            pendingweights,
+            encoded_evalqvals,
+            config.get("gmcdf-tolerance", weights_vcv.default_tolerance),
+        )
+    elif pendingrows:
+        allquantiles = weights.weighted_quantiles_rows(
+            pendingvalues,
+            pendingweights,
+            encoded_evalqvals,
+            ignore_missing=config.get("ignore-missing", False),
+        )
+    if pendingrows:
+        yield [list(column) for column in zip(*pendingrows)] + list(
+            np.array(allquantiles).T
+        )
+
+
+def collect_data(config, columns, basenames, transforms, vectransforms):
+    """Sum the values of all target directories, as main.quantiles uses them.
+
+    Returns
+    -------
+    data : EnsembleStore
+    years : list
+    parallel_deltamethod_data : EnsembleStore, or None unless doing a
+        parallel deltamethod run
+    """
     data, years = results.sum_into_data(
         config["results-root"], basenames, columns, config, transforms, vectransforms
     )
+    if not configs.is_parallel_deltamethod(config):
+        return data, years, None
+
+    # corresponds to each value in data, if doing parallel deltamethod
+    config2 = copy.copy(config)
+    config2["deltamethod"] = True
+    parallel_deltamethod_data, parallel_deltamethod_years = results.sum_into_data(
+        config["deltamethod"],
+        basenames,
+        columns,
+        config2,
+        transforms,
+        vectransforms,
+    )
+    return data, years, parallel_deltamethod_data
+
+
+def file_groups(filestuff, data, parallel_deltamethod_data, config):
+    """The values for an output file, and their variances if any.
+
+    Returns
+    -------
+    (filedata, filevariances), with filevariances None unless doing a
+    parallel deltamethod run; or None if the file should be skipped.
+    """
+    if (
+        configs.is_parallel_deltamethod(config)
+        and filestuff not in parallel_deltamethod_data
+    ):
+        print(
+            str(filestuff)
+            + " is not in delta method output. Skipping model specification..."
+        )
+        return None
+
+    # Compute all delta-method variances for this file together
+    if config.get("deltamethod", False) and not configs.is_parallel_deltamethod(config):
+        filedata = results.deltamethod_group(data[filestuff], config)
+    else:
+        filedata = data[filestuff]
+    if configs.is_parallel_deltamethod(config):
+        filevariances = results.deltamethod_group(
+            parallel_deltamethod_data[filestuff], config
+        )
+    else:
+        filevariances = None
+
+    return filedata, filevariances
+
+
+def edf_header(rownames, evalqvals):
+    return rownames + [
+        q if isinstance(q, str) else "q" + str(int(q * 100)) for q in evalqvals
+    ]
+
+
+def encode_evalqvals(evalqvals, config):
+    if configs.is_parallel_deltamethod(config):
+        return weights_vcv.WeightedGMCDF.encode_evalqvals(evalqvals)
+    return weights.WeightedECDF.encode_evalqvals(evalqvals)
+
+
+def allregions_quantiles(
+    allvalues, allvariances, allweights, encoded_evalqvals, config
+):
+    """The quantiles of every region of one row, as (region, quantile)."""
+    if allvariances is None:
+        return weights.weighted_quantiles(
+            allvalues,
+            allweights,
+            encoded_evalqvals,
+            ignore_missing=config.get("ignore-missing", False),
+        )
+
+    return weights_vcv.mixture_quantiles(
+        allvalues,
+        allvariances,
+        allweights,
+        encoded_evalqvals,
+        config.get("gmcdf-tolerance", weights_vcv.default_tolerance),
+    )
+
+
+def sketch_columns(filesketches, rowstuffs, evalqvals, config):
+    """Yield the columns of the quantiles of each row's sketch, in blocks.
+
+    The largest rank error of any of the quantiles is reported.
+    """
+    rownames = configs.csv_rownames(config)
+    encoded_evalqvals = encode_evalqvals(evalqvals, config)
+    errorbound = 0
+
+    pendingrows = []
+    pendingquantiles = []
+    for rowstuff in rowstuffs:
+        print("Outputing row: " + str(rowstuff))
+        quantiles, errorbounds = filesketches[rowstuff].quantiles(encoded_evalqvals)
+        errorbound = max(errorbound, np.max(errorbounds, initial=0))
+        if configs.is_allregions(config):
+            assert "all" in rowstuff
+            columns = [[field] * len(quantiles) for field in rowstuff]
+            columns[rownames.index("region")] = config["regionorder"][: len(quantiles)]
+            yield columns + list(quantiles.T)
+        else:
+            pendingrows.append(rowstuff)
+            pendingquantiles.append(quantiles)
+
+    if pendingrows:
+        yield [list(column) for column in zip(*pendingrows)] + list(
+            np.array(pendingquantiles).T
+        )
+    print("Quantile rank error bound: %g" % errorbound)
+
+
+def quantiles_by_chunk(
+    config, evalqvals, columns, basenames, transforms, vectransforms
+):
+    """Compute quantiles for all regions, reading a chunk of regions at a time.
+
+    The region axis is split into chunks small enough that the values
+    of every member for one chunk fit within `max-memory`. Each chunk
+    is read (only its slab of regions), summed and reduced to quantiles
+    before the next one is read. The quantiles are kept in a
+    memory-mapped scratch file until every chunk is done, and then
+    written in the same order as main.quantiles writes them. A row is
+    written with only the regions it had values for; regions and rows
+    missing from a chunk are left out rather than filled.
+    """
+    numregions, regionbytes = results.region_footprint(
+        config["results-root"], basenames, columns, config
+    )
     if configs.is_parallel_deltamethod(config):
-        # corresponds to each value in data, if doing parallel deltamethod
         config2 = copy.copy(config)
         config2["deltamethod"] = True
-        parallel_deltamethod_data, parallel_deltamethod_years = results.sum_into_data(
-            config["deltamethod"],
-            basenames,
-            columns,
-            config2,
-            transforms,
-            vectransforms,
+        regionbytes += results.region_footprint(
+            config["deltamethod"], basenames, columns, config2
+        )[1]
+    chunksize = max(
+        1, int(config["max-memory"] // (chunk_memory_factor * max(regionbytes, 1)))
+    )
+    print(
+        "Reading %d regions in chunks of %d." % (numregions, min(chunksize, numregions))
+    )
+
+    encoded_evalqvals = encode_evalqvals(evalqvals, config)
+    rownames = configs.csv_rownames(config)
+    scratchdir = config.get("scratch-dir", None)
+    scratch = {}  # { filestuff => [(regions, rowindex, memmap, file)] }, by chunk
+    regionorder = []
+
+    for start in range(0, max(numregions, 1), chunksize):
+        chunkconfig = copy.copy(config)
+        chunkconfig["region-chunk"] = [start, start + chunksize]
+        data, years, parallel_deltamethod_data = collect_data(
+            chunkconfig, columns, basenames, transforms, vectransforms
         )
+        chunkregions = list(chunkconfig.get("regionorder", []))
 
-    for filestuff in data:
-        print("Creating file: " + str(filestuff))
+        for filestuff in data:
+            filegroups = file_groups(
+                filestuff, data, parallel_deltamethod_data, chunkconfig
+            )
+            if filegroups is None or len(filegroups[0]) == 0 or not chunkregions:
+                continue
+            filedata, filevariances = filegroups
 
-        if (
-            configs.is_parallel_deltamethod(config)
-            and filestuff not in parallel_deltamethod_data
-        ):
-            print(
-                str(filestuff)
-                + " is not in delta method output. Skipping model specification..."
+            # Removed once closed
+            fp = tempfile.TemporaryFile(dir=scratchdir)
+            filequantiles = np.memmap(
+                fp,
+                dtype=float,
+                mode="w+",
+                shape=(len(filedata), len(chunkregions), len(evalqvals)),
             )
-            continue
+            rowindex = {}  # { rowstuff => (row, regions) }, if it has values
 
-        with open(configs.csv_makepath(filestuff, config), "w") as fp:
-            writer = csv.writer(fp, quoting=csv.QUOTE_MINIMAL)
-            rownames = configs.csv_rownames(config)
-
-            if output_format == "edfcsv":
-                writer.writerow(
-                    rownames
-                    + [
-                        q if isinstance(q, str) else "q" + str(int(q * 100))
-                        for q in evalqvals
-                    ]
-                )
-                if configs.is_parallel_deltamethod(config):
-                    encoded_evalqvals = weights_vcv.WeightedGMCDF.encode_evalqvals(
-                        evalqvals
-                    )
-                else:
-                    encoded_evalqvals = weights.WeightedECDF.encode_evalqvals(evalqvals)
-            elif output_format == "valuescsv":
-                writer.writerow(rownames + ["batch", "gcm", "iam", "value", "weight"])
-
-            for rowstuff in configs.csv_sorted(list(data[filestuff].keys()), config):
-                print("Outputing row: " + str(rowstuff))
-                if do_gcmweights:
-                    model_weights = weights.get_weights(
-                        configs.csv_organized_rcp(filestuff, rowstuff, config)
+            filegcmweights = {}  # { rcp => weight of each of filedata.members }
+            for rowstuff in filedata.keys():
+                rcp = configs.csv_organized_rcp(filestuff, rowstuff, chunkconfig)
+                if rcp not in filegcmweights:
+                    filegcmweights[rcp] = weights.member_weights(
+                        filedata.members, rcp, chunkconfig
                     )
 
-                allvalues = []
-                allvariances = []  # only used for parallel deltamethod
-                allweights = []
-                allmontevales = []
-
-                for batch, gcm, iam in data[filestuff][rowstuff]:
-                    value = data[filestuff][rowstuff][(batch, gcm, iam)]
-                    if config.get("deltamethod", False):
-                        value = results.deltamethod_variance(value, config)
-
-                    if do_gcmweights:
-                        try:
-                            weight = model_weights[gcm.lower()]
-                        except Exception as ex:
-                            import traceback  # CATBELL
-
-                            print(
-                                "".join(
-                                    traceback.format_exception(
-                                        ex.__class__, ex, ex.__traceback__
-                                    )
-                                )
-                            )  # CATBELL
-                            print(
-                                "Warning: No weight available for %s, so dropping."
-                                % gcm
-                            )
-                            weight = 0.0
-                    else:
-                        weight = 1.0
-
-                    allvalues.append(value)
-                    allweights.append(weight)
-                    allmontevales.append([batch, gcm, iam])
-
-                    if configs.is_parallel_deltamethod(config):
-                        allvariances.append(
-                            results.deltamethod_variance(
-                                parallel_deltamethod_data[filestuff][rowstuff][
-                                    (batch, gcm, iam)
-                                ],
-                                config,
-                            )
-                        )
-
-                # print filestuff, rowstuff, allvalues
+                members, allvalues = filedata.row(rowstuff)
                 if len(allvalues) == 0:
                     continue
+                if filevariances is not None:
+                    allvariances = filevariances.get(rowstuff, members)
+                else:
+                    allvariances = None
+                allweights = filegcmweights[rcp][filedata.member_order(rowstuff)]
+
+                quantiles = allregions_quantiles(
+                    allvalues, allvariances, allweights, encoded_evalqvals, chunkconfig
+                )
+                if len(quantiles) == 0:
+                    continue
+                filequantiles[len(rowindex), : len(quantiles)] = quantiles
+                rowindex[rowstuff] = (len(rowindex), len(quantiles))
+
+            scratch.setdefault(filestuff, []).append(
+                (chunkregions, rowindex, filequantiles, fp)
+            )
+
+        regionorder.extend(chunkregions)
+        del data, parallel_deltamethod_data
+
+    # Rows have only the regions for which some chunk had values
+    config["regionorder"] = regionorder
+    for filestuff in scratch:
+        print("Creating file: " + str(filestuff))
+        chunks = scratch[filestuff]
+        rowstuffs = {}  # ordered, as first seen
+        for chunkregions, rowindex, filequantiles, fp in chunks:
+            rowstuffs.update(dict.fromkeys(rowindex))
+
+        with outputs.open_writer(
+            configs.csv_makepath(filestuff, config), config
+        ) as writer:
+            writer.writeheader(edf_header(rownames, evalqvals))
+            for rowstuff in configs.csv_sorted(list(rowstuffs), config):
+                rowregions = []
+                rowquantiles = []
+                for chunkregions, rowindex, filequantiles, fp in chunks:
+                    if rowstuff in rowindex:
+                        row, count = rowindex[rowstuff]
+                        rowregions.extend(chunkregions[:count])
+                        rowquantiles.append(filequantiles[row, :count])
+
+                columns = [[field] * len(rowregions) for field in rowstuff]
+                columns[rownames.index("region")] = rowregions
+                writer.writecolumns(columns + list(np.concatenate(rowquantiles).T))
+
+        for chunkregions, rowindex, filequantiles, fp in chunks:
+            fp.close()
+
+
+def index(config):
+    """Build, or bring up to date, the catalog of the results tree."""
+    assert config.get(
+        "catalog", None
+    ), "Error: The catalog option must give the path of the catalog."
+    dircatalog = catalog.Catalog(config["catalog"])
+
+    roots = [config["results-root"]]
+    if configs.is_parallel_deltamethod(config):
+        roots.append(config["deltamethod"])
+
+    for root in roots:
+        for path in root.values() if isinstance(root, dict) else [root]:
+            counts = dircatalog.refresh(path)
+            print(
+                "Indexed %s: %d directories listed, %d unchanged."
+                % (path, counts["listed"], counts["unchanged"])
+            )
+
+
+def values_columns(rowstuff, rownames, members, allvalues, allweights, years, config):
+    """The columns of the valuescsv rows for one row of the ensemble.
+
+    Each member's value may be a single value, or a value for each
+    region (or, with the regions organized into files, for each year).
+
+    Returns
+    -------
+    list of columns: those of rowstuff, then batch, gcm, iam, value, weight
+    """
+    if len(allvalues) > 0 and not isinstance(allvalues[0], (list, np.ndarray)):
+        memberindex = np.arange(len(members))
+        columns = [
+            outputs.Factor([field], np.zeros(len(members), int)) for field in rowstuff
+        ]
+        values = np.asarray(allvalues)
+    else:
+        if "region" in config.get("file-organize", []) and "year" not in config.get(
+            "file-organize", []
+        ):
+            axisname, labels = "year", years  # still set from before
+            counts = [min(len(values), len(years)) for values in allvalues]
+        else:
+            axisname, labels = "region", config["regionorder"]
+            counts = [len(values) for values in allvalues]
+
+        memberindex = np.repeat(np.arange(len(members)), counts)
+        labelindex = np.concatenate([np.arange(count) for count in counts])
+        columns = [
+            outputs.Factor([field], np.zeros(len(memberindex), int))
+            for field in rowstuff
+        ]
+        columns[rownames.index(axisname)] = outputs.Factor(labels, labelindex)
+        if isinstance(allvalues, np.ndarray) and allvalues.dtype != object:
+            values = allvalues[memberindex, labelindex]
+        else:
+            values = [allvalues[ii][jj] for ii, jj in zip(memberindex, labelindex)]
+
+    for kk in range(3):
+        columns.append(outputs.Factor([member[kk] for member in members], memberindex))
 
-                if output_format == "edfcsv":
-                    if configs.is_allregions(config):
-                        assert "all" in rowstuff
-                        allvalues = np.array(allvalues)
-                        if configs.is_parallel_deltamethod(config):
-                            allvariances = np.array(allvariances)
-                        for ii in range(allvalues.shape[1]):
-                            if configs.is_parallel_deltamethod(config):
-                                distribution = weights_vcv.WeightedGMCDF(
-                                    allvalues[:, ii], allvariances[:, ii], allweights
-                                )
-                            else:
-                                distribution = weights.WeightedECDF(
-                                    allvalues[:, ii],
-                                    allweights,
-                                    ignore_missing=config.get("ignore-missing", False),
-                                )
-                            myrowstuff = list(rowstuff)
-                            myrowstuff[rownames.index("region")] = config[
-                                "regionorder"
-                            ][ii]
-                            writer.writerow(
-                                myrowstuff
-                                + list(distribution.inverse(encoded_evalqvals))
-                            )
-                    else:
-                        if configs.is_parallel_deltamethod(config):
-                            distribution = weights_vcv.WeightedGMCDF(
-                                allvalues, allvariances, allweights
-                            )
-                        else:
-                            distribution = weights.WeightedECDF(
-                                allvalues,
-                                allweights,
-                                ignore_missing=config.get("ignore-missing", False),
-                            )
-
-                        writer.writerow(
-                            list(rowstuff)
-                            + list(distribution.inverse(encoded_evalqvals))
-                        )
-                elif output_format == "valuescsv":
-                    for ii in range(len(allvalues)):
-                        if isinstance(allvalues[ii], list) or isinstance(
-                            allvalues[ii], np.ndarray
-                        ):
-                            if "region" in config.get(
-                                "file-organize", []
-                            ) and "year" not in config.get("file-organize", []):
-                                for jj in range(min(len(allvalues[ii]), len(years))):
-                                    row = (
-                                        list(rowstuff)
-                                        + allmontevales[ii]
-                                        + [allvalues[ii][jj], allweights[ii]]
-                                    )
-                                    row[rownames.index("year")] = years[
-                                        jj
-                                    ]  # still set from before
-                                    writer.writerow(row)
-                                continue
-
-                            for jj in range(len(allvalues[ii])):
-                                myrowstuff = list(rowstuff)
-                                myrowstuff[rownames.index("region")] = config[
-                                    "regionorder"
-                                ][jj]
-                                writer.writerow(
-                                    myrowstuff
-                                    + allmontevales[ii]
-                                    + [allvalues[ii][jj], allweights[ii]]
-                                )
-                        else:
-                            writer.writerow(
-                                list(rowstuff)
-                                + allmontevales[ii]
-                                + [allvalues[ii], allweights[ii]]
-                            )
+    return columns + [values, outputs.Factor(list(allweights), memberindex)]
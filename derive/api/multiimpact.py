@@ -0,0 +1,146 @@
+"""Block-structured delta-method variances across several impacts
+
+A master VCV covers the coefficients of several impacts, each of whose
+files carries the VCV for its own block on the diagonal. Rather than
+zero-padding every file's coefficients out to the size of the master
+VCV, coefficients are kept per block and variances are computed only
+over the blocks that are present.
+"""
+
+import os
+import hashlib
+import numpy as np
+
+
+class MultiImpactVCV(object):
+    """A master VCV, with the offsets of the impact blocks within it
+
+    Parameters
+    ----------
+    vcv : array-like
+        The square master variance-covariance matrix.
+    """
+
+    def __init__(self, vcv):
+        self.vcv = np.asarray(vcv, dtype=float)
+        self.shape = self.vcv.shape
+        self.offsets = {}  # { digest of a file's VCV => offset }
+        self.nonzero = {}  # { (offset, size, offset, size) => bool }
+
+    @staticmethod
+    def load(path):
+        """Load a master VCV from a CSV file, through a binary cache.
+
+        The parsed matrix is saved alongside the CSV as a `.npz` file,
+        with the size and modification time of the CSV it was parsed
+        from. It is used only while the CSV still has both.
+        """
+        cachepath = path + ".npz"
+        stat = os.stat(path)
+        source = np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+        if os.path.exists(cachepath):
+            with np.load(cachepath) as cache:
+                if np.array_equal(cache["source"], source):
+                    return MultiImpactVCV(cache["vcv"])
+
+        vcv = np.loadtxt(path, delimiter=",", ndmin=2)
+        # Write and rename, so concurrent runs never see a partial file
+        temppath = cachepath + ".%d" % os.getpid()
+        try:
+            with open(temppath, "wb") as fp:
+                np.savez(fp, vcv=vcv, source=source)
+            os.replace(temppath, cachepath)
+        except OSError:
+            pass  # Cannot cache next to the CSV; parse it every time
+
+        return MultiImpactVCV(vcv)
+
+    def find_block(self, vcv, filepath=""):
+        """Return the offset of a file's VCV on the master's diagonal."""
+        vcv = np.ma.getdata(vcv)
+        digest = hashlib.sha1(np.ascontiguousarray(vcv, dtype=float).tobytes())
+        digest = (vcv.shape, digest.hexdigest())
+        if digest in self.offsets:
+            return self.offsets[digest]
+
+        size = vcv.shape[0]
+        diagonal = np.diag(self.vcv)
+        offset = None
+        for ii in range(self.shape[0] - size + 1):
+            # Check the diagonal first; it rules out most offsets cheaply
+            if not np.allclose(diagonal[ii : (ii + size)], np.diag(vcv)):
+                continue
+            if np.allclose(vcv, self.vcv[ii : (ii + size), ii : (ii + size)]):
+                offset = ii
+                break
+
+        assert offset is not None, (
+            "Cannot find the VCV for " + filepath + " within the master VCV."
+        )
+        self.offsets[digest] = offset
+
+        return offset
+
+    def block_nonzero(self, offset1, size1, offset2, size2):
+        key = (offset1, size1, offset2, size2)
+        if key not in self.nonzero:
+            self.nonzero[key] = np.any(
+                self.vcv[offset1 : (offset1 + size1), offset2 : (offset2 + size2)]
+            )
+
+        return self.nonzero[key]
+
+    def variance(self, coefficients):
+        """Delta-method variance of BlockCoefficients.
+
+        Sums the quadratic forms over every pair of blocks present,
+        skipping pairs where the master VCV is zero.
+        """
+        blocks = coefficients.blocks
+        total = 0
+        for offset1 in blocks:
+            size1 = blocks[offset1].shape[0]
+            for offset2 in blocks:
+                size2 = blocks[offset2].shape[0]
+                if not self.block_nonzero(offset1, size1, offset2, size2):
+                    continue
+                total = total + np.einsum(
+                    "i...,ij,j...->...",
+                    blocks[offset1],
+                    self.vcv[offset1 : (offset1 + size1), offset2 : (offset2 + size2)],
+                    blocks[offset2],
+                )
+
+        return total
+
+
+class BlockCoefficients(object):
+    """Delta-method coefficients for blocks of a master VCV
+
+    Stands in for the coefficients zero-padded out to the size of the
+    master VCV, holding only the blocks that are present.
+
+    Parameters
+    ----------
+    blocks : dict
+        { offset => array }, where the first axis of each array runs over
+        the coefficients of the block starting at offset.
+    """
+
+    def __init__(self, blocks):
+        self.blocks = blocks
+
+    def __add__(self, other):
+        blocks = dict(self.blocks)
+        for offset in other.blocks:
+            if offset in blocks:
+                blocks[offset] = blocks[offset] + other.blocks[offset]
+            else:
+                blocks[offset] = other.blocks[offset]
+
+        return BlockCoefficients(blocks)
+
+    def __neg__(self):
+        return BlockCoefficients(
+            {offset: -self.blocks[offset] for offset in self.blocks}
+        )
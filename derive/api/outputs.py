@@ -0,0 +1,364 @@
+"""Writers for the files produced by `derive quantiles`
+
+Each `output-format` names the table to produce (`edf`, the quantiles of
+each row, or `values`, every member's value and weight) and the file
+format to write it in: `csv`, `nc` (netCDF4) or `parquet`. Writers take
+a header, and then rows or whole columns. The netCDF4 and Parquet
+writers keep each column typed (numbers as numbers, names as strings)
+and write them in bulk, as they are collected.
+"""
+
+import csv
+import gzip
+import numpy as np
+import netCDF4
+
+formats = {
+    "edfcsv": ("edf", "csv"),
+    "valuescsv": ("values", "csv"),
+    "edfnc": ("edf", "nc"),
+    "valuesnc": ("values", "nc"),
+    "edfparquet": ("edf", "parquet"),
+    "valuesparquet": ("values", "parquet"),
+}
+
+extensions = {"csv": ".csv", "nc": ".nc4", "parquet": ".parquet"}
+compressions = {"gzip": ".gz", "zstd": ".zst"}  # for csv files
+
+flush_rows = 1000000  # rows collected before writing them to a binary file
+block_rows = 100000  # rows formatted together, when writing columns to csv
+
+
+def table_kind(output_format):
+    """The table produced by an output-format: `edf` or `values`."""
+    assert output_format in formats, "Error: output-format must be one of " + ", ".join(
+        formats
+    )
+    return formats[output_format][0]
+
+
+def extension(config):
+    """The extension of the output files, including any compression."""
+    filetype = formats[config.get("output-format", "edfcsv")][1]
+    if filetype == "csv" and config.get("output-compression", None):
+        assert (
+            config["output-compression"] in compressions
+        ), "Error: output-compression must be one of " + ", ".join(compressions)
+        return extensions[filetype] + compressions[config["output-compression"]]
+    return extensions[filetype]
+
+
+def open_writer(path, config):
+    filetype = formats[config.get("output-format", "edfcsv")][1]
+    if filetype == "nc":
+        return NetCDFWriter(path)
+    if filetype == "parquet":
+        return ParquetWriter(path)
+    return CSVWriter(
+        path,
+        config.get("output-precision", None),
+        config.get("output-compression", None),
+    )
+
+
+class CSVWriter(object):
+    """Writes rows as csv.writer would, or whole columns at once
+
+    Parameters
+    ----------
+    path : str
+    precision : int or None
+        Digits after the decimal point for numbers, or None for the
+        shortest text that reads back as the same number.
+    compression : None, `gzip` or `zstd`
+    """
+
+    def __init__(self, path, precision=None, compression=None):
+        if compression == "gzip":
+            self.fp = gzip.open(path, "wt", compresslevel=6)
+        elif compression == "zstd":
+            # Only needed for this compression, so only required if it is used
+            import zstandard
+
+            self.fp = zstandard.open(path, "wt")
+        else:
+            self.fp = open(path, "w")
+        self.writer = csv.writer(self.fp, quoting=csv.QUOTE_MINIMAL)
+        self.precision = precision
+
+    def writeheader(self, names):
+        self.writer.writerow(names)
+
+    def writerow(self, row):
+        if self.precision is None:
+            self.writer.writerow(row)
+        else:
+            self.writecolumns([[value] for value in row])
+
+    def writecolumns(self, columns):
+        """Write rows given as a list of equal-length columns.
+
+        Each column is formatted in one pass, and all of the rows are
+        written together.
+        """
+        if len(columns) == 0:
+            return
+        for start in range(0, len(columns[0]), block_rows):
+            texts = [
+                format_column(column_slice(column, start), self.precision)
+                for column in columns
+            ]
+            self.fp.write("\r\n".join(map(",".join, zip(*texts))) + "\r\n")
+
+    def close(self):
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ColumnWriter(CSVWriter):
+    """Collects rows and columns, and appends them to the file in bulk
+
+    Subclasses define append(columns), given a list of arrays, one per
+    column; the type of each column is set by the first rows written.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.names = None
+        self.rows = []  # rows not yet added to chunks
+        self.chunks = []  # [[column]], not yet appended
+        self.numrows = 0  # rows in rows and chunks
+
+    def writeheader(self, names):
+        self.names = list(names)
+
+    def writerow(self, row):
+        self.rows.append(row)
+        self.numrows += 1
+        if self.numrows >= flush_rows:
+            self.flush()
+
+    def writecolumns(self, columns):
+        self.collect_rows()
+        self.chunks.append(columns)
+        self.numrows += len(columns[0])
+        if self.numrows >= flush_rows:
+            self.flush()
+
+    def collect_rows(self):
+        if self.rows:
+            self.chunks.append([list(column) for column in zip(*self.rows)])
+            self.rows = []
+
+    def flush(self):
+        self.collect_rows()
+        if self.chunks:
+            self.append(
+                [
+                    typed_column([chunk[cc] for chunk in self.chunks])
+                    for cc in range(len(self.names))
+                ]
+            )
+        self.chunks = []
+        self.numrows = 0
+
+    def close(self):
+        self.flush()
+
+
+class Factor(object):
+    """A column of labels[index], for columns with few distinct values
+
+    Each label is only formatted once.
+    """
+
+    def __init__(self, labels, index):
+        self.labels = labels
+        self.index = np.asarray(index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def values(self):
+        labels = np.empty(len(self.labels), dtype=object)
+        labels[:] = list(self.labels)
+        return labels[self.index]
+
+
+def column_slice(column, start):
+    """The block_rows rows of a column from start."""
+    if isinstance(column, Factor):
+        return Factor(column.labels, column.index[start : start + block_rows])
+    return column[start : start + block_rows]
+
+
+def format_column(column, precision=None):
+    """The text of each value in a column, as written by csv.writer.
+
+    Numbers are written as repr would, or with precision digits after
+    the decimal point.
+    """
+    if isinstance(column, Factor):
+        texts = np.empty(len(column.labels), dtype=object)
+        texts[:] = format_column(column.labels, precision)
+        return texts[column.index].tolist()
+
+    if precision is None:
+        formatter = float.__repr__
+    else:
+        formatter = ("%." + str(int(precision)) + "f").__mod__
+
+    column = np.asarray(column)
+    if column.dtype == np.float64 or (
+        column.dtype.kind == "f" and precision is not None
+    ):
+        return list(map(formatter, column.tolist()))
+
+    if column.dtype == object:
+        texts = [
+            formatter(value) if isinstance(value, float) else str(value)
+            for value in column.tolist()
+        ]
+    else:
+        texts = list(map(str, column))
+
+    # Quote as csv.QUOTE_MINIMAL does
+    if any(special in "".join(texts) for special in ',"\r\n'):
+        texts = [
+            (
+                '"' + text.replace('"', '""') + '"'
+                if any(special in text for special in ',"\r\n')
+                else text
+            )
+            for text in texts
+        ]
+
+    return texts
+
+
+def typed_column(chunks):
+    """Concatenate the chunks of a column, as numbers if possible."""
+    column = np.concatenate(
+        [
+            chunk.values() if isinstance(chunk, Factor) else np.asarray(chunk)
+            for chunk in chunks
+        ]
+    )
+    if column.dtype == object:
+        # Numbers (e.g., the labels of a year Factor) keep their own type
+        column = np.asarray(column.tolist()) if len(column) else column
+    if column.dtype.kind in "iufb":
+        return column
+    return column.astype(str).astype(object)
+
+
+class NetCDFWriter(ColumnWriter):
+    """Each column is a variable along an unlimited `row` dimension
+
+    Text columns are stored as integer codes, compressed like the
+    numbers, into a `<name>_labels` variable of the distinct values.
+    """
+
+    def __init__(self, path):
+        super(NetCDFWriter, self).__init__(path)
+        self.rootgrp = None
+        self.labels = {}  # { name => { label => code } }, for text columns
+
+    def append(self, columns):
+        if self.rootgrp is None:
+            self.rootgrp = netCDF4.Dataset(self.path, "w", format="NETCDF4")
+            self.rootgrp.createDimension("row", None)
+            for name, column in zip(self.names, columns):
+                if column.dtype == object:
+                    self.labels[name] = {}
+                    self.rootgrp.createDimension(name + "_labels", None)
+                    self.rootgrp.createVariable(
+                        name + "_labels", str, (name + "_labels",)
+                    )
+                    variable = self.rootgrp.createVariable(
+                        name, "i4", ("row",), zlib=True
+                    )
+                    variable.labels = name + "_labels"
+                else:
+                    self.rootgrp.createVariable(name, column.dtype, ("row",), zlib=True)
+
+        start = len(self.rootgrp.dimensions["row"])
+        for name, column in zip(self.names, columns):
+            if name in self.labels:
+                column = self.encode(name, column)
+            self.rootgrp.variables[name][start : start + len(column)] = column
+
+    def encode(self, name, column):
+        """Codes for a text column, adding any new labels."""
+        labels = self.labels[name]
+        unique, inverse = np.unique(column.astype(str), return_inverse=True)
+        for label in unique:
+            if label not in labels:
+                self.rootgrp.variables[name + "_labels"][len(labels)] = label
+                labels[label] = len(labels)
+
+        return np.array([labels[label] for label in unique], dtype="i4")[inverse]
+
+    def close(self):
+        super(NetCDFWriter, self).close()
+        if self.rootgrp is None:
+            self.append([np.array([], dtype=object) for name in self.names])
+        self.rootgrp.close()
+
+
+class ParquetWriter(ColumnWriter):
+    """Each flush of columns is written as a Parquet row group"""
+
+    def __init__(self, path):
+        super(ParquetWriter, self).__init__(path)
+        # Only needed for this format, so only required if it is used
+        import pyarrow
+        import pyarrow.parquet
+
+        self.pyarrow = pyarrow
+        self.writer = None
+
+    def append(self, columns):
+        table = self.pyarrow.table(
+            {name: column for name, column in zip(self.names, columns)}
+        )
+        if self.writer is None:
+            self.writer = self.pyarrow.parquet.ParquetWriter(self.path, table.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        super(ParquetWriter, self).close()
+        if self.writer is None:
+            self.append([np.array([], dtype=object) for name in self.names])
+        self.writer.close()
+
+
+def read_columns(path):
+    """{ name => array } for a netCDF4 or Parquet output file."""
+    if path.endswith(extensions["parquet"]):
+        import pyarrow.parquet
+
+        table = pyarrow.parquet.read_table(path)
+        return {
+            name: table.column(name).to_numpy(zero_copy_only=False)
+            for name in table.column_names
+        }
+
+    columns = {}
+    with netCDF4.Dataset(path, "r") as rootgrp:
+        for name in rootgrp.variables:
+            variable = rootgrp.variables[name]
+            if variable.dimensions != ("row",):
+                continue
+            if "labels" in variable.ncattrs():
+                labels = rootgrp.variables[variable.labels][:]
+                columns[name] = np.asarray(labels, dtype=object)[variable[:]]
+            else:
+                columns[name] = variable[:]
+
+    return columns
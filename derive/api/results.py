@@ -19,14 +19,34 @@ __version__ = "$Revision$"
 # $Source$
 
 import os
+import sys
+import copy
 import glob
 import re
+import time
+import resource
+import threading
+import collections
+import concurrent.futures
 import numpy as np
-from derive.api import configs, bundles
+from derive.api import (
+    configs,
+    bundles,
+    multiimpact,
+    catalog,
+    incremental,
+    ensemble,
+    outputs,
+    sketches,
+    shards,
+)
 
 debug = True
 rcps = ["rcp45", "rcp85"]
 
+listings = {}  # { target directory => set of names }, for one crawl; see use_catalog
+dircatalog = None  # catalog.Catalog to list directories from; see use_catalog
+
 
 def iterate_targetdirs(root, targetsubdirs):
     for targetsubdir in targetsubdirs:
@@ -46,43 +66,75 @@ def subdirs(root):
     if isinstance(root, dict):
         subdirs = None
         for name in root:
-            mydirs = os.listdir(root[name])
+            mydirs = scan_subdirs(root[name])
             if subdirs is None:  # Not initialized yet
                 subdirs = mydirs
             else:
-                subdirs = subdirs & mydirs
+                subdirs = [subdir for subdir in subdirs if subdir in mydirs]
         return subdirs
 
-    return os.listdir(root)
+    return scan_subdirs(root)
+
+
+def scan_subdirs(root, accept=None):
+    """The subdirectories of root, in directory order.
+
+    If accept is given, only subdirectories named in it are returned;
+    other entries are skipped without being checked.
+    """
+    if dircatalog is not None:
+        listing = dircatalog.listing(root)
+        if listing is not None:
+            return [
+                name
+                for name, isdir in listing
+                if isdir and (accept is None or name in accept)
+            ]
+
+    found = []
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if accept is not None and entry.name not in accept:
+                continue
+            if entry.is_dir():
+                found.append(entry.name)
 
+    return found
 
-def iterate_both(root):
+
+def iterate_both(root, filters=None):
     for subdir in subdirs(root):
         if "batch" not in subdir and "median" != subdir:
             continue
 
-        for result in iterate_batch(root, subdir):
+        for result in iterate_batch(root, subdir, filters):
             yield result
 
 
-def iterate_montecarlo(root, batches=None):
+def iterate_montecarlo(root, batches=None, filters=None):
     for subdir in subdirs(root):
         if "batch" not in subdir:
             continue
         if batches is not None and subdir not in batches:
             continue
 
-        for result in iterate_batch(root, subdir):
+        for result in iterate_batch(root, subdir, filters):
             yield result
 
 
-def recurse_directories(root, levels):
+def recurse_directories(root, levels, filters=None):
+    """Yield [subdir, ..., targetdir] for every directory `levels` deep.
+
+    filters, if given, has an entry for each level: either None, or the
+    names allowed at that level. Subtrees are pruned as soon as a level
+    does not match.
+    """
     if isinstance(root, dict):
         subdirs = None
         for name in root:
             mydirs = set(
                 os.path.join(*elements[:-1])
-                for elements in recurse_directories(root[name], levels)
+                for elements in recurse_directories(root[name], levels, filters)
             )
             if subdirs is None:  # Not initialized yet
                 subdirs = mydirs
@@ -94,24 +146,24 @@ def recurse_directories(root, levels):
             ]
         return
 
-    for subdir in os.listdir(root):
-        if not os.path.isdir(os.path.join(root, subdir)):
-            continue
-
+    accept = filters[0] if filters else None
+    for subdir in scan_subdirs(root, accept):
         if levels == 1:
             targetdir = os.path.join(root, subdir)
             yield [subdir, targetdir]
         else:
-            for recurse in recurse_directories(os.path.join(root, subdir), levels - 1):
+            for recurse in recurse_directories(
+                os.path.join(root, subdir), levels - 1, filters[1:] if filters else None
+            ):
                 yield [subdir] + recurse
 
 
-def iterate_batch(root, batch):
+def iterate_batch(root, batch, filters=None):
     if isinstance(root, dict):
         subdir = {name: os.path.join(root[name], batch) for name in root}
     else:
         subdir = os.path.join(root, batch)
-    for alldirs in recurse_directories(subdir, 4):
+    for alldirs in recurse_directories(subdir, 4, filters):
         yield [batch] + alldirs
 
 
@@ -124,6 +176,33 @@ def collect_in_dictionaries(data, datum, *keys):
     data[keys[-1]] = datum
 
 
+def list_directory(path):
+    """The names in a target directory, listed only once per crawl."""
+    if path not in listings:
+        listing = dircatalog.listing(path) if dircatalog is not None else None
+        if listing is not None:
+            listings[path] = set(name for name, isdir in listing)
+        else:
+            with os.scandir(path) as entries:
+                listings[path] = set(entry.name for entry in entries)
+
+    return listings[path]
+
+
+def use_catalog(config):
+    """Start a crawl: list directories from the catalog given by config,
+    if any, and forget the listings of any earlier crawl."""
+    global dircatalog
+
+    listings.clear()
+
+    path = config.get("catalog", None)
+    if path is None:
+        dircatalog = None
+    elif dircatalog is None or dircatalog.path != path:
+        dircatalog = catalog.Catalog(path)
+
+
 def directory_contains(targetdir, oneof, bypattern=False):
     if isinstance(targetdir, dict):
         for name in targetdir:
@@ -136,7 +215,7 @@ def directory_contains(targetdir, oneof, bypattern=False):
     if isinstance(oneof, str):
         oneof = [oneof]
 
-    files = os.listdir(targetdir)
+    files = list_directory(targetdir)
 
     for filename in oneof:
         if filename in files:
@@ -146,7 +225,21 @@ def directory_contains(targetdir, oneof, bypattern=False):
 
 
 def sum_into_data(root, basenames, columns, config, transforms, vectransforms):
-    data = {}  # { filestuff => { rowstuff => { batch-gcm-iam => value } } }
+    """Collect the values from every valid target directory under root.
+
+    With `workers` above 1 in config, target directories are read in a
+    pool of processes (see iterate_extracted); the results are merged
+    in the same order as a serial run.
+
+    With `distribution: sketch`, each row's values are added to a
+    weighted sketch as they are read, rather than kept.
+    """
+    if sketches.is_sketch(config):
+        data = sketches.SketchStore(config)  # filestuff => rowstuff => sketch
+    elif shards.is_sharded(config):
+        data = shards.ShardStore()  # [target's contributions]
+    else:
+        data = ensemble.EnsembleStore()  # filestuff => rowstuff x batch-gcm-iam
     years = (
         []
     )  # constructing years return variable here so if code doesnt execute function doesn't error
@@ -156,98 +249,565 @@ def sum_into_data(root, basenames, columns, config, transforms, vectransforms):
     else:
         message_on_none = "No valid target directories found; try --verbose"
 
-    for batch, rcp, gcm, iam, ssp, targetdir in configs.iterate_valid_targets(
-        root, config, basenames
+    targets = configs.iterate_valid_targets(root, config, basenames)
+    if shards.is_sharded(config):
+        positions = data.positions if isinstance(data, shards.ShardStore) else {}
+        targets = shards.shard_targets(targets, config, positions)
+    for target, extracted in iterate_extracted(
+        targets, basenames, columns, config, transforms, vectransforms
     ):
         message_on_none = "No valid results sets found within directories."
+        batch, rcp, gcm, iam, ssp, targetdir = target
         if isinstance(targetdir, str):
             print(targetdir)
         else:
             print(targetdir[list(targetdir.keys())[0]], "...")
 
-        # Ensure that all basenames are accounted for
-        foundall = True
-        for basename in basenames:
-            if not directory_contains(targetdir, basename + ".nc4", bypattern=True):
-                foundall = False
-                break
-        if not foundall:
+        contributions, targetobservations, targetyears, fingerprint = extracted
+        if contributions is None:
             continue
 
-        # Extract the values
-        for ii in range(len(basenames)):
-            if isinstance(targetdir, dict):
-                fullpath = os.path.join(
-                    configs.multipath(targetdir, basenames[ii]), basenames[ii] + ".nc4"
+        if isinstance(data, shards.ShardStore):
+            data.add(target, (batch, gcm, iam), contributions, targetyears)
+        else:
+            add_contributions(data, (batch, gcm, iam), contributions)
+        if fingerprint is not None:
+            for filestuff in contributions:
+                incremental.add_source(filestuff, fingerprint)
+        observations += targetobservations
+        if targetyears is not None:
+            years = targetyears
+
+    print("Observations:", observations)
+    if observations == 0:
+        print(message_on_none)
+    bundles.report_readstats()
+    return data, years
+
+
+def add_contributions(data, member, contributions):
+    """Set the values a member contributes to each file and row."""
+    for filestuff in contributions:
+        for rowstuff in contributions[filestuff]:
+            data.set(filestuff, rowstuff, member, contributions[filestuff][rowstuff])
+
+
+def region_footprint(root, basenames, columns, config):
+    """The number of regions, and the bytes read per region for all targets.
+
+    The first valid target directory is read for its first region only,
+    and taken as typical of the rest.
+
+    Returns
+    -------
+    numregions : int
+    regionbytes : int
+        Bytes held per region across every target directory.
+    """
+    probe = copy.copy(config)
+    probe["region-chunk"] = [0, 1]
+    numtargets = 0
+    targetbytes = None
+    for target in configs.iterate_valid_targets(root, probe, basenames):
+        if targetbytes is None:
+            fullpaths = target_paths(target, basenames)
+            if fullpaths is None:
+                continue
+            targetbytes = 0
+            for fullpath in set(fullpaths):
+                bundle = bundles.read_bundle_columns(
+                    fullpath,
+                    [
+                        columns[ii]
+                        for ii in range(len(basenames))
+                        if fullpaths[ii] == fullpath
+                    ],
+                    probe,
                 )
-            else:
-                fullpath = os.path.join(targetdir, basenames[ii] + ".nc4")
+                targetbytes += sum(
+                    np.asarray(data).nbytes for data in bundle.columns.values()
+                )
+                numregions = len(bundle.selection.layout.regionorder)
+        numtargets += 1
 
-            try:
-                for region, years, values in bundles.iterate_regions(
-                    fullpath, columns[ii], config
+    if targetbytes is None:
+        return 0, 0
+    return numregions, targetbytes * numtargets
+
+
+def target_paths(target, basenames):
+    """The file for each basename in a target directory.
+
+    Returns None if some basename is missing.
+    """
+    batch, rcp, gcm, iam, ssp, targetdir = target
+
+    # Ensure that all basenames are accounted for
+    for basename in basenames:
+        if not directory_contains(targetdir, basename + ".nc4", bypattern=True):
+            return None
+
+    fullpaths = []
+    for basename in basenames:
+        if isinstance(targetdir, dict):
+            fullpaths.append(
+                os.path.join(configs.multipath(targetdir, basename), basename + ".nc4")
+            )
+        else:
+            fullpaths.append(os.path.join(targetdir, basename + ".nc4"))
+
+    return fullpaths
+
+
+def read_target(target, basenames, columns, config, transforms):
+    """Read the bundles for all basenames in one target directory.
+
+    Each file is read once, for all of the columns requested from it.
+    Errors in reading a file are returned in place of its bundle, to be
+    raised when it is used.
+
+    Returns
+    -------
+    fullpaths : list of str
+        The file for each basename.
+    targetbundles : dict or None
+        { fullpath => Bundle or exception }, or None if the values are
+        cached from an unchanged target.
+    cached : incremental.TargetState or None
+        Only when running incrementally.
+    None is returned instead if some basename is missing.
+    """
+    fullpaths = target_paths(target, basenames)
+    if fullpaths is None:
+        return None
+
+    cached = incremental.TargetState.lookup(
+        target, fullpaths, basenames, columns, config, transforms
+    )
+    if cached is not None and cached.entry is not None:
+        return fullpaths, None, cached
+
+    targetbundles = {}
+    for fullpath in fullpaths:
+        if fullpath in targetbundles:
+            continue
+        try:
+            targetbundles[fullpath] = bundles.read_bundle_columns(
+                fullpath,
+                [
+                    columns[jj]
+                    for jj in range(len(basenames))
+                    if fullpaths[jj] == fullpath
+                ],
+                config,
+            )
+        except BaseException as ex:
+            targetbundles[fullpath] = ex
+
+    return fullpaths, targetbundles, cached
+
+
+def extract_target(
+    target, basenames, columns, config, transforms, vectransforms, readtarget=None
+):
+    """Sum the values of all basenames in one target directory.
+
+    The bundles are read with read_target, unless that has already been
+    done and its result is passed as readtarget.
+
+    Returns
+    -------
+    contributions : dict or None
+        { filestuff => { rowstuff => value } } for this target's member,
+        or None if some basename is missing from the directory.
+    observations : int
+    years : array-like or None
+    fingerprint : str or None
+        The fingerprint of the target's files, if running incrementally.
+    """
+    batch, rcp, gcm, iam, ssp, targetdir = target
+    contributions = {}  # { filestuff => { rowstuff => value } }
+    years = None
+    observations = 0
+
+    if readtarget is None:
+        readtarget = read_target(target, basenames, columns, config, transforms)
+    if readtarget is None:
+        return None, 0, None, None
+    fullpaths, targetbundles, cached = readtarget
+    if targetbundles is None:
+        return cached.restore(config)
+
+    failed = False
+    # Extract the values
+    for ii in range(len(basenames)):
+        fullpath = fullpaths[ii]
+
+        try:
+            if isinstance(targetbundles[fullpath], BaseException):
+                raise targetbundles[fullpath]
+            for region, years, values in bundles.iterate_regions(
+                fullpath, columns[ii], config, targetbundles[fullpath]
+            ):
+                if (
+                    "region" in config.get("file-organize", [])
+                    and "year" not in config.get("file-organize", [])
+                    and outputs.table_kind(config.get("output-format", "edfcsv"))
+                    == "values"
                 ):
-                    if (
-                        "region" in config.get("file-organize", [])
-                        and "year" not in config.get("file-organize", [])
-                        and config.get("output-format", "edfcsv") == "valuescsv"
-                    ):
-                        values = vectransforms[ii](values)
-                        filestuff, rowstuff = configs.csv_organize(
-                            rcp, ssp, region, "all", config
+                    values = vectransforms[ii](values)
+                    filestuff, rowstuff = configs.csv_organize(
+                        rcp, ssp, region, "all", config
+                    )
+                    if ii == 0:
+                        collect_in_dictionaries(
+                            contributions, values, filestuff, rowstuff
                         )
-                        if ii == 0:
-                            collect_in_dictionaries(
-                                data, values, filestuff, rowstuff, (batch, gcm, iam)
-                            )
-                        else:
-                            data[filestuff][rowstuff][(batch, gcm, iam)] += values
-                        observations += 1
-                        continue
-                    for year, value in bundles.iterate_values(years, values, config):
-                        if region == "all":
-                            value = vectransforms[ii](value)
-                        else:
-                            value = transforms[ii](value)
-                        filestuff, rowstuff = configs.csv_organize(
-                            rcp, ssp, region, year, config
+                    else:
+                        # Not in place: the first may view a shared bundle
+                        contributions[filestuff][rowstuff] = (
+                            contributions[filestuff][rowstuff] + values
                         )
-                        if ii == 0:
-                            collect_in_dictionaries(
-                                data, value, filestuff, rowstuff, (batch, gcm, iam)
-                            )
-                        else:
-                            data[filestuff][rowstuff][(batch, gcm, iam)] += value
-                        observations += 1
-            except Exception as ex:
-                import traceback  # CATBELL
-
-                print(
-                    "".join(
-                        traceback.format_exception(ex.__class__, ex, ex.__traceback__)
+                    observations += 1
+                    continue
+                for year, value in bundles.iterate_values(years, values, config):
+                    if region == "all":
+                        value = vectransforms[ii](value)
+                    else:
+                        value = transforms[ii](value)
+                    filestuff, rowstuff = configs.csv_organize(
+                        rcp, ssp, region, year, config
                     )
-                )  # CATBELL
-                print("Failed to read " + fullpath)
-                traceback.print_exc()
-                if debug:
-                    exit()
+                    if ii == 0:
+                        collect_in_dictionaries(
+                            contributions, value, filestuff, rowstuff
+                        )
+                    else:
+                        # Not in place: the first may view a shared bundle
+                        contributions[filestuff][rowstuff] = (
+                            contributions[filestuff][rowstuff] + value
+                        )
+                    observations += 1
+        except Exception as ex:
+            import traceback  # CATBELL
+
+            print(
+                "".join(traceback.format_exception(ex.__class__, ex, ex.__traceback__))
+            )  # CATBELL
+            print("Failed to read " + fullpath)
+            traceback.print_exc()
+            failed = True
+            if debug:
+                exit()
+
+    if cached is None:
+        return contributions, observations, years, None
+    if not failed:
+        cached.save(config, contributions, observations, years)
+    return contributions, observations, years, cached.fingerprint
+
+
+def iterate_extracted(targets, basenames, columns, config, transforms, vectransforms):
+    """Yield (target, extract_target(target, ...)) for each target, in order.
+
+    Config options: workers (processes to read with; default 1, in this
+    process), worker-tasks (targets each worker reads before it is
+    replaced; default 100), worker-memory (bytes of memory above which
+    workers are replaced)
+    """
+    args = (basenames, columns, config, transforms, vectransforms)
+    workers = config.get("workers", 1)
+    if workers <= 1:
+        if config.get("prefetch", 0) > 0:
+            for target, readtarget in iterate_prefetched(
+                targets, basenames, columns, config, transforms
+            ):
+                yield target, extract_target(target, *args, readtarget=readtarget)
+        else:
+            for target in targets:
+                yield target, extract_target(target, *args)
+        return
 
-    print("Observations:", observations)
-    if observations == 0:
-        print(message_on_none)
-    return data, years
+    tasks_per_worker = config.get("worker-tasks", 100)
+    memory_ceiling = config.get("worker-memory", None)
+
+    targets = enumerate(targets)
+    pending = {}  # { index => (target, future) }
+    finished = {}  # { index => (target, result) }
+    nextindex = 0
+    executor = None
+    exhausted = False
+    while True:
+        if executor is None:
+            executor = concurrent.futures.ProcessPoolExecutor(workers)
+            submitted = 0
+            recycle = False
+
+        # Keep the pool busy, until it is due to be replaced
+        while not exhausted and not recycle and len(pending) < 2 * workers:
+            try:
+                index, target = next(targets)
+            except StopIteration:
+                exhausted = True
+                break
+            pending[index] = (target, executor.submit(extract_worker, target, *args))
+            submitted += 1
+            if submitted >= workers * tasks_per_worker:
+                recycle = True
+
+        if len(pending) == 0:
+            executor.shutdown()
+            break
+
+        done, notdone = concurrent.futures.wait(
+            [future for target, future in pending.values()],
+            return_when=concurrent.futures.FIRST_COMPLETED,
+        )
+        for index in list(pending.keys()):
+            target, future = pending[index]
+            if future not in done:
+                continue
+            del pending[index]
+            result, state = future.result()
+            merge_worker_state(config, state)
+            finished[index] = (target, result)
+            if memory_ceiling is not None and state["memory"] > memory_ceiling:
+                recycle = True
+
+        # Hand results on in the order of the targets
+        while nextindex in finished:
+            yield finished.pop(nextindex)
+            nextindex += 1
+
+        if recycle and len(pending) == 0:
+            executor.shutdown()
+            executor = None
+
+
+def iterate_prefetched(targets, basenames, columns, config, transforms):
+    """Yield (target, read_target(target, ...)), reading ahead in a thread.
+
+    A background thread crawls the targets and reads their bundles into
+    a bounded queue, so that reading the next targets overlaps with
+    summing the current one. Only one thread reads, since the netCDF
+    library is not thread-safe.
+
+    Config options: prefetch (number of targets to read ahead), and
+    prefetch-memory (bytes of bundles to hold; at least one target is
+    always read ahead). The time spent waiting for reads is reported.
+    """
+    depth = config["prefetch"]
+    memory_limit = config.get("prefetch-memory", None)
+
+    queued = collections.deque()  # [(target, readtarget, nbytes)]
+    state = {"bytes": 0, "done": False, "error": None, "stop": False}
+    condition = threading.Condition()
+
+    def has_room():
+        if len(queued) == 0:
+            return True
+        if len(queued) >= depth:
+            return False
+        return memory_limit is None or state["bytes"] < memory_limit
+
+    def produce():
+        try:
+            for target in targets:
+                readtarget = read_target(target, basenames, columns, config, transforms)
+                nbytes = 0
+                if readtarget is not None and readtarget[1] is not None:
+                    for bundle in readtarget[1].values():
+                        if isinstance(bundle, bundles.Bundle):
+                            nbytes += bundle.nbytes
+
+                with condition:
+                    while not has_room() and not state["stop"]:
+                        condition.wait()
+                    if state["stop"]:
+                        return
+                    queued.append((target, readtarget, nbytes))
+                    state["bytes"] += nbytes
+                    condition.notify_all()
+        except BaseException as ex:
+            state["error"] = ex
+        finally:
+            with condition:
+                state["done"] = True
+                condition.notify_all()
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+
+    stalled = 0
+    try:
+        while True:
+            with condition:
+                if len(queued) == 0 and not state["done"]:
+                    time_start = time.time()
+                    while len(queued) == 0 and not state["done"]:
+                        condition.wait()
+                    stalled += time.time() - time_start
+                if len(queued) == 0:
+                    break
+                target, readtarget, nbytes = queued.popleft()
+                state["bytes"] -= nbytes
+                condition.notify_all()
+
+            yield target, readtarget
+    finally:
+        with condition:
+            state["stop"] = True
+            condition.notify_all()
+        print("Waited %.1f s for reads, with prefetch depth %d." % (stalled, depth))
+
+    producer.join()
+    if state["error"] is not None:
+        raise state["error"]
+
+
+def extract_worker(target, *args):
+    """Run extract_target in a worker, and report the state it changed."""
+    config = args[2]
+    use_catalog(config)
+    readstats = dict(bundles.readstats)
+    result = extract_target(target, *args)
+
+    return result, {
+        "regionorder": config.get("regionorder", None),
+        "deltamethod": config.get("deltamethod", None),
+        "deltamethod_vcv": bundles.deltamethod_vcv,
+        "readstats": {
+            key: bundles.readstats[key] - readstats[key] for key in readstats
+        },
+        "memory": current_memory(),
+    }
+
+
+def merge_worker_state(config, state):
+    """Carry the state a worker changed over into this process."""
+    if state["regionorder"] is not None:
+        config["regionorder"] = state["regionorder"]
+    if state["deltamethod"] is True:
+        config["deltamethod"] = True
+    if config.get("multiimpact_vcv", None) is None:
+        bundles.use_deltamethod_vcv(state["deltamethod_vcv"])
+    for key in state["readstats"]:
+        bundles.readstats[key] += state["readstats"][key]
+
+
+def current_memory():
+    """Resident memory of this process, in bytes."""
+    try:
+        with open("/proc/self/statm", "r") as fp:
+            return int(fp.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError):
+        # Peak, rather than current, memory; in KB on Linux, bytes on Mac
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if sys.platform == "darwin" else maxrss * 1024
 
 
 def deltamethod_variance(value, config):
-    if config.get("multiimpact_vcv", None) is None:
-        deltamethod_vcv = bundles.deltamethod_vcv
-    else:
-        deltamethod_vcv = config["multiimpact_vcv"]
+    """Delta-method variance of a coefficient array.
 
-    if value.ndim == 1:
-        return deltamethod_vcv.dot(value).dot(value)
-    else:
-        combined = np.zeros((value.shape[1]))
-        for ii in range(value.shape[1]):
-            combined[ii] = deltamethod_vcv.dot(value[:, ii]).dot(value[:, ii])
-        return combined
+    The first axis of value runs over the coefficients; the variance
+    is computed for every element of the remaining axes at once.
+    """
+    if config.get("multiimpact_vcv", None) is not None:
+        return config["multiimpact_vcv"].variance(value)
+
+    deltamethod_vcv = np.ma.getdata(bundles.deltamethod_vcv)
+    value = np.ma.filled(value, 0)
+
+    return np.einsum("i...,ij,j...->...", value, deltamethod_vcv, value)
+
+
+deltamethod_batch_size = 10000000  # coefficients in each batched computation
+
+
+def deltamethod_variances(values, config):
+    """Delta-method variances for a list of coefficient arrays.
+
+    Arrays with the same shape (or the same blocks, under
+    multiimpact_vcv) are stacked and their variances computed together,
+    in batches of up to deltamethod_batch_size coefficients.
+
+    Returns
+    -------
+    list of variances, matching values
+    """
+    groups = {}  # { shape signature => [index into values] }
+    for ii in range(len(values)):
+        groups.setdefault(coefficients_signature(values[ii]), []).append(ii)
+
+    variances = [None] * len(values)
+    for indices in groups.values():
+        if isinstance(values[indices[0]], multiimpact.BlockCoefficients):
+            size = sum(np.size(block) for block in values[indices[0]].blocks.values())
+        else:
+            size = np.size(values[indices[0]])
+        step = max(1, deltamethod_batch_size // max(1, size))
+
+        for start in range(0, len(indices), step):
+            batch = indices[start : (start + step)]
+            combined = deltamethod_variance(
+                stack_coefficients([values[ii] for ii in batch]), config
+            )
+            for jj in range(len(batch)):
+                variances[batch[jj]] = combined[jj]
+
+    return variances
+
+
+def deltamethod_group(group, config):
+    """Replace the coefficients in an ensemble.FileGroup by their
+    delta-method variances, computed together."""
+    if not group.is_dense():
+        present = group.present()
+        cells = list(zip(*np.nonzero(present)))
+        variances = deltamethod_variances(
+            [group.values[mm, rr] for mm, rr in cells], config
+        )
+
+        values = None
+        for ii in range(len(cells)):
+            if values is None:
+                values = np.full(present.shape + np.shape(variances[ii]), np.nan)
+            values[cells[ii]] = variances[ii]
+        if values is None:
+            values = np.full(present.shape, np.nan)
+        return group.with_values(values)
+
+    # Coefficients are the third axis, after members and rows
+    coefficients = group.values[: len(group.members), : len(group.rows)]
+    size = max(1, np.prod(coefficients.shape[2:], dtype=int))
+    step = max(1, deltamethod_batch_size // (size * max(1, len(group.members))))
+
+    values = np.empty(coefficients.shape[:2] + coefficients.shape[3:])
+    for start in range(0, len(group.rows), step):
+        values[:, start : (start + step)] = deltamethod_variance(
+            np.moveaxis(coefficients[:, start : (start + step)], 2, 0), config
+        )
+    return group.with_values(values)
+
+
+def coefficients_signature(value):
+    if isinstance(value, multiimpact.BlockCoefficients):
+        return tuple(
+            sorted((offset, value.blocks[offset].shape) for offset in value.blocks)
+        )
+    return np.shape(value)
+
+
+def stack_coefficients(values):
+    """Stack coefficient arrays along a new second axis."""
+    if isinstance(values[0], multiimpact.BlockCoefficients):
+        return multiimpact.BlockCoefficients(
+            {
+                offset: np.stack(
+                    [np.ma.filled(value.blocks[offset], 0) for value in values], axis=1
+                )
+                for offset in values[0].blocks
+            }
+        )
+
+    return np.stack([np.ma.filled(value, 0) for value in values], axis=1)
@@ -0,0 +1,159 @@
+"""Splitting a quantiles run across nodes, and merging the results
+
+With `shard: i/N` (or `derive quantiles --shard i/N`), a run reads only
+its share of the valid target directories, chosen by a hash of each
+target's (batch, rcp, gcm, iam, ssp), and writes what it collected to a
+partial file in `shard-dir` instead of writing output files. Once every
+shard is done, `derive merge` combines the partial files and writes the
+same output files as a single run would have.
+
+A partial file holds each target directory's values, with the target's
+position among all of the valid targets, so that the merged values are
+added in the same order as by a single run. With `distribution:
+sketch`, it holds the shard's sketches instead, which are merged.
+"""
+
+import os
+import glob
+import pickle
+import hashlib
+import heapq
+from derive.api import bundles, incremental
+
+
+def is_sharded(config):
+    return bool(config.get("shard", None))
+
+
+def parse_shard(config):
+    """(index, count) of this shard, from `shard: i/N`; index counts from 0."""
+    try:
+        index, count = [int(part) for part in str(config["shard"]).split("/")]
+    except ValueError:
+        index, count = -1, 0
+    assert 0 <= index < count, "Error: shard must be i/N, with 0 <= i < N."
+    return index, count
+
+
+def target_key(target):
+    """The (batch, rcp, gcm, iam, ssp) that identifies a target."""
+    return tuple(target[:5])
+
+
+def in_shard(target, index, count):
+    digest = hashlib.sha1(repr(target_key(target)).encode("utf-8")).hexdigest()
+    return int(digest, 16) % count == index
+
+
+def shard_targets(targets, config, positions):
+    """Yield the targets of this shard, in order.
+
+    The position of each, among all of the targets, is recorded in
+    positions as { target_key => position }.
+    """
+    index, count = parse_shard(config)
+    for position, target in enumerate(targets):
+        if in_shard(target, index, count):
+            positions[target_key(target)] = position
+            yield target
+
+
+class ShardStore(object):
+    """The values read by a shard, kept by target directory
+
+    Used in place of an ensemble.EnsembleStore by results.sum_into_data.
+    """
+
+    def __init__(self):
+        self.targets = []  # [(position, member, contributions, years)]
+        self.positions = {}  # { target_key => position }, see shard_targets
+
+    def add(self, target, member, contributions, years):
+        position = self.positions[target_key(target)]
+        self.targets.append((position, member, contributions, years))
+
+
+def shard_dir(config):
+    directory = config.get("shard-dir", config.get("output-dir", None))
+    assert directory, "Error: Sharded runs need a shard-dir (or output-dir)."
+    return directory
+
+
+def partial_path(config, index, count):
+    return os.path.join(shard_dir(config), "shard-%d-of-%d.pkl" % (index, count))
+
+
+def config_digest(argv, config):
+    """A digest of the basenames and options that must match across shards."""
+    return repr(
+        (
+            list(argv),
+            incremental.config_digest(
+                config, incremental.reading_options + incremental.output_options
+            ),
+        )
+    )
+
+
+def write_partial(argv, config, data, years, parallel_deltamethod_data):
+    """Save what a shard collected, for merge.
+
+    The state set in reading the files (see results.extract_worker) is
+    saved with it.
+    """
+    index, count = parse_shard(config)
+    path = partial_path(config, index, count)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path + ".tmp", "wb") as fp:
+        pickle.dump(
+            {
+                "digest": config_digest(argv, config),
+                "data": data,
+                "years": years,
+                "parallel_deltamethod_data": parallel_deltamethod_data,
+                "state": {
+                    "regionorder": config.get("regionorder", None),
+                    "deltamethod": config.get("deltamethod", None),
+                    "deltamethod_vcv": bundles.deltamethod_vcv,
+                    "readstats": {},
+                },
+            },
+            fp,
+            protocol=pickle.HIGHEST_PROTOCOL,
+        )
+    os.replace(path + ".tmp", path)  # Only complete files are merged
+    print("Wrote partial results to " + path)
+
+
+def read_partials(argv, config):
+    """The partial results of every shard, in order of shard.
+
+    All N shards named in shard-dir must be present, and have been run
+    with the same options as config (apart from how they were read and
+    written).
+    """
+    paths = glob.glob(os.path.join(shard_dir(config), "shard-*-of-*.pkl"))
+    counts = set(
+        int(os.path.basename(path).split("-of-")[1].split(".")[0]) for path in paths
+    )
+    assert (
+        len(counts) == 1
+    ), "Error: Expected the partial results of one sharded run in " + shard_dir(config)
+    count = counts.pop()
+
+    partials = []
+    for index in range(count):
+        path = partial_path(config, index, count)
+        assert os.path.exists(path), "Error: Missing partial results " + path
+        with open(path, "rb") as fp:
+            partials.append(pickle.load(fp))
+        assert partials[-1]["digest"] == config_digest(argv, config), (
+            "Error: Shard %d was run with different options." % index
+        )
+
+    return partials
+
+
+def merged_targets(stores):
+    """The targets of several ShardStores, in their order in a single run."""
+    return heapq.merge(*[store.targets for store in stores], key=lambda entry: entry[0])
@@ -0,0 +1,371 @@
+"""Mergeable summaries of weighted values, for approximate quantiles
+
+With `distribution: sketch`, each output row keeps a weighted quantile
+summary in place of every member's value, so the memory held for a row
+does not grow with the size of the ensemble. Members are added as they
+are read, and summaries of different parts of an ensemble can be merged
+or saved and loaded again.
+
+The summaries follow Greenwald and Khanna's: each entry is a value that
+was added, with its own weight and bounds on the weight of everything
+below it. Entries are dropped only while their neighbours still pin
+down every quantile to within `sketch-error` of the total weight.
+"""
+
+import io
+import numpy as np
+from derive.api import configs, weights
+
+distributions = ["ecdf", "sketch"]
+default_error = 0.01  # as a fraction of the total weight
+
+
+def is_sketch(config):
+    distribution = config.get("distribution", "ecdf")
+    assert (
+        distribution in distributions
+    ), "Error: distribution must be one of " + ", ".join(distributions)
+    return distribution == "sketch"
+
+
+class WeightedSketch(object):
+    """A weighted quantile summary, for each element of a row's values
+
+    Values may be single numbers or arrays (e.g., a value for each
+    region); every element is summarized separately, and all of them
+    are kept together as (element, entry) arrays. Entries beyond the
+    end of an element's summary have a weight of 0.
+
+    Each entry records the weight of the value itself, a lower bound on
+    the weight of all values below it (`lower`) and an upper bound on
+    the weight of the values up to and including it (`upper`). Values
+    are collected in a buffer, and added to the summary together.
+
+    Parameters
+    ----------
+    shape : tuple
+        The shape of each value.
+    error : float
+        The largest error allowed in the rank of any quantile, as a
+        fraction of the total weight.
+    buffersize : int or None
+        Values collected before they are summarized; by default, 1 / error.
+    """
+
+    def __init__(self, shape=(), error=default_error, buffersize=None):
+        assert 0 < error < 1, "Error: sketch-error must be between 0 and 1."
+        self.shape = tuple(shape)
+        self.error = error
+        self.buffersize = buffersize or int(np.ceil(1 / error))
+
+        size = int(np.prod(self.shape))
+        self.values = np.empty((size, 0))
+        self.weights = np.empty((size, 0))
+        self.lower = np.empty((size, 0))
+        self.upper = np.empty((size, 0))
+        self.moments = np.zeros((3, size))  # sums of w, w x and w x^2
+        self.buffer = []  # [(values, weight)], not yet summarized
+
+    def add(self, value, weight):
+        """Add a value (a number or an array of shape) with a weight.
+
+        NaN values are left out.
+        """
+        if weight <= 0:
+            return
+        value = np.asarray(value, dtype=float)
+        assert value.shape == self.shape, "Error: Sketch values must keep one shape."
+        self.buffer.append((value.reshape(-1), weight))
+        if len(self.buffer) >= self.buffersize:
+            self.flush()
+
+    def flush(self):
+        """Add the buffered values to the summary."""
+        if not self.buffer:
+            return
+        values = np.stack([value for value, weight in self.buffer], axis=1)
+        entryweights = np.where(
+            np.isnan(values), 0.0, [weight for value, weight in self.buffer]
+        )
+        self.buffer = []
+
+        counted = np.where(entryweights > 0, values, 0)
+        self.moments += [
+            np.sum(entryweights, axis=1),
+            np.sum(entryweights * counted, axis=1),
+            np.sum(entryweights * counted**2, axis=1),
+        ]
+
+        # Every buffered value, with its exact bounds
+        values, entryweights = sort_entries(values, entryweights)
+        cumulative = np.cumsum(entryweights, axis=1)
+        self.include(
+            (values, entryweights, cumulative - entryweights, cumulative),
+            np.sum(entryweights, axis=1),
+        )
+
+    def merge(self, other):
+        """Add all of the values of another sketch of the same shape."""
+        assert other.shape == self.shape, "Error: Only sketches of one shape merge."
+        self.flush()
+        other.flush()
+        self.moments += other.moments
+        self.include(
+            (other.values, other.weights, other.lower, other.upper), other.moments[0]
+        )
+
+    def include(self, summary, total):
+        """Combine a summary with this one, and drop the entries not needed."""
+        summary = combine(
+            (self.values, self.weights, self.lower, self.upper),
+            summary,
+            self.moments[0] - total,
+            total,
+        )
+        keep = compress_entries(summary, self.error * self.moments[0])
+
+        # Kept entries first, in order
+        width = np.max(np.sum(keep, axis=1), initial=0)
+        order = np.argsort(~keep, axis=1, kind="stable")[:, :width]
+        self.values, self.weights, self.lower, self.upper = [
+            np.take_along_axis(np.where(keep, array, fill), order, axis=1)
+            for array, fill in zip(summary, [np.inf, 0, np.inf, np.inf])
+        ]
+
+    def quantiles(self, pp):
+        """The quantiles of each element, and bounds on their rank errors.
+
+        A quantile is found as WeightedECDF.inverse would from every
+        value: the last entry known to be entirely below it.
+
+        Parameters
+        ----------
+        pp : list
+            Quantiles, or the codes of WeightedECDF.encode_evalqvals.
+
+        Returns
+        -------
+        quantiles : array-like
+            With shape shape + (len(pp),)
+        errorbounds : array-like
+            With shape shape. Each quantile q lies between the exact
+            quantiles at q - errorbound and q.
+        """
+        self.flush()
+        total = self.moments[0]
+        results = np.full((len(total), len(pp)), np.nan)
+        errorbounds = np.zeros(len(total))
+        valid = self.weights > 0
+        rows = np.arange(len(total))
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = self.moments[1] / total
+            for kk in range(len(pp)):
+                if pp[kk] == 2:  # mean
+                    results[:, kk] = mean
+                elif pp[kk] == 3:  # standard deviation
+                    results[:, kk] = np.sqrt(
+                        np.maximum(self.moments[2] / total - mean**2, 0)
+                    )
+                elif self.values.shape[1] > 0:
+                    below = valid & (self.upper / total[:, None] < pp[kk])
+                    # The last entry below, or the first (the smallest value)
+                    index = np.where(
+                        np.any(below, axis=1),
+                        below.shape[1] - 1 - np.argmax(below[:, ::-1], axis=1),
+                        0,
+                    )
+                    results[:, kk] = np.where(
+                        total > 0, self.values[rows, index], np.nan
+                    )
+                    errors = self.rank_error(index, pp[kk] * total) / total
+                    errorbounds = np.maximum(
+                        errorbounds, np.where(np.any(below, axis=1), errors, 0)
+                    )
+
+        return (
+            results.reshape(self.shape + (len(pp),)),
+            np.nan_to_num(errorbounds).reshape(self.shape),
+        )
+
+    def rank_error(self, index, target):
+        """How far below target the weight up to entry index may fall.
+
+        Everything up to the entry weighs at least lower + weight. The
+        following entry's weight counts too, if nothing can lie between
+        them.
+        """
+        rows = np.arange(len(index))
+        known = self.lower[rows, index] + self.weights[rows, index]
+        if self.values.shape[1] > 1:
+            following = np.minimum(index + 1, self.values.shape[1] - 1)
+            nextweight = self.weights[rows, following]
+            # (to within rounding in the sums of weights)
+            adjacent = (following > index) & (
+                self.upper[rows, following] - nextweight
+                <= known + 1e-12 * self.moments[0]
+            )
+            known = known + np.where(adjacent, nextweight, 0)
+        return np.maximum(target - known, 0)
+
+    def to_bytes(self):
+        """The sketch, as bytes for from_bytes."""
+        self.flush()
+        fp = io.BytesIO()
+        np.savez(
+            fp,
+            shape=np.array(self.shape, dtype=int),
+            error=self.error,
+            buffersize=self.buffersize,
+            values=self.values,
+            weights=self.weights,
+            lower=self.lower,
+            upper=self.upper,
+            moments=self.moments,
+        )
+        return fp.getvalue()
+
+    @staticmethod
+    def from_bytes(data):
+        arrays = np.load(io.BytesIO(data))
+        sketch = WeightedSketch(
+            tuple(arrays["shape"]), float(arrays["error"]), int(arrays["buffersize"])
+        )
+        for name in ["values", "weights", "lower", "upper", "moments"]:
+            setattr(sketch, name, arrays[name])
+        return sketch
+
+
+def sort_entries(values, entryweights, *others):
+    """Sort each element's entries by value, with empty entries last."""
+    order = np.lexsort((values, entryweights <= 0), axis=1)
+    return [
+        np.take_along_axis(array, order, axis=1)
+        for array in (values, entryweights) + others
+    ]
+
+
+def combine(summary1, summary2, total1, total2):
+    """The summary of the values of two summaries, with sorted entries.
+
+    Each entry's bounds gain what the other summary can say about the
+    weight below its value: at least that up to and including the other
+    summary's entries below it, and at most that below its entries above
+    it.
+    """
+    values, entryweights, lower, upper = [
+        np.concatenate([array1, array2], axis=1)
+        for array1, array2 in zip(summary1, summary2)
+    ]
+    from2 = np.zeros(values.shape, dtype=bool)
+    from2[:, summary1[0].shape[1] :] = True
+
+    below2, upto2 = other_bounds(values, entryweights, lower, upper, from2, total2)
+    below1, upto1 = other_bounds(values, entryweights, lower, upper, ~from2, total1)
+    lower = lower + np.where(from2, below1, below2)
+    upper = upper + np.where(from2, upto1, upto2)
+
+    return sort_entries(values, entryweights, lower, upper)
+
+
+def other_bounds(values, entryweights, lower, upper, isother, othertotal):
+    """For each entry, bounds on the weight of the other summary's values
+    strictly below it, and up to and including it."""
+    isother = isother & (entryweights > 0)
+    size = values.shape[1]
+    if size == 0:
+        return values, values
+
+    # Entries of the other summary with the same value come after
+    order = np.lexsort((isother, values), axis=1)
+    below = np.maximum.accumulate(
+        np.take_along_axis(np.where(isother, lower + entryweights, 0), order, axis=1),
+        axis=1,
+    )
+    np.put_along_axis(below, order, below.copy(), axis=1)
+
+    # ... or before
+    order = np.lexsort((~isother, values), axis=1)
+    upto = np.minimum.accumulate(
+        np.take_along_axis(
+            np.where(isother, upper - entryweights, np.inf), order, axis=1
+        )[:, ::-1],
+        axis=1,
+    )[:, ::-1]
+    np.put_along_axis(upto, order, upto.copy(), axis=1)
+
+    return below, np.minimum(upto, othertotal[:, None])
+
+
+def compress_entries(summary, limit):
+    """Which entries to keep, so that each pair of neighbouring kept
+    entries spans no more than limit of weight (or are neighbours already).
+
+    The first and last entries of each element are always kept.
+    """
+    values, entryweights, lower, upper = summary
+    numentries = np.sum(entryweights > 0, axis=1)
+    keep = np.zeros(values.shape, dtype=bool)
+    lastlower = np.zeros(len(values))  # lower of the last kept entry
+    for jj in range(values.shape[1]):
+        if jj + 1 < values.shape[1]:
+            nextupper = upper[:, jj + 1]
+        else:
+            nextupper = np.inf
+        keep[:, jj] = (jj < numentries) & (
+            (jj == 0) | (jj == numentries - 1) | (nextupper - lastlower > limit)
+        )
+        lastlower = np.where(keep[:, jj], lower[:, jj], lastlower)
+
+    return keep
+
+
+class SketchStore(object):
+    """A sketch for every output row: { filestuff => { rowstuff => WeightedSketch } }
+
+    Used in place of an ensemble.EnsembleStore, with each member's
+    value weighted by its GCM's weight as it is added.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.error = config.get("sketch-error", default_error)
+        self.groups = {}
+        self.memberweights = {}  # { (rcp, member) => weight }
+
+    def set(self, filestuff, rowstuff, member, value):
+        rcp = configs.csv_organized_rcp(filestuff, rowstuff, self.config)
+        if (rcp, member) not in self.memberweights:
+            self.memberweights[(rcp, member)] = weights.member_weights(
+                [member], rcp, self.config
+            )[0]
+
+        group = self.groups.setdefault(filestuff, {})
+        if rowstuff not in group:
+            group[rowstuff] = WeightedSketch(np.shape(value), self.error)
+        group[rowstuff].add(value, self.memberweights[(rcp, member)])
+
+    def merge(self, other):
+        """Add the sketches of another store."""
+        for filestuff in other:
+            group = self.groups.setdefault(filestuff, {})
+            for rowstuff, sketch in other[filestuff].items():
+                if rowstuff in group:
+                    group[rowstuff].merge(sketch)
+                else:
+                    group[rowstuff] = sketch
+
+    def __contains__(self, filestuff):
+        return filestuff in self.groups
+
+    def __getitem__(self, filestuff):
+        return self.groups[filestuff]
+
+    def __iter__(self):
+        return iter(self.groups)
+
+    def __len__(self):
+        return len(self.groups)
+
+    def keys(self):
+        return self.groups.keys()
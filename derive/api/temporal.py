@@ -0,0 +1,149 @@
+"""Reductions of values along the year axis
+
+All of these are built on cumulative sums along the year axis, so any
+number of (possibly overlapping) spans of years cost O(years) per
+series. Values may have any number of other axes, as for the
+deltamethod (`_bcde`) layout, where the year axis is the second one.
+"""
+
+import numpy as np
+
+
+def prefix_sums(values, axis=0):
+    """Cumulative sums along axis, starting with a zero.
+
+    Element ii along axis is the sum of the first ii values, so the sum
+    over [start, end) is `sums[end] - sums[start]`. Masked values are
+    left out, as np.ma.mean leaves them out, and NaN values only spoil
+    the spans that hold them, as in np.mean.
+
+    Returns
+    -------
+    sums : array-like
+        Prefix sums of the values, counting masked and NaN values as 0
+    counts : array-like or None
+        Prefix counts of the unmasked values, or None if none are masked
+    nans : array-like or None
+        Prefix counts of the NaN values, or None if there are none
+    """
+    values = np.ma.asarray(values, dtype=float)
+    masked = np.ma.getmaskarray(values)
+    values = np.ma.filled(values, 0.0)
+    isnan = np.isnan(values)
+    if np.any(isnan):
+        values = np.where(isnan, 0.0, values)
+
+    def prefix(array):
+        zeros = np.zeros(array.shape[:axis] + (1,) + array.shape[axis + 1 :])
+        return np.concatenate((zeros, np.cumsum(array, axis=axis)), axis=axis)
+
+    return (
+        prefix(values),
+        prefix(~masked) if np.any(masked) else None,
+        prefix(isnan) if np.any(isnan) else None,
+    )
+
+
+def span_means(prefixes, starts, ends, axis=0):
+    """Means over [starts, ends) index spans, from prefix_sums.
+
+    The spans are stacked along axis; spans without any unmasked values
+    give NaN.
+    """
+    sums, counts, nans = prefixes
+    starts = np.asarray(starts)
+    ends = np.asarray(ends)
+
+    def spans(array):
+        return np.take(array, ends, axis=axis) - np.take(array, starts, axis=axis)
+
+    if counts is None:
+        counts = (ends - starts).astype(float)
+        counts[counts == 0] = np.nan
+        shape = [1] * sums.ndim
+        shape[axis] = len(counts)
+        counts = counts.reshape(shape)
+    else:
+        counts = spans(counts)
+        counts[counts == 0] = np.nan
+
+    means = spans(sums) / counts
+    if nans is not None:
+        means[spans(nans) > 0] = np.nan
+    return means
+
+
+def float_type(values):
+    """The type of the means of values, as np.mean would give them (e.g.,
+    float32 for float32 bundles)."""
+    return np.result_type(np.ma.asarray(values).dtype, np.float32)
+
+
+def yearset_means(years, values, yearsets, axis=0):
+    """Means over each (start, end) yearset, excluding the end year.
+
+    The yearsets are stacked along axis, in the order given. Values
+    narrower than float64 are averaged over each yearset with np.mean,
+    so that they are rounded as before, rather than from prefix sums.
+    """
+    years = np.asarray(years)
+    starts = np.searchsorted(years, [yearset[0] for yearset in yearsets])
+    ends = np.searchsorted(years, [yearset[1] for yearset in yearsets])
+
+    if float_type(values) != np.float64:
+        if not np.ma.is_masked(values):
+            values = np.ma.getdata(values)  # np.ma.mean would give float64
+        means = np.ma.stack(
+            [
+                np.mean(np.take(values, np.arange(start, end), axis=axis), axis=axis)
+                for start, end in zip(starts, ends)
+            ],
+            axis=axis,
+        )
+        return np.ma.filled(means, np.nan)
+
+    return span_means(prefix_sums(values, axis), starts, ends, axis)
+
+
+def rolling_means(years, values, window, axis=0):
+    """Means over the `window` years ending at each year.
+
+    Only years with a complete window are returned.
+
+    Returns
+    -------
+    endyears : array-like
+        The last year of each window
+    means : array-like
+        The window means, stacked along axis
+    """
+    years = np.asarray(years)
+    ends = np.arange(1, len(years) + 1)
+    starts = np.searchsorted(years, years - window + 1)
+    complete = years - window + 1 >= years[0]
+
+    means = span_means(
+        prefix_sums(values, axis), starts[complete], ends[complete], axis
+    )
+    return years[complete], means.astype(float_type(values), copy=False)
+
+
+def cumulative_sums(years, values, axis=0, discountrate=0, discountyear=None):
+    """Running totals up to and including each year.
+
+    With a discountrate, each value is discounted back to discountyear
+    (by default, the first year), giving the net present value of all
+    values up to each year. Masked values are left out, while a NaN
+    value makes the totals from its year on NaN.
+    """
+    values = np.ma.filled(np.ma.asarray(values, dtype=float), 0.0)
+    if discountrate:
+        years = np.asarray(years)
+        if discountyear is None:
+            discountyear = years[0]
+        shape = [1] * values.ndim
+        shape[axis] = len(years)
+        factors = (1.0 + discountrate) ** -(years - discountyear).astype(float)
+        values = values * factors.reshape(shape)
+
+    return np.cumsum(values, axis=axis)
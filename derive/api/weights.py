@@ -23,22 +23,29 @@ import csv
 import numpy as np
 from statsmodels.distributions.empirical_distribution import StepFunction
 
+default_weights_dir = "/shares/gcp/climate/BCSD/SMME/SMME-weights/"
 
-def get_weights(rcp):
-    weights = get_weights_april2016(rcp)
-    weights.update(get_weights_march2018(rcp))
+registry = {}  # { (weights directory, rcp) => { model => weight } }
+unweighted = set()  # (rcp, model) already reported as without a weight
 
-    return weights
+
+def get_weights(rcp, weightsdir=default_weights_dir):
+    """{ model => weight } for an RCP, read once per weights directory."""
+    if (weightsdir, rcp) not in registry:
+        weights = get_weights_april2016(rcp, weightsdir)
+        weights.update(get_weights_march2018(rcp, weightsdir))
+        registry[(weightsdir, rcp)] = weights
+
+    return registry[(weightsdir, rcp)]
 
 
-def get_weights_april2016(rcp):
+def get_weights_april2016(rcp, weightsdir=default_weights_dir):
     weights = {}
 
     with open(
-        "/shares/gcp/climate/BCSD/SMME/SMME-weights/"
-        + rcp
-        + "_2090_SMME_edited_for_April_2016.tsv",
-        "rU",
+        os.path.join(weightsdir, rcp + "_2090_SMME_edited_for_April_2016.tsv"),
+        "r",
+        newline="",
     ) as tsvfp:
         reader = csv.reader(tsvfp, delimiter="\t")
         next(reader)
@@ -53,11 +60,11 @@ def get_weights_april2016(rcp):
     return weights
 
 
-def get_weights_march2018(rcp):
+def get_weights_march2018(rcp, weightsdir=default_weights_dir):
     weights = {}
 
     with open(
-        "/shares/gcp/climate/BCSD/SMME/SMME-weights/" + rcp + "_SMME_weights.tsv", "rU"
+        os.path.join(weightsdir, rcp + "_SMME_weights.tsv"), "r", newline=""
     ) as tsvfp:
         reader = csv.reader(tsvfp, delimiter="\t")
         next(reader)
@@ -74,6 +81,28 @@ def get_weights_march2018(rcp):
     return weights
 
 
+def member_weights(members, rcp, config):
+    """The weight of each (batch, gcm, iam) member, as an array.
+
+    Members whose GCM has no weight get 0, so are dropped; each such
+    GCM is reported once per RCP.
+    """
+    if not config.get("do-gcmweights", True):
+        return np.ones(len(members))
+
+    model_weights = get_weights(rcp, config.get("gcmweights-dir", default_weights_dir))
+    memberweights = np.zeros(len(members))
+    for ii in range(len(members)):
+        gcm = members[ii][1]
+        if gcm.lower() in model_weights:
+            memberweights[ii] = model_weights[gcm.lower()]
+        elif (rcp, gcm) not in unweighted:
+            print("Warning: No weight available for %s, so dropping." % gcm)
+            unweighted.add((rcp, gcm))
+
+    return memberweights
+
+
 def weighted_values(values, weights):
     """Takes a dictionary of model => value"""
     models = list(values.keys())
@@ -135,6 +164,110 @@ class WeightedECDF(StepFunction):
         return [p if isinstance(p, float) else encoder[p] for p in evalqvals]
 
 
+def weighted_quantiles(values, weights, pp, ignore_missing=False):
+    """Quantiles of weighted values, as WeightedECDF.inverse, for many
+    rows at once.
+
+    Parameters
+    ----------
+    values : array-like
+        Values with the members along the first axis, and any number of
+        other axes (e.g., regions).
+    weights : array-like
+        A weight for each member.
+    pp : list
+        Quantiles, or the codes of WeightedECDF.encode_evalqvals.
+    ignore_missing : bool
+        Drop NaN values, as in WeightedECDF.
+
+    Returns
+    -------
+    array-like
+        The values at each quantile, with shape values.shape[1:] + (len(pp),)
+    """
+    values = np.asarray(values)
+    # Keep float32 values as float32, so medians match WeightedECDF
+    values = np.array(values, dtype=np.result_type(values.dtype, np.float32))
+    shape = values.shape[1:]
+    # Members along the last, contiguous axis, so sums are as for each row
+    values = np.ascontiguousarray(values.reshape(len(values), -1).T)
+    weights = np.array(np.broadcast_to(np.asarray(weights, dtype=float), values.shape))
+
+    if ignore_missing:
+        missing = np.isnan(values)
+        weights[missing] = 0
+        values[missing] = 0
+        if values.shape[1] > 0:
+            allmissing = np.sum(weights, axis=1) == 0
+            weights[allmissing, 0] = 1
+            values[allmissing, 0] = np.nan
+
+    # One sort of every row
+    order = np.argsort(values, axis=1, kind="stable")
+    values = np.take_along_axis(values, order, axis=1)
+    weights = np.take_along_axis(weights, order, axis=1)
+    cumulative = np.cumsum(weights, axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        cumulative /= cumulative[:, -1:]
+
+    results = np.empty((values.shape[0], len(pp)))
+    for kk in range(len(pp)):
+        if pp[kk] == 2:  # mean
+            results[:, kk] = np.sum(values * weights, axis=1) / np.sum(weights, axis=1)
+        elif pp[kk] == 3:  # standard deviation
+            mu = np.sum(values * weights, axis=1) / np.sum(weights, axis=1)
+            results[:, kk] = np.sqrt(
+                np.sum(weights * (values - mu[:, None]) ** 2, axis=1)
+                / np.sum(weights, axis=1)
+            )
+        else:
+            # The last value whose cumulative weight is below the quantile,
+            # or the first value (as inverse does, since its -inf case
+            # clears itself)
+            indexes = np.sum(cumulative < pp[kk], axis=1) - 1
+            results[:, kk] = values[np.arange(len(values)), np.maximum(indexes, 0)]
+
+    # Special case with identical weights
+    if 0.5 in pp:
+        equal = np.all(weights == weights[:, :1], axis=1)
+        if np.any(equal):
+            results[equal, pp.index(0.5)] = np.median(values[equal], axis=1)
+
+    if ignore_missing and values.shape[1] > 0:
+        results[allmissing] = np.nan
+
+    return results.reshape(shape + (len(pp),))
+
+
+def weighted_quantiles_rows(rowvalues, rowweights, pp, ignore_missing=False):
+    """weighted_quantiles for a list of rows, each with its own members.
+
+    Rows with the same weights are stacked and computed together.
+
+    Returns
+    -------
+    list of the values at each quantile, for each row
+    """
+    groups = {}  # { weights => [row index] }
+    for ii in range(len(rowvalues)):
+        key = tuple(rowweights[ii])
+        groups.setdefault(key, []).append(ii)
+
+    results = [None] * len(rowvalues)
+    for key in groups:
+        indices = groups[key]
+        quantiles = weighted_quantiles(
+            np.stack([rowvalues[ii] for ii in indices], axis=1),
+            rowweights[indices[0]],
+            pp,
+            ignore_missing,
+        )
+        for jj in range(len(indices)):
+            results[indices[jj]] = quantiles[jj]
+
+    return results
+
+
 if __name__ == "__main__":
     import sys
 
@@ -20,19 +20,23 @@ __version__ = "$Revision$"
 # $Source$
 
 import numpy as np
-from scipy.optimize import brentq
+from scipy.special import ndtr
 from scipy.stats import norm
 
+default_tolerance = 2e-12  # absolute, as the default xtol of scipy's brentq
+max_iterations = 200
+
 
 class WeightedGMCDF(object):
     """
     A weighted Gaussian mixture model.
     """
 
-    def __init__(self, means, variances, weights):
+    def __init__(self, means, variances, weights, tolerance=default_tolerance):
         self.means = means
         self.sds = np.sqrt(variances)  # as std. dev.
         self.weights = weights / np.sum(weights)  # as fractions of 1
+        self.tolerance = tolerance
 
     def inverse(self, pp):
         # pp is a scalar or vector of probabilities
@@ -40,22 +44,15 @@ class WeightedGMCDF(object):
         if len(np.array(pp).shape) == 0:
             pp = np.array([pp])
 
-        # determine extreme left and right bounds for root-finding
-        pp = np.array(pp)  # needs to be np array
-        left = np.min(norm.ppf(np.min(pp), self.means, self.sds))
-        right = np.max(norm.ppf(np.max(pp[pp < 1]), self.means, self.sds))
-        # find root for each probability
-        roots = []
-        for p in pp:
-            if p == 2:
-                roots.append(np.average(self.means, weights=self.weights))
-                continue
-
-            # Set up mixed distribution CDF with root and find it
-            func = lambda x: sum(self.weights * norm.cdf(x, self.means, self.sds)) - p
-            roots.append(brentq(func, left, right))
-
-        return roots
+        return list(
+            mixture_quantiles(
+                self.means,
+                np.square(self.sds),
+                self.weights,
+                pp,
+                self.tolerance,
+            )
+        )
 
     @staticmethod
     def encode_evalqvals(evalqvals):
@@ -63,6 +60,144 @@ class WeightedGMCDF(object):
         return [p if isinstance(p, float) else encoder[p] for p in evalqvals]
 
 
+def mixture_quantiles(means, variances, weights, pp, tolerance=default_tolerance):
+    """Quantiles of weighted Gaussian mixtures, for many rows at once.
+
+    Solves for every row and probability together, as
+    WeightedGMCDF.inverse does one at a time, to within tolerance.
+
+    Parameters
+    ----------
+    means, variances : array-like
+        Components along the first axis, and any number of other axes
+        (e.g., regions) over which the mixtures vary.
+    weights : array-like
+        A weight for each component.
+    pp : list
+        Probabilities, or 2 for the mean.
+
+    Returns
+    -------
+    array-like
+        The quantiles, with shape means.shape[1:] + (len(pp),)
+    """
+    means = np.asarray(means, dtype=float)
+    shape = means.shape[1:]
+    means = means.reshape(len(means), -1).T  # (row, component)
+    sds = np.sqrt(np.asarray(variances, dtype=float).reshape(means.shape[::-1]).T)
+    weights = np.asarray(weights, dtype=float)
+    weights = weights / np.sum(weights)
+    pp = np.array(pp, dtype=float)
+
+    results = np.empty((means.shape[0], len(pp)))
+    ismean = pp == 2
+    if np.any(ismean):
+        results[:, ismean] = (np.sum(means * weights, axis=1) / np.sum(weights))[
+            :, None
+        ]
+
+    if not np.all(ismean):
+        # Extreme left and right bounds of each row's roots
+        left = np.min(norm.ppf(np.min(pp), means, sds), axis=1)
+        right = np.max(norm.ppf(np.max(pp[pp < 1]), means, sds), axis=1)
+        results[:, ~ismean] = solve_mixtures(
+            means, sds, weights, pp[~ismean], left, right, tolerance
+        )
+
+    return results.reshape(shape + (len(pp),))
+
+
+def mixture_quantiles_rows(
+    rowmeans, rowvariances, rowweights, pp, tolerance=default_tolerance
+):
+    """mixture_quantiles for a list of rows, each with its own components.
+
+    Rows with the same weights are stacked and solved together.
+
+    Returns
+    -------
+    list of the quantiles, for each row
+    """
+    groups = {}  # { weights => [row index] }
+    for ii in range(len(rowmeans)):
+        groups.setdefault(tuple(rowweights[ii]), []).append(ii)
+
+    results = [None] * len(rowmeans)
+    for key in groups:
+        indices = groups[key]
+        quantiles = mixture_quantiles(
+            np.stack([rowmeans[ii] for ii in indices], axis=1),
+            np.stack([rowvariances[ii] for ii in indices], axis=1),
+            rowweights[indices[0]],
+            pp,
+            tolerance,
+        )
+        for jj in range(len(indices)):
+            results[indices[jj]] = quantiles[jj]
+
+    return results
+
+
+def solve_mixtures(means, sds, weights, probs, left, right, tolerance):
+    """Find x where each row's mixture CDF equals each of probs.
+
+    Newton steps are taken within brackets [lo, hi] that start at
+    [left, right] for each row, falling back on bisection whenever a
+    step would leave its bracket or is not half as long as the step
+    before (so that Newton steps cannot cycle). Only the unconverged
+    roots are evaluated on each iteration.
+
+    Returns
+    -------
+    array-like
+        The roots, as (row, probability)
+    """
+    rows = np.repeat(np.arange(means.shape[0]), len(probs))
+    targets = np.tile(probs, means.shape[0])
+    lo = np.repeat(left, len(probs))
+    hi = np.repeat(right, len(probs))
+    xx = (lo + hi) / 2
+    laststep = hi - lo
+    active = np.arange(len(xx))
+
+    for iteration in range(max_iterations):
+        if len(active) == 0:
+            break
+
+        zz = (xx[active, None] - means[rows[active]]) / sds[rows[active]]
+        ff = np.sum(weights * ndtr(zz), axis=1) - targets[active]
+        density = np.sum(
+            weights * np.exp(-0.5 * zz**2) / sds[rows[active]], axis=1
+        ) / np.sqrt(2 * np.pi)
+
+        below = ff < 0
+        lo[active] = np.where(below, xx[active], lo[active])
+        hi[active] = np.where(below, hi[active], xx[active])
+
+        # Non-finite or overlong steps are left to bisection below
+        with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+            step = ff / density
+            newton = xx[active] - step
+            inside = (
+                np.isfinite(newton)
+                & (newton >= lo[active])
+                & (newton <= hi[active])
+                & (2 * np.abs(step) <= laststep[active])
+            )
+        bisect = (lo[active] + hi[active]) / 2
+        laststep[active] = np.where(inside, np.abs(step), np.abs(bisect - xx[active]))
+        xx[active] = np.where(inside, newton, bisect)
+
+        converged = (
+            (hi[active] - lo[active] <= tolerance)
+            | (inside & (np.abs(step) <= tolerance / 2))
+            | ~np.isfinite(xx[active])
+        )
+        active = active[~converged]
+
+    return xx.reshape(means.shape[0], len(probs))
+
+
 if __name__ == "__main__":
     # # Example between R and python
     # # R:
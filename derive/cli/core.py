@@ -40,8 +40,13 @@ def single(netcdfpath, conf):
     multiple=True,
     help="Additional KEY=VALUE configuration option.",
 )
+@click.option(
+    "--shard",
+    default=None,
+    help="Read only shard i of N (as i/N, from 0), and save partial results.",
+)
 @click.argument("basenames", nargs=-1)
-def quantiles(confpath, basenames, conf):
+def quantiles(confpath, basenames, conf, shard):
     """Run the derive quantiles system with configuration file"""
     file_configs = read_config(confpath)
 
@@ -50,5 +55,54 @@ def quantiles(confpath, basenames, conf):
     for k, v in (arg.strip().split("=") for arg in conf):
         arg_configs[k] = safe_load(v)
     file_configs.update(arg_configs)
+    if shard is not None:
+        file_configs["shard"] = shard
 
     derive.api.quantiles(basenames, file_configs)
+
+
+@derive_cli.command(help="Combine the partial results of sharded quantiles runs")
+@click.argument("confpath", required=True, type=click.Path(exists=True))
+@click.option(
+    "-c",
+    "--conf",
+    nargs=1,
+    default="",
+    multiple=True,
+    help="Additional KEY=VALUE configuration option.",
+)
+@click.argument("basenames", nargs=-1)
+def merge(confpath, basenames, conf):
+    """Write the quantiles of a sharded run, from the partial results"""
+    file_configs = read_config(confpath)
+
+    # Parse CLI config values as yaml str before merging.
+    arg_configs = {}
+    for k, v in (arg.strip().split("=") for arg in conf):
+        arg_configs[k] = safe_load(v)
+    file_configs.update(arg_configs)
+
+    derive.api.merge(basenames, file_configs)
+
+
+@derive_cli.command(help="Build or refresh the catalog of a results tree")
+@click.argument("confpath", required=True, type=click.Path(exists=True))
+@click.option(
+    "-c",
+    "--conf",
+    nargs=1,
+    default="",
+    multiple=True,
+    help="Additional KEY=VALUE configuration option.",
+)
+def index(confpath, conf):
+    """Catalog the results tree given in the configuration file"""
+    file_configs = read_config(confpath)
+
+    # Parse CLI config values as yaml str before merging.
+    arg_configs = {}
+    for k, v in (arg.strip().split("=") for arg in conf):
+        arg_configs[k] = safe_load(v)
+    file_configs.update(arg_configs)
+
+    derive.api.index(file_configs)
@@ -0,0 +1,36 @@
+import os
+import numpy as np
+import pytest
+from netCDF4 import Dataset
+
+REGIONS = ["", "USA", "CAN", "MEX"]
+YEARS = np.arange(2000, 2011)
+GCMS = ["CCSM4", "GFDL-CM3", "MIROC5"]
+
+
+def write_bundle(path, seed, regions=REGIONS):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    rootgrp = Dataset(path, "w", format="NETCDF4")
+    rootgrp.createDimension("year", len(YEARS))
+    rootgrp.createDimension("region", len(regions))
+    rootgrp.createVariable("year", "i4", ("year",))[:] = YEARS
+    regionvar = rootgrp.createVariable("regions", str, ("region",))
+    for ii, region in enumerate(regions):
+        regionvar[ii] = region
+    rebased = rootgrp.createVariable("rebased", "f8", ("year", "region"))
+    rebased[:] = np.random.RandomState(seed).normal(size=(len(YEARS), len(regions)))
+    rootgrp.close()
+
+
+@pytest.fixture
+def resultsroot(tmp_path):
+    """Write a small Monte Carlo results tree and return its root"""
+    seed = 0
+    for batch in ["batch0", "batch1"]:
+        for rcp in ["rcp45", "rcp85"]:
+            for gcm in GCMS:
+                seed += 1
+                targetdir = tmp_path / "results" / batch / rcp / gcm / "high" / "SSP3"
+                write_bundle(str(targetdir / "impact.nc4"), seed)
+
+    return str(tmp_path / "results")
@@ -0,0 +1,165 @@
+import numpy as np
+import pytest
+from netCDF4 import Dataset
+from derive.api import bundles
+
+REGIONS = ["", "USA", "USA.1", "CAN", "CAN.1", "MEX", "FUND-USA", "FRA"]
+YEARS = np.arange(2000, 2011)
+
+
+@pytest.fixture
+def bundlepath(tmp_path):
+    """Write a small, chunked impact bundle and return its path"""
+    path = str(tmp_path / "impact.nc4")
+    rootgrp = Dataset(path, "w", format="NETCDF4")
+    rootgrp.createDimension("year", len(YEARS))
+    rootgrp.createDimension("region", len(REGIONS))
+    rootgrp.createVariable("year", "i4", ("year",))[:] = YEARS
+    regions = rootgrp.createVariable("regions", str, ("region",))
+    for ii, region in enumerate(REGIONS):
+        regions[ii] = region
+    rebased = rootgrp.createVariable(
+        "rebased", "f8", ("year", "region"), zlib=True, chunksizes=(4, 3)
+    )
+    rebased[:] = np.arange(len(YEARS) * len(REGIONS)).reshape(len(YEARS), len(REGIONS))
+    other = rootgrp.createVariable("other", "f8", ("year", "region"))
+    other[:] = -rebased[:]
+    rootgrp.close()
+
+    return path
+
+
+def test_coalesce_indices():
+    """Neighbouring indices should collapse into single slices"""
+    assert bundles.coalesce_indices(np.array([], dtype=int)) == []
+    assert bundles.coalesce_indices(np.array([1, 2, 3, 5, 7, 8])) == [
+        slice(1, 4),
+        slice(5, 6),
+        slice(7, 9),
+    ]
+
+
+@pytest.mark.parametrize(
+    "config",
+    [
+        {"region": "CAN"},
+        {"regions": ["MEX", "USA", "USA.1"]},
+        {"regions": ["global", "countries"]},
+        {"regions": ["funds", "FRA"]},
+    ],
+)
+def test_read_region_matches_full_read(bundlepath, config):
+    """Reading a region subset gives the same columns as masking a full read"""
+    allyears, allregions, alldata = bundles.read(bundlepath)
+    years, regions, data = bundles.read_region(config, bundlepath)
+
+    mask = np.isin(allregions, bundles.configs.get_regions(config, allregions))
+    np.testing.assert_array_equal(years, allyears)
+    np.testing.assert_array_equal(regions, allregions[mask])
+    np.testing.assert_array_equal(data, alldata[:, mask])
+
+
+def test_layout_shared_across_files(bundlepath, tmp_path):
+    """Bundles with the same axes share one cached layout"""
+    copypath = str(tmp_path / "impact-copy.nc4")
+    with open(bundlepath, "rb") as src, open(copypath, "wb") as dst:
+        dst.write(src.read())
+
+    bundle1 = bundles.read_bundle(bundlepath, ["rebased"], config={"region": "CAN"})
+    bundle2 = bundles.read_bundle(copypath, ["rebased"], config={"region": "CAN"})
+
+    assert bundle1.selection is bundle2.selection
+    assert bundle1.selection.regionorder == ["CAN"]
+    assert bundle1.selection.layout.regionindex["FRA"] == REGIONS.index("FRA")
+    np.testing.assert_array_equal(
+        bundle1.columns["rebased"], bundle2.columns["rebased"]
+    )
+
+
+def test_layout_distinguishes_regions(tmp_path):
+    """Bundles whose region names differ anywhere get their own layout"""
+    regions = ["R%03d" % ii for ii in range(200)]
+    swapped = list(regions)
+    swapped[1], swapped[2] = swapped[2], swapped[1]
+
+    paths = []
+    for name, names in [("impact1.nc4", regions), ("impact2.nc4", swapped)]:
+        paths.append(str(tmp_path / name))
+        rootgrp = Dataset(paths[-1], "w", format="NETCDF4")
+        rootgrp.createDimension("year", len(YEARS))
+        rootgrp.createDimension("region", len(names))
+        rootgrp.createVariable("year", "i4", ("year",))[:] = YEARS
+        regionvar = rootgrp.createVariable("regions", str, ("region",))
+        for ii, region in enumerate(names):
+            regionvar[ii] = region
+        rebased = rootgrp.createVariable("rebased", "f8", ("year", "region"))
+        rebased[:] = np.tile(np.arange(len(names)), (len(YEARS), 1))
+        rootgrp.close()
+
+    for path, names in zip(paths, [regions, swapped]):
+        bundle = bundles.read_bundle(path, ["rebased"], config={"region": "R001"})
+        np.testing.assert_array_equal(
+            bundle.columns["rebased"][:, 0], names.index("R001")
+        )
+
+
+def test_iterate_regions_shares_bundle(bundlepath):
+    """Columns read together match columns read one at a time"""
+    config = {"regions": ["USA", "MEX"]}
+    bundle = bundles.read_bundle_columns(bundlepath, ["rebased", "other", None], config)
+    assert sorted(bundle.columns.keys()) == ["other", "rebased"]
+
+    for column in ["rebased", "other", None]:
+        together = list(bundles.iterate_regions(bundlepath, column, config, bundle))
+        alone = list(bundles.iterate_regions(bundlepath, column, config))
+        assert [region for region, years, values in together] == ["USA", "MEX"]
+        for (region1, years1, values1), (region2, years2, values2) in zip(
+            together, alone
+        ):
+            np.testing.assert_array_equal(values1, values2)
+
+
+@pytest.mark.parametrize("strategy", ["auto"] + bundles.read_strategies)
+@pytest.mark.parametrize(
+    "indices",
+    [
+        (None, [1, 2, 6]),
+        ([0, 1, 2, 9], [0, 3, 4, 5]),
+        (None, []),
+        ([4], None),
+    ],
+)
+def test_read_plan_strategies(bundlepath, strategy, indices):
+    """Every read strategy returns the same selection"""
+    rootgrp = Dataset(bundlepath, "r", format="NETCDF4")
+    variable = rootgrp.variables["rebased"]
+    alldata = variable[:]
+    indices = tuple(None if ii is None else np.array(ii, dtype=int) for ii in indices)
+    plan = bundles.ReadPlan(variable, indices, {"read-strategy": strategy})
+    data = plan.read(variable)
+    rootgrp.close()
+
+    expected = alldata
+    for axis, axisindices in enumerate(indices):
+        if axisindices is not None:
+            expected = expected.take(axisindices, axis=axis)
+    np.testing.assert_array_equal(data, expected)
+    assert plan.decompressed >= plan.used
+
+
+@pytest.mark.parametrize(
+    "config,expected",
+    [
+        ({"years": [2003, 2007]}, [2003, 2007]),
+        ({"year": 2010}, [2010]),
+        ({"yearsets": [[2001, 2003], [2008, 2010]]}, [2001, 2002, 2008, 2009]),
+        ({}, list(YEARS)),
+    ],
+)
+def test_read_years_pushdown(bundlepath, config, expected):
+    """Only the years a configuration uses are read"""
+    allyears, allregions, alldata = bundles.read(bundlepath)
+    years, regions, data = bundles.read_region(config, bundlepath)
+
+    assert list(years) == expected
+    np.testing.assert_array_equal(data, alldata[np.isin(allyears, expected), :])
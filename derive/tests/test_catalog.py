@@ -0,0 +1,46 @@
+import os
+import shutil
+from derive.api import catalog, configs, results
+
+
+def test_refresh_lists_only_changed(resultsroot, tmp_path):
+    """A second refresh lists only the directories that have changed"""
+    dircatalog = catalog.Catalog(str(tmp_path / "catalog.db"))
+    first = dircatalog.refresh(resultsroot)
+    assert first["unchanged"] == 0
+
+    second = dircatalog.refresh(resultsroot)
+    assert second == {"listed": 0, "unchanged": first["listed"]}
+
+    removed = os.path.join(resultsroot, "batch1", "rcp45")
+    shutil.rmtree(removed)
+    targetdir = os.path.join(resultsroot, "batch0", "rcp85", "MIROC5", "high", "SSP3")
+    open(os.path.join(targetdir, "impact-costs.nc4"), "w").close()
+
+    third = dircatalog.refresh(resultsroot)
+    assert third["listed"] == 2
+    assert dircatalog.listing(removed) is None
+    assert dircatalog.listing(os.path.join(removed, "CCSM4")) is None
+    assert sorted(dircatalog.files(targetdir)) == ["impact-costs.nc4", "impact.nc4"]
+
+
+def test_targets_from_catalog(resultsroot, tmp_path, monkeypatch):
+    """Targets come from the catalog, without listing the filesystem"""
+    config = {"do-montecarlo": True, "only-ssp": "SSP3"}
+    expected = list(configs.iterate_valid_targets(resultsroot, config, ["impact"]))
+
+    catalogpath = str(tmp_path / "catalog.db")
+    catalog.Catalog(catalogpath).refresh(resultsroot)
+
+    def no_scandir(path):
+        raise AssertionError("Listed " + path)
+
+    monkeypatch.setattr(os, "scandir", no_scandir)
+    results.listings.clear()
+    config["catalog"] = catalogpath
+    try:
+        targets = list(configs.iterate_valid_targets(resultsroot, config, ["impact"]))
+    finally:
+        results.use_catalog({})
+
+    assert targets == expected
@@ -14,8 +14,14 @@ def tempfl():
 
 @pytest.mark.parametrize(
     "subcmd",
-    [None, "single", "quantiles"],
-    ids=("--help", "single --help", "quantiles --help"),
+    [None, "single", "quantiles", "merge", "index"],
+    ids=(
+        "--help",
+        "single --help",
+        "quantiles --help",
+        "merge --help",
+        "index --help",
+    ),
 )
 def test_cli_helpflags(subcmd):
     """Test that CLI commands don't throw Error if given --help flag"""
@@ -126,3 +132,38 @@ def test_quantiles_argpass(mocker, tempfl, addargs, expected_argv, expected_conf
 
     runner.invoke(derive.cli.derive_cli, cli_args)
     derive.api.quantiles.assert_called_once_with(expected_argv, expected_config)
+
+
+def test_shard_merge_argpass(mocker, tempfl):
+    """Whitebox test that --shard and 'merge' correctly pass args to API"""
+    mocker.patch.object(derive.api, "quantiles")
+    mocker.patch.object(derive.api, "merge")
+    mocker.patch.object(
+        derive.cli.core, "read_config", side_effect=lambda confpath: {"abc": 123}
+    )
+
+    runner = CliRunner()
+
+    runner.invoke(
+        derive.cli.derive_cli,
+        ["quantiles", str(tempfl.name), "--shard", "1/4", "basefilename"],
+    )
+    derive.api.quantiles.assert_called_once_with(
+        ("basefilename",), {"abc": 123, "shard": "1/4"}
+    )
+
+    runner.invoke(derive.cli.derive_cli, ["merge", str(tempfl.name), "basefilename"])
+    derive.api.merge.assert_called_once_with(("basefilename",), {"abc": 123})
+
+
+def test_index_argpass(mocker, tempfl):
+    """Whitebox test that 'index' subcommand correctly passes args to API"""
+    mocker.patch.object(derive.api, "index")
+    mocker.patch.object(derive.cli.core, "read_config", return_value={"abc": 123})
+
+    cli_args = ["index", str(tempfl.name), "-c", "catalog=results.db"]
+
+    runner = CliRunner()
+
+    runner.invoke(derive.cli.derive_cli, cli_args)
+    derive.api.index.assert_called_once_with({"abc": 123, "catalog": "results.db"})
@@ -0,0 +1,83 @@
+import numpy as np
+from derive.api import bundles, ensemble, multiimpact, results, weights
+
+
+def test_rows_keep_insertion_order():
+    """Each row lists its members in the order they were added to it"""
+    group = ensemble.FileGroup()
+    for ii in range(20):  # Enough to grow the arrays several times
+        group.set(("rcp45",), ("batch%d" % ii, "CCSM4", "high"), float(ii))
+    group.set(("rcp85",), ("batch3", "CCSM4", "high"), 30.0)
+    group.set(("rcp85",), ("batch1", "CCSM4", "high"), 10.0)
+    group.set(("rcp85",), ("batch3", "CCSM4", "high"), 31.0)
+
+    members, values = group.row(("rcp85",))
+    assert members == [("batch3", "CCSM4", "high"), ("batch1", "CCSM4", "high")]
+    np.testing.assert_array_equal(values, [31.0, 10.0])
+    assert group.keys() == [("rcp45",), ("rcp85",)]
+    assert len(group.row(("rcp45",))[0]) == 20
+    np.testing.assert_array_equal(
+        group.get(("rcp45",), [("batch2", "CCSM4", "high")]), [2.0]
+    )
+
+
+def test_masked_values_are_missing():
+    """Masked values are stored as NaN, and arrays are copied"""
+    group = ensemble.FileGroup()
+    value = np.ma.masked_array([1.0, 2.0, 3.0], mask=[False, True, False])
+    group.set("row", "member", value)
+    value[0] = 5.0
+
+    np.testing.assert_array_equal(group["row"]["member"], [1.0, np.nan, 3.0])
+
+
+def test_float32_values_keep_type():
+    """Values from float32 bundles are kept, and their medians found, as float32"""
+    group = ensemble.FileGroup()
+    values = np.random.RandomState(0).normal(size=(20, 3)).astype(np.float32)
+    for ii in range(len(values)):  # Enough to grow the arrays several times
+        group.set("row", ii, values[ii])
+    assert group.row("row")[1].dtype == np.float32
+
+    np.testing.assert_array_equal(
+        weights.weighted_quantiles(group.row("row")[1], [1.0] * 20, [0.5])[:, 0],
+        [
+            weights.WeightedECDF(list(values[:, jj]), [1.0] * 20).inverse([0.5])[0]
+            for jj in range(3)
+        ],
+    )
+
+    group.set("row", 20, np.array([0.1, 0.2, 0.3]))
+    assert group.row("row")[1].dtype == np.float64
+    assert group["row"][20][0] == 0.1
+
+
+def test_deltamethod_group_matches_variances(monkeypatch):
+    """Dense and object groups give the same variances as one at a time"""
+    rs = np.random.RandomState(0)
+    vcv = np.cov(rs.normal(size=(3, 10)))
+    monkeypatch.setattr(bundles, "deltamethod_vcv", vcv)
+    config = {"multiimpact_vcv": None}
+
+    group = ensemble.FileGroup()
+    coefficients = {}
+    for rowstuff in ["a", "b"]:
+        for member in range(4):
+            coefficients[rowstuff, member] = rs.normal(size=(3, 5))
+            group.set(rowstuff, member, coefficients[rowstuff, member])
+    variances = results.deltamethod_group(group, config)
+    for (rowstuff, member), value in coefficients.items():
+        np.testing.assert_allclose(
+            variances[rowstuff][member], results.deltamethod_variance(value, config)
+        )
+
+    config = {"multiimpact_vcv": multiimpact.MultiImpactVCV(vcv)}
+    group = ensemble.FileGroup()
+    for (rowstuff, member), value in coefficients.items():
+        group.set(rowstuff, member, multiimpact.BlockCoefficients({0: value}))
+    assert not group.is_dense()
+    variances = results.deltamethod_group(group, config)
+    for (rowstuff, member), value in coefficients.items():
+        np.testing.assert_allclose(
+            variances[rowstuff][member], results.deltamethod_variance(value, {})
+        )
@@ -0,0 +1,68 @@
+import os
+import numpy as np
+import derive.api
+from derive.api import bundles
+from derive.tests.test_results import sum_into_data
+
+
+def touch(path):
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+
+def test_unchanged_targets_not_read(resultsroot, tmp_path, monkeypatch):
+    """Only targets whose files have changed are read again"""
+    config = {"regions": ["USA", "MEX"], "incremental": str(tmp_path / "state")}
+    first, firstyears = sum_into_data(resultsroot, config)
+
+    changed = os.path.join(resultsroot, "batch1", "rcp85", "CCSM4", "high", "SSP3")
+    touch(os.path.join(changed, "impact.nc4"))
+
+    read = []
+    read_bundle_columns = bundles.read_bundle_columns
+
+    def counting_read(filepath, *args):
+        read.append(filepath)
+        return read_bundle_columns(filepath, *args)
+
+    monkeypatch.setattr(bundles, "read_bundle_columns", counting_read)
+    second, secondyears = sum_into_data(resultsroot, config)
+
+    assert read == [os.path.join(changed, "impact.nc4")]
+    np.testing.assert_array_equal(firstyears, secondyears)
+    for filestuff in first:
+        for rowstuff in first[filestuff]:
+            for member, value in first[filestuff][rowstuff].items():
+                np.testing.assert_array_equal(
+                    value, second[filestuff][rowstuff][member]
+                )
+
+
+def test_unchanged_outputs_not_written(resultsroot, tmp_path, capsys):
+    """Only output files with changed inputs are written again"""
+    outdir = tmp_path / "output"
+    config = {
+        "results-root": resultsroot,
+        "output-dir": str(outdir),
+        "do-montecarlo": True,
+        "do-gcmweights": False,
+        "region": "USA",
+        "incremental": str(tmp_path / "state"),
+    }
+    derive.api.quantiles(["impact"], dict(config))
+    written = {path.name: path.read_text() for path in outdir.iterdir()}
+    assert sorted(written) == ["rcp45-SSP3.csv", "rcp85-SSP3.csv"]
+
+    touch(
+        os.path.join(
+            resultsroot, "batch0", "rcp85", "MIROC5", "high", "SSP3", "impact.nc4"
+        )
+    )
+    (outdir / "rcp45-SSP3.csv").write_text("stale")
+    (outdir / "rcp85-SSP3.csv").write_text("stale")
+    capsys.readouterr()
+    derive.api.quantiles(["impact"], dict(config))
+
+    assert "Unchanged file: ('rcp45', 'SSP3')" in capsys.readouterr().out
+    assert (outdir / "rcp45-SSP3.csv").read_text() == "stale"
+    assert (outdir / "rcp85-SSP3.csv").read_text() == written["rcp85-SSP3.csv"]
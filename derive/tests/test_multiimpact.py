@@ -0,0 +1,75 @@
+import os
+import numpy as np
+from derive.api import multiimpact, results
+
+
+def master_vcv():
+    vcv = np.zeros((5, 5))
+    vcv[:3, :3] = [[1.0, 0.2, 0.1], [0.2, 2.0, 0.3], [0.1, 0.3, 1.5]]
+    vcv[3:, 3:] = [[0.5, 0.05], [0.05, 0.7]]
+    vcv[0, 3] = vcv[3, 0] = 0.04
+    return vcv
+
+
+def test_load_caches_binary(tmp_path):
+    """The CSV is parsed once and then read from the binary cache"""
+    path = str(tmp_path / "master.csv")
+    np.savetxt(path, master_vcv(), delimiter=",")
+
+    registry = multiimpact.MultiImpactVCV.load(path)
+    np.testing.assert_array_equal(registry.vcv, master_vcv())
+    assert (tmp_path / "master.csv.npz").exists()
+    np.testing.assert_array_equal(
+        multiimpact.MultiImpactVCV.load(path).vcv, master_vcv()
+    )
+    assert sorted(os.listdir(str(tmp_path))) == ["master.csv", "master.csv.npz"]
+
+
+def test_load_replaced_csv(tmp_path):
+    """A CSV replaced by an older copy is parsed again, not read from the cache"""
+    path = str(tmp_path / "master.csv")
+    np.savetxt(path, master_vcv(), delimiter=",")
+    multiimpact.MultiImpactVCV.load(path)
+
+    stat = os.stat(path)
+    np.savetxt(path, 2 * master_vcv(), delimiter=",")
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns - 10**9))
+    np.testing.assert_array_equal(
+        multiimpact.MultiImpactVCV.load(path).vcv, 2 * master_vcv()
+    )
+
+
+def test_block_variance_matches_padded():
+    """Block-wise variance equals the quadratic form on padded coefficients"""
+    registry = multiimpact.MultiImpactVCV(master_vcv())
+    assert registry.find_block(master_vcv()[3:, 3:]) == 3
+    assert registry.find_block(master_vcv()[:3, :3]) == 0
+
+    rs = np.random.RandomState(0)
+    impact1 = rs.normal(size=(3, 6))
+    impact2 = rs.normal(size=(2, 6))
+    coefficients = multiimpact.BlockCoefficients({0: impact1}) + (
+        -multiimpact.BlockCoefficients({3: impact2})
+    )
+
+    padded = np.concatenate((impact1, -impact2))
+    expected = np.einsum("i...,ij,j...->...", padded, master_vcv(), padded)
+    np.testing.assert_allclose(registry.variance(coefficients), expected)
+
+
+def test_batched_variances_match_single():
+    """Batched variances equal those computed one value at a time"""
+    config = {"multiimpact_vcv": multiimpact.MultiImpactVCV(master_vcv())}
+    rs = np.random.RandomState(1)
+    values = [
+        multiimpact.BlockCoefficients(
+            {0: rs.normal(size=(3, 4)), 3: rs.normal(size=(2, 4))}
+        )
+        for ii in range(5)
+    ] + [multiimpact.BlockCoefficients({3: rs.normal(size=(2, 4))})]
+
+    variances = results.deltamethod_variances(values, config)
+    for value, variance in zip(values, variances):
+        np.testing.assert_allclose(
+            variance, results.deltamethod_variance(value, config)
+        )
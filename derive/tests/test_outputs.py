@@ -0,0 +1,107 @@
+import gzip
+import netCDF4
+import numpy as np
+import pytest
+from derive.api import outputs
+
+HEADER = ["region", "year", "batch", "value", "weight"]
+ROWS = [
+    ["USA", 2000, "batch0", 1.5, 0.25],
+    ["CAN", 2000, "batch0", np.nan, 0.25],
+]
+COLUMNS = [["MEX", "USA"], [2001, 2001], ["batch1", "batch1"], [-2.0, 3.0], [1, 1]]
+
+
+def write_table(path, output_format, monkeypatch):
+    monkeypatch.setattr(outputs, "flush_rows", 3)  # append in several parts
+    with outputs.open_writer(path, {"output-format": output_format}) as writer:
+        writer.writeheader(HEADER)
+        for row in ROWS:
+            writer.writerow(row)
+        writer.writecolumns(COLUMNS)
+        writer.writerow(ROWS[0])
+
+
+def test_csv_columns_match_rows(tmp_path, monkeypatch):
+    """Columns are written as the same text as rows"""
+    write_table(str(tmp_path / "columns.csv"), "edfcsv", monkeypatch)
+    with outputs.open_writer(str(tmp_path / "rows.csv"), {}) as writer:
+        writer.writeheader(HEADER)
+        for row in ROWS + [list(row) for row in zip(*COLUMNS)] + ROWS[:1]:
+            writer.writerow(row)
+
+    assert (tmp_path / "columns.csv").read_text() == (tmp_path / "rows.csv").read_text()
+
+
+@pytest.mark.parametrize("output_format", ["valuesnc", "valuesparquet"])
+def test_binary_roundtrip(tmp_path, monkeypatch, output_format):
+    """Typed columns read back as written"""
+    if output_format == "valuesparquet":
+        pytest.importorskip("pyarrow")
+    path = str(
+        tmp_path / ("table" + outputs.extension({"output-format": output_format}))
+    )
+    write_table(path, output_format, monkeypatch)
+
+    columns = outputs.read_columns(path)
+    assert list(columns) == HEADER
+    assert list(columns["region"]) == ["USA", "CAN", "MEX", "USA", "USA"]
+    assert list(columns["year"]) == [2000, 2000, 2001, 2001, 2000]
+    assert columns["year"].dtype.kind == "i"
+    np.testing.assert_array_equal(
+        np.ma.filled(columns["value"], np.nan), [1.5, np.nan, -2.0, 3.0, 1.5]
+    )
+    np.testing.assert_array_equal(columns["weight"], [0.25, 0.25, 1, 1, 0.25])
+
+
+def test_netcdf_factor_types(tmp_path):
+    """Factors of numbers are written with their own type, as plain columns are"""
+    path = str(tmp_path / "table.nc4")
+    years = np.array([2030, 2050], dtype=np.int32)  # as read from bundles
+    with outputs.open_writer(path, {"output-format": "valuesnc"}) as writer:
+        writer.writeheader(["region", "year", "plainyear", "value"])
+        writer.writecolumns(
+            [
+                outputs.Factor(["USA", "CAN"], [0, 1, 1]),
+                outputs.Factor(list(years), [0, 0, 1]),
+                years[[0, 0, 1]],
+                outputs.Factor([0.5, 1.5], [1, 0, 1]),
+            ]
+        )
+
+    rootgrp = netCDF4.Dataset(path)
+    assert rootgrp.variables["year"].dtype == np.int32
+    assert rootgrp.variables["plainyear"].dtype == np.int32
+    assert rootgrp.variables["value"].dtype == np.float64
+    rootgrp.close()
+    columns = outputs.read_columns(path)
+    assert list(columns["region"]) == ["USA", "CAN", "CAN"]
+    assert list(columns["year"]) == [2030, 2030, 2050]
+
+
+def test_csv_bulk_formatting(tmp_path, monkeypatch):
+    """Factors, quoting, precision and compression in bulk writes"""
+    monkeypatch.setattr(outputs, "block_rows", 2)
+    labels = ["plain", 'has "quotes"', "has,comma"]
+    columns = [
+        outputs.Factor(labels, [0, 1, 2, 1, 0]),
+        np.array([0.1, -0.0, np.nan, 1e-20, 12345678.9]),
+        outputs.Factor([2030], np.zeros(5, int)),
+    ]
+
+    path = str(tmp_path / "rows.csv")
+    with outputs.open_writer(path, {}) as writer:
+        for row in zip([labels[ii] for ii in [0, 1, 2, 1, 0]], columns[1], [2030] * 5):
+            writer.writerow(row)
+    with outputs.open_writer(str(tmp_path / "columns.csv"), {}) as writer:
+        writer.writecolumns(columns)
+    assert (tmp_path / "columns.csv").read_text() == open(path).read()
+
+    config = {"output-compression": "gzip", "output-precision": 2}
+    path = str(tmp_path / ("rounded" + outputs.extension(config)))
+    with outputs.open_writer(path, config) as writer:
+        writer.writecolumns(columns[1:])
+    with gzip.open(path, "rt", newline="") as fp:
+        assert fp.read() == (
+            "0.10,2030\r\n-0.00,2030\r\nnan,2030\r\n0.00,2030\r\n12345678.90,2030\r\n"
+        )
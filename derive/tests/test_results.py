@@ -0,0 +1,247 @@
+import os
+import numpy as np
+import pytest
+import derive.api
+from derive.api import configs, results
+from derive.tests.conftest import GCMS, REGIONS, write_bundle
+
+
+def sum_into_data(root, config, basenames=["impact", "-impact"]):
+    config = dict(config, **{"do-montecarlo": True})
+    columns, basenames, transforms, vectransforms = configs.interpret_filenames(
+        basenames, config
+    )
+    return results.sum_into_data(
+        root, basenames, columns, config, transforms, vectransforms
+    )
+
+
+@pytest.mark.parametrize(
+    "workers",
+    [
+        {"workers": 2},
+        {"workers": 2, "worker-tasks": 1},
+        {"prefetch": 3},
+        {"prefetch": 3, "prefetch-memory": 1},
+    ],
+)
+def test_workers_match_serial(resultsroot, workers):
+    """Reading in worker processes or a prefetch thread gives the same data"""
+    config = {"regions": ["USA", "MEX"], "years": [2005, 2010]}
+    serial, serialyears = sum_into_data(resultsroot, config, ["impact"])
+    parallel, parallelyears = sum_into_data(
+        resultsroot, dict(config, **workers), ["impact"]
+    )
+
+    np.testing.assert_array_equal(serialyears, parallelyears)
+    assert list(serial.keys()) == list(parallel.keys())
+    for filestuff in serial:
+        assert list(serial[filestuff].keys()) == list(parallel[filestuff].keys())
+        for rowstuff in serial[filestuff]:
+            assert list(serial[filestuff][rowstuff].items()) == list(
+                parallel[filestuff][rowstuff].items()
+            )
+    assert len(serial[filestuff][rowstuff]) == 2 * len(GCMS)
+
+
+def test_transforms_sum(resultsroot):
+    """A negated basename cancels the same basename"""
+    data, years = sum_into_data(resultsroot, {"region": "CAN", "workers": 2})
+    for filestuff in data:
+        for rowstuff in data[filestuff]:
+            assert all(value == 0 for value in data[filestuff][rowstuff].values())
+
+
+@pytest.mark.parametrize("workers", [{}, {"workers": 2}, {"prefetch": 3}])
+def test_repeated_basename_sum(resultsroot, workers):
+    """A basename repeated around its negation sums to itself, for all regions"""
+    single, singleyears = sum_into_data(resultsroot, workers, ["impact"])
+    repeated, repeatedyears = sum_into_data(
+        resultsroot, workers, ["impact", "-impact", "impact"]
+    )
+
+    assert list(single.keys()) == list(repeated.keys())
+    for filestuff in single:
+        for rowstuff in single[filestuff]:
+            assert "all" in rowstuff
+            for member, values in single[filestuff][rowstuff].items():
+                assert np.any(values != 0)
+                np.testing.assert_allclose(
+                    repeated[filestuff][rowstuff][member], values, atol=1e-12
+                )
+
+
+def test_crawler_prunes_filtered_levels(resultsroot, monkeypatch):
+    """Filtered crawls skip whole subtrees and give the same targets"""
+    config = {"do-montecarlo": True, "only-rcp": "rcp85", "only-models": ["MIROC5"]}
+    everything = [
+        target
+        for target in configs.iterate_valid_targets(
+            resultsroot, {"do-montecarlo": True}, ["impact"]
+        )
+        if target[1] == "rcp85" and target[2] == "MIROC5"
+    ]
+
+    scanned = []
+    scandir = os.scandir
+
+    def counting_scandir(path):
+        scanned.append(path)
+        return scandir(path)
+
+    monkeypatch.setattr(os, "scandir", counting_scandir)
+    results.listings.clear()
+    targets = list(configs.iterate_valid_targets(resultsroot, config, ["impact"]))
+
+    assert targets == everything
+    assert not any("rcp45" in path or "CCSM4" in path for path in scanned)
+    # Each target directory is listed once, for the check and the read
+    assert len(targets) == 2
+    for target in targets:
+        assert results.target_paths(target, ["impact"]) is not None
+        assert scanned.count(target[-1]) == 1
+
+
+def test_crawls_see_new_files(resultsroot):
+    """Files added between crawls are found by the later crawl"""
+    config = {"do-montecarlo": True}
+    assert list(configs.iterate_valid_targets(resultsroot, config, ["other"])) == []
+
+    targetdir = os.path.join(resultsroot, "batch0", "rcp85", "MIROC5", "high", "SSP3")
+    os.symlink(
+        os.path.join(targetdir, "impact.nc4"), os.path.join(targetdir, "other.nc4")
+    )
+    targets = list(configs.iterate_valid_targets(resultsroot, config, ["other"]))
+    assert [target[-1] for target in targets] == [targetdir]
+
+
+def test_region_chunks_match_whole(resultsroot, tmp_path, capsys):
+    """Quantiles read a chunk of regions at a time match those read at once"""
+    config = {
+        "results-root": resultsroot,
+        "do-montecarlo": True,
+        "do-gcmweights": False,
+    }
+    derive.api.quantiles(
+        ["impact"], dict(config, **{"output-dir": str(tmp_path / "whole")})
+    )
+    capsys.readouterr()
+    derive.api.quantiles(
+        ["impact"],
+        dict(config, **{"output-dir": str(tmp_path / "chunked"), "max-memory": 3000}),
+    )
+    assert "Reading 4 regions in chunks of 1." in capsys.readouterr().out
+
+    for path in (tmp_path / "whole").iterdir():
+        assert (tmp_path / "chunked" / path.name).read_text() == path.read_text()
+
+
+def test_region_chunks_skip_missing_regions(resultsroot, tmp_path, monkeypatch):
+    """Regions missing from some files are left out of chunks, not filled"""
+    seed = 100
+    for batch in ["batch0", "batch1"]:
+        for gcm in GCMS:
+            seed += 1
+            path = os.path.join(
+                resultsroot, batch, "rcp85", gcm, "high", "SSP3", "impact.nc4"
+            )
+            os.remove(path)
+            write_bundle(path, seed, REGIONS[:2])
+
+    # Size the chunks by the files with every region, whichever is crawled first
+    region_footprint = results.region_footprint
+    monkeypatch.setattr(
+        results,
+        "region_footprint",
+        lambda *args: (len(REGIONS), region_footprint(*args)[1]),
+    )
+
+    config = {
+        "results-root": resultsroot,
+        "do-montecarlo": True,
+        "do-gcmweights": False,
+    }
+    for rcp in ["rcp45", "rcp85"]:
+        derive.api.quantiles(
+            ["impact"],
+            dict(config, **{"output-dir": str(tmp_path / "whole"), "only-rcp": rcp}),
+        )
+    derive.api.quantiles(
+        ["impact"],
+        dict(config, **{"output-dir": str(tmp_path / "chunked"), "max-memory": 3000}),
+    )
+
+    for path in (tmp_path / "whole").iterdir():
+        assert (tmp_path / "chunked" / path.name).read_text() == path.read_text()
+
+
+@pytest.mark.parametrize("blockrows", [1000, 3])
+def test_output_workers_match_serial(resultsroot, tmp_path, blockrows):
+    """Files computed in output workers, whole or in blocks, match a serial run"""
+    config = {
+        "results-root": resultsroot,
+        "do-montecarlo": True,
+        "do-gcmweights": False,
+        "region": "USA",
+    }
+    derive.api.quantiles(
+        ["impact"], dict(config, **{"output-dir": str(tmp_path / "serial")})
+    )
+    derive.api.quantiles(
+        ["impact"],
+        dict(
+            config,
+            **{
+                "output-dir": str(tmp_path / "workers"),
+                "output-workers": 2,
+                "output-block-rows": blockrows,
+            }
+        ),
+    )
+
+    paths = list((tmp_path / "serial").iterdir())
+    assert paths
+    for path in paths:
+        assert (tmp_path / "workers" / path.name).read_text() == path.read_text()
+
+
+@pytest.mark.parametrize("distribution", ["ecdf", "sketch"])
+def test_shards_merge_to_single_run(resultsroot, tmp_path, distribution):
+    """Merging the partial results of every shard matches a single run"""
+    config = {
+        "results-root": resultsroot,
+        "do-montecarlo": True,
+        "do-gcmweights": False,
+        "regions": ["USA", "CAN"],
+        "distribution": distribution,
+    }
+    derive.api.quantiles(
+        ["impact"], dict(config, **{"output-dir": str(tmp_path / "single")})
+    )
+
+    config["output-dir"] = str(tmp_path / "merged")
+    config["shard-dir"] = str(tmp_path / "shards")
+    for shard in ["0/3", "1/3", "2/3"]:
+        derive.api.quantiles(["impact"], dict(config, shard=shard))
+    assert not (tmp_path / "merged").exists()
+    derive.api.merge(["impact"], config)
+
+    paths = list((tmp_path / "single").iterdir())
+    assert paths
+    for path in paths:
+        merged = (tmp_path / "merged" / path.name).read_text()
+        if distribution == "ecdf":
+            assert merged == path.read_text()
+        else:
+            # Sketches are summed in a different order
+            single = [line.split(",") for line in path.read_text().splitlines()]
+            merged = [line.split(",") for line in merged.splitlines()]
+            assert [row[:2] for row in merged] == [row[:2] for row in single]
+            np.testing.assert_allclose(
+                np.array([row[2:] for row in merged[1:]], dtype=float),
+                np.array([row[2:] for row in single[1:]], dtype=float),
+                rtol=1e-12,
+            )
+
+    with pytest.raises(AssertionError, match="different options"):
+        derive.api.merge(["impact"], dict(config, years=[2050]))
@@ -0,0 +1,51 @@
+import numpy as np
+from derive.api import sketches, weights
+
+QUANTILES = [0.01, 0.17, 0.5, 0.83, 0.99]
+
+
+def test_small_sketch_is_exact():
+    """Without dropping any entries, quantiles are those of the ECDF"""
+    rs = np.random.RandomState(0)
+    values = rs.normal(size=(30, 4))
+    memberweights = rs.uniform(0.1, 1, size=30)
+
+    sketch = sketches.WeightedSketch((4,), error=0.001)
+    for value, weight in zip(values, memberweights):
+        sketch.add(value, weight)
+    quantiles, errorbounds = sketch.quantiles([2] + QUANTILES)
+
+    np.testing.assert_allclose(
+        quantiles,
+        weights.weighted_quantiles(values, memberweights, [2] + QUANTILES),
+        rtol=1e-12,
+    )
+    np.testing.assert_array_equal(errorbounds, 0)
+
+
+def test_merged_sketches_within_error():
+    """Quantiles of merged, reloaded sketches lie within the rank error"""
+    rs = np.random.RandomState(1)
+    values = rs.normal(size=(3000, 20)) * rs.uniform(0.5, 2, size=20)
+    memberweights = rs.uniform(0.1, 1, size=3000)
+    error = 0.01
+
+    parts = [sketches.WeightedSketch((20,), error) for kk in range(3)]
+    for ii in range(len(values)):
+        parts[ii % 3].add(values[ii], memberweights[ii])
+    sketch = parts[0]
+    for part in parts[1:]:
+        sketch.merge(sketches.WeightedSketch.from_bytes(part.to_bytes()))
+    assert sketch.values.shape[1] < 1000  # much less than every value
+
+    quantiles, errorbounds = sketch.quantiles(QUANTILES)
+    assert np.all(errorbounds <= error)
+    upper = weights.weighted_quantiles(values, memberweights, QUANTILES)
+    lower = weights.weighted_quantiles(
+        values, memberweights, [pp - error for pp in QUANTILES]
+    )
+    assert np.all((quantiles >= lower) & (quantiles <= upper))
+    np.testing.assert_allclose(
+        sketch.quantiles([2])[0][:, 0],
+        np.average(values, axis=0, weights=memberweights),
+    )
@@ -0,0 +1,102 @@
+import numpy as np
+import pytest
+from derive.api import bundles, temporal
+
+YEARS = np.arange(2000, 2030)
+
+
+@pytest.fixture
+def values():
+    return np.random.RandomState(1).normal(size=(len(YEARS), 4))
+
+
+def test_yearset_means(values):
+    """Prefix-sum yearset means match direct means, including overlaps"""
+    yearsets = [(2000, 2010), (2005, 2015), (2020, 2030), (2040, 2050)]
+    means = temporal.yearset_means(YEARS, values, yearsets)
+
+    for ii, yearset in enumerate(yearsets[:3]):
+        mask = (YEARS >= yearset[0]) & (YEARS < yearset[1])
+        np.testing.assert_allclose(means[ii], values[mask].mean(axis=0))
+    assert np.all(np.isnan(means[3]))
+
+
+def test_rolling_means(values):
+    """Rolling means cover the window ending at each complete year"""
+    endyears, means = temporal.rolling_means(YEARS, values, 10)
+
+    np.testing.assert_array_equal(endyears, YEARS[9:])
+    for ii, endyear in enumerate(endyears):
+        mask = (YEARS > endyear - 10) & (YEARS <= endyear)
+        np.testing.assert_allclose(means[ii], values[mask].mean(axis=0))
+
+
+def test_cumulative_sums_discounted(values):
+    """Discounted running totals are NPVs back to the discount year"""
+    sums = temporal.cumulative_sums(YEARS, values, 0, 0.03, 2010)
+
+    factors = 1.03 ** -(YEARS - 2010.0)
+    np.testing.assert_allclose(sums[-1], np.sum(values * factors[:, None], axis=0))
+    np.testing.assert_allclose(
+        temporal.cumulative_sums(YEARS, values), np.cumsum(values, axis=0)
+    )
+
+
+def test_iterate_values_deltamethod_layout(values):
+    """Yearsets average over the year axis of deltamethod coefficients"""
+    coefs = np.stack([values, 2 * values, -values])  # coefs x years x regions
+    config = {"deltamethod": True, "yearsets": [[2000, 2010], [2010, 2020]]}
+
+    results = list(bundles.iterate_values(YEARS, coefs, config))
+    assert [label for label, value in results] == ["2000-2010", "2010-2020"]
+    np.testing.assert_allclose(results[0][1], coefs[:, :10, :].mean(axis=1))
+
+
+def test_masked_and_nan_years(values):
+    """Masked years are left out; NaN years only spoil their own spans"""
+    masked = np.ma.masked_array(values, mask=np.zeros(values.shape, dtype=bool))
+    masked[1, 0] = np.ma.masked
+    masked[12, 1] = np.nan
+    yearsets = [(2000, 2003), (2005, 2010), (2010, 2015), (2020, 2030)]
+    means = temporal.yearset_means(YEARS, masked, yearsets)
+
+    for ii, yearset in enumerate(yearsets):
+        mask = (YEARS >= yearset[0]) & (YEARS < yearset[1])
+        np.testing.assert_allclose(means[ii], np.ma.mean(masked[mask], axis=0))
+    assert np.isnan(means[2, 1]) and np.all(np.isfinite(np.delete(means, 9)))
+
+    endyears, rolling = temporal.rolling_means(YEARS, masked, 5)
+    assert np.all(np.isfinite(rolling[:, 0]))
+    assert np.all(np.isnan(rolling[8:13, 1]))
+    assert np.all(np.isfinite(np.delete(rolling[:, 1], range(8, 13))))
+
+    sums = temporal.cumulative_sums(YEARS, masked)
+    np.testing.assert_allclose(sums[-1, 0], np.ma.sum(masked[:, 0]))
+
+
+def test_rolling_window_drops_incomplete_years(values):
+    """Requested years without a complete window are left out"""
+    config = {"rolling-window": 5, "years": [2002, 2008]}
+
+    results = list(bundles.iterate_values(YEARS, values, config))
+    assert [year for year, value in results] == [2008]
+    np.testing.assert_allclose(results[0][1], values[4:9].mean(axis=0))
+
+
+def test_float32_means_keep_type(values):
+    """float32 yearset and rolling means are float32, yearsets as np.mean gives"""
+    values = values.astype(np.float32)
+    yearsets = [(2000, 2010), (2005, 2015)]
+    means = temporal.yearset_means(YEARS, values, yearsets)
+
+    assert means.dtype == np.float32
+    for ii, yearset in enumerate(yearsets):
+        mask = (YEARS >= yearset[0]) & (YEARS < yearset[1])
+        np.testing.assert_array_equal(means[ii], np.mean(values[mask], axis=0))
+    assert temporal.rolling_means(YEARS, values, 10)[1].dtype == np.float32
+
+    masked = np.ma.masked_array(values, mask=np.zeros(values.shape, dtype=bool))
+    masked[:10, 0] = np.ma.masked
+    means = temporal.yearset_means(YEARS, masked, yearsets)
+    assert np.isnan(means[0, 0])
+    np.testing.assert_allclose(means[1, 0], np.mean(values[10:15, 0]), rtol=1e-6)
@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+from derive.api import weights
+
+EVALQVALS = weights.WeightedECDF.encode_evalqvals(["mean", 0.17, 0.5, 0.83, "sdev"])
+
+
+@pytest.mark.parametrize(
+    "memberweights", [np.ones(7), np.array([0.1, 0.3, 0.0, 0.2, 0.2, 0.1, 0.4])]
+)
+@pytest.mark.parametrize("ignore_missing", [False, True])
+def test_weighted_quantiles_match_ecdf(memberweights, ignore_missing):
+    """Batched quantiles match WeightedECDF row by row"""
+    values = np.random.RandomState(0).normal(size=(7, 5, 3))
+    values[1, 0, 0] = values[3, 0, 0]  # A tie
+    if ignore_missing:
+        values[2, 1, :] = np.nan
+        values[:, 2, 2] = np.nan
+
+    quantiles = weights.weighted_quantiles(
+        values, memberweights, EVALQVALS, ignore_missing
+    )
+    assert quantiles.shape == (5, 3, len(EVALQVALS))
+    for ii in range(5):
+        for jj in range(3):
+            distribution = weights.WeightedECDF(
+                values[:, ii, jj], list(memberweights), ignore_missing=ignore_missing
+            )
+            np.testing.assert_allclose(
+                quantiles[ii, jj], distribution.inverse(EVALQVALS), rtol=1e-12
+            )
+
+
+def test_weighted_quantiles_rows():
+    """Rows with different members and weights are each computed correctly"""
+    rs = np.random.RandomState(1)
+    rowvalues = [rs.normal(size=4), rs.normal(size=3), rs.normal(size=4)]
+    rowweights = [[1.0, 2.0, 1.0, 1.0], [1.0, 1.0, 1.0], [1.0, 2.0, 1.0, 1.0]]
+
+    results = weights.weighted_quantiles_rows(rowvalues, rowweights, EVALQVALS)
+    for values, memberweights, result in zip(rowvalues, rowweights, results):
+        np.testing.assert_allclose(
+            result,
+            weights.WeightedECDF(values, memberweights).inverse(EVALQVALS),
+            rtol=1e-12,
+        )
+
+
+def test_member_weights(tmp_path, capsys, monkeypatch):
+    """GCM weights are read once and aligned to the members"""
+    monkeypatch.setattr(weights, "registry", {})
+    monkeypatch.setattr(weights, "unweighted", set())
+    for rcp in ["rcp45", "rcp85"]:
+        (tmp_path / (rcp + "_2090_SMME_edited_for_April_2016.tsv")).write_text(
+            "n\tmodel\tweight\n1\tCCSM4_r1\t0.3\n2\t*GFDL-CM3*\t0.5\n"
+        )
+        (tmp_path / (rcp + "_SMME_weights.tsv")).write_text(
+            "n\tmodel\tweight\n1\tpattern1\t0.1\n"
+        )
+    config = {"gcmweights-dir": str(tmp_path)}
+    members = [("batch0", "GFDL-CM3", "high"), ("batch0", "MIROC5", "high")]
+    members.append(("batch1", "CCSM4", "high"))
+
+    for repeat in range(2):
+        np.testing.assert_array_equal(
+            weights.member_weights(members, "rcp85", config), [0.5, 0.0, 0.3]
+        )
+    assert list(weights.registry) == [(str(tmp_path), "rcp85")]
+    assert capsys.readouterr().out.count("No weight available for MIROC5") == 1
+
+    np.testing.assert_array_equal(
+        weights.member_weights(members, "rcp85", {"do-gcmweights": False}),
+        np.ones(3),
+    )
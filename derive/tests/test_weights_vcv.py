@@ -0,0 +1,103 @@
+import warnings
+import numpy as np
+from scipy.optimize import brentq
+from scipy.stats import norm
+from derive.api import weights_vcv
+
+PP = [2, 0.01, 0.17, 0.5, 0.83, 0.99]
+
+
+def brentq_quantiles(means, variances, weights, pp):
+    """Each quantile of one mixture, solved separately with brentq"""
+    sds = np.sqrt(variances)
+    weights = np.array(weights) / np.sum(weights)
+    probs = np.array(pp)
+    left = np.min(norm.ppf(np.min(probs), means, sds))
+    right = np.max(norm.ppf(np.max(probs[probs < 1]), means, sds))
+
+    roots = []
+    for p in pp:
+        if p == 2:
+            roots.append(np.average(means, weights=weights))
+        else:
+            roots.append(
+                brentq(
+                    lambda x: np.sum(weights * norm.cdf(x, means, sds)) - p,
+                    left,
+                    right,
+                )
+            )
+    return roots
+
+
+def test_mixture_quantiles_match_brentq():
+    """Vectorized quantiles match brentq within the tolerance"""
+    rs = np.random.RandomState(0)
+    means = rs.normal(size=(8, 4, 3))
+    variances = rs.exponential(size=(8, 4, 3)) ** 2
+    weights = rs.uniform(size=8)
+
+    quantiles = weights_vcv.mixture_quantiles(means, variances, weights, PP)
+    assert quantiles.shape == (4, 3, len(PP))
+    for ii in range(4):
+        for jj in range(3):
+            np.testing.assert_allclose(
+                quantiles[ii, jj],
+                brentq_quantiles(means[:, ii, jj], variances[:, ii, jj], weights, PP),
+                rtol=0,
+                atol=2 * weights_vcv.default_tolerance,
+            )
+
+
+def test_mixture_quantiles_rows():
+    """Rows with their own components and weights match WeightedGMCDF"""
+    rs = np.random.RandomState(1)
+    rowmeans = [rs.normal(size=5), rs.normal(size=3), rs.normal(size=5)]
+    rowvariances = [rs.exponential(size=len(means)) for means in rowmeans]
+    rowweights = [[1.0] * 5, [1.0, 2.0, 3.0], [1.0] * 5]
+
+    results = weights_vcv.mixture_quantiles_rows(
+        rowmeans, rowvariances, rowweights, PP, tolerance=1e-6
+    )
+    for ii in range(3):
+        np.testing.assert_allclose(
+            results[ii],
+            brentq_quantiles(rowmeans[ii], rowvariances[ii], rowweights[ii], PP),
+            rtol=0,
+            atol=2e-6,
+        )
+
+
+def test_mixture_quantiles_narrow_components():
+    """Overflowing Newton steps fall back on bisection without warnings"""
+    rs = np.random.RandomState(19)
+    means = rs.normal(scale=10, size=(rs.randint(2, 6), 1))
+    variances = rs.uniform(1e-3, 1e-1, size=means.shape) ** 2
+    weights = rs.uniform(size=len(means))
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        quantiles = weights_vcv.mixture_quantiles(means, variances, weights, PP)
+    np.testing.assert_allclose(
+        quantiles[0],
+        brentq_quantiles(means[:, 0], variances[:, 0], weights, PP),
+        rtol=0,
+        atol=2 * weights_vcv.default_tolerance,
+    )
+
+
+def test_mixture_quantiles_no_cycling():
+    """Newton steps on very uneven mixtures still converge"""
+    rs = np.random.RandomState(0)
+    means = rs.normal(size=(30, 5000))[:, [285, 500, 832, 892]]
+    variances = (rs.exponential(size=(30, 5000)) ** 2)[:, [285, 500, 832, 892]]
+    weights = rs.uniform(size=30)
+
+    quantiles = weights_vcv.mixture_quantiles(means, variances, weights, PP)
+    for ii in range(4):
+        np.testing.assert_allclose(
+            quantiles[ii],
+            brentq_quantiles(means[:, ii], variances[:, ii], weights, PP),
+            rtol=0,
+            atol=2 * weights_vcv.default_tolerance,
+        )